@@ -1,14 +1,16 @@
 # coding=utf-8
-import ccxt
-from ccxt.base.exchange import Exchange
+import json
+import os
 import time
 from datetime import datetime
 import psycopg2
-import tomli
 import re
+import sys
+import getopt
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from DeribitVolHistoryDBUpdate import DeribitVolHistoryDBUpdate
+from DatabaseGateway import get_database_pool, load_config as load_config_section
+from JobInstrumentation import instrumentation, timed, EXCHANGE_FETCH, TRANSFORM, DB_READ, DB_WRITE, ROWS_FETCHED, ROWS_INSERTED, HTTP_CALLS
 
 
 OHLCV_TABLE_TIMESTAMP = 4  # column of human-readable timestamp in database
@@ -24,8 +26,32 @@ OHLCV_EXCHANGE_LOW = 5
 OHLCV_EXCHANGE_CLOSE = 6
 OHLCV_EXCHANGE_VOLUME = 7
 
+DAY_MS = 24 * 60 * 60 * 1000
+# deribit trades are fetched per currency, a page at a time; the most trades a request returns
+TRADES_PAGE_SIZE = 1000
+DERIVATIVE_TYPES = ('swap', 'future', 'option')
 
-def get_exchange_ohlcv(exchange: Exchange, market: dict) -> list:
+# keys of the prices written by the daily run that have not been given vols yet; picked up by the next run
+PENDING_KEYS_FILE = 'pending_price_keys.json'
+
+# imported on first use (see get_ccxt); importing ccxt loads every exchange it supports, which takes most of a second
+ccxt = None
+
+
+def get_ccxt():
+    """ The ccxt module, imported the first time it is needed
+    """
+
+    global ccxt
+
+    if ccxt is None:
+        import ccxt as ccxt_module
+        ccxt = ccxt_module
+
+    return ccxt
+
+
+def get_exchange_ohlcv(exchange, market: dict) -> list:
     """ Returns Exchange OHLCV Data for given market symbol (if it exists)
     """
 
@@ -34,24 +60,29 @@ def get_exchange_ohlcv(exchange: Exchange, market: dict) -> list:
         if symbol in exchange.markets:
             time.sleep(exchange.rateLimit / 1000) # time.sleep wants seconds
             # time_from = 1534201200000 # Deribit starts on 14 Aug 2018
-            ohlcv_page = exchange.fetch_ohlcv(symbol, timeframe='1d', limit=5000)
+            # ccxt parses the response itself, so the fetch includes the json parse
+            with instrumentation.stage(EXCHANGE_FETCH):
+                ohlcv_page = exchange.fetch_ohlcv(symbol, timeframe='1d', limit=5000)
+            instrumentation.count(exchange.id, HTTP_CALLS)
+            instrumentation.count(exchange.id, ROWS_FETCHED, len(ohlcv_page))
             # pp.pprint(ohlv_page)
             #print(datetime.fromtimestamp(ohlv_page[0][0]/1000).strftime("%d %B %Y %H:%M:%S"))
 
             table = []
-            for ohlcv_row in ohlcv_page:
-                # print(ohlcv_row)
-                row = [exchange.id, symbol]
-                row.extend(ohlcv_row)
-                table.append(row)
+            with instrumentation.stage(TRANSFORM, count=len(ohlcv_page)):
+                for ohlcv_row in ohlcv_page:
+                    # print(ohlcv_row)
+                    row = [exchange.id, symbol]
+                    row.extend(ohlcv_row)
+                    table.append(row)
             return table
 
 
 def check_ohlcv_table_exists(cursor: psycopg2.extensions.cursor):
     cursor.execute(f'''CREATE TABLE IF NOT EXISTS '{OHLCV_PRICE_TABLE}' (
                         ts TIMESTAMP,
-                        Exchange  STRING NOT NULL,
-                        MarketSymbol  STRING NOT NULL,
+                        Exchange  SYMBOL CAPACITY 256 CACHE INDEX,
+                        MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
                         ExchangeDay TIMESTAMP NOT NULL,
                         ExchangeDate TIMESTAMP NOT NULL,
                         ExchangeTimestamp LONG NOT NULL,
@@ -60,10 +91,14 @@ def check_ohlcv_table_exists(cursor: psycopg2.extensions.cursor):
                         Low   FLOAT,
                         Close FLOAT,
                         Volume  FLOAT
-                ) timestamp(ts);''')
+                ) timestamp(ExchangeDate) PARTITION BY MONTH;''')
 
 
-def update_ohlcv_table(connection: psycopg2.extensions.connection, cursor: psycopg2.extensions.cursor, exchange_ohlcv: list, last_update: int=0) -> int:
+@timed(DB_WRITE)
+def update_ohlcv_table(connection: psycopg2.extensions.connection, cursor: psycopg2.extensions.cursor, exchange_ohlcv: list, last_update: int=0, written_keys: set=None) -> int:
+    """ Insert any rows newer than last_update. If given, the (exchange, symbol, 'YYYY-MM-DD') key
+        of every row written is added to written_keys.
+    """
     now = datetime.utcnow()
     rowcount = 0
     for ohlcv_row in exchange_ohlcv:
@@ -85,38 +120,184 @@ def update_ohlcv_table(connection: psycopg2.extensions.connection, cursor: psyco
                  ohlcv_row[OHLCV_EXCHANGE_OPEN], ohlcv_row[OHLCV_EXCHANGE_HIGH], ohlcv_row[OHLCV_EXCHANGE_LOW], ohlcv_row[OHLCV_EXCHANGE_CLOSE],
                  ohlcv_row[OHLCV_EXCHANGE_VOLUME]))
             rowcount += cursor.rowcount
+            if written_keys is not None:
+                written_keys.add((ohlcv_row[OHLCV_EXCHANGE_EXCHANGE], ohlcv_row[OHLCV_EXCHANGE_SYMBOL], exchange_day.strftime('%Y-%m-%d')))
     connection.commit()
     return rowcount
 
 
+@timed(DB_READ)
 def get_ohlcv_last_update_time(cursor: psycopg2.extensions.cursor, exchange_id: str, market_symbol: str) -> int:
-    cursor.execute(f'''SELECT max(ExchangeTimestamp)
+    # the latest row for the symbol is found through the MarketSymbol index, newest partition first
+    cursor.execute(f'''SELECT ExchangeTimestamp
                         FROM '{OHLCV_PRICE_TABLE}'
                         WHERE MarketSymbol = %s
-                        AND Exchange = %s;
+                        AND Exchange = %s
+                        LATEST ON ExchangeDate PARTITION BY MarketSymbol;
                         ''',
                    (market_symbol, exchange_id))
     last_update_time_ms = cursor.fetchone()
-    return last_update_time_ms[0]
+    return last_update_time_ms[0] if last_update_time_ms else None
+
+
+@timed(DB_READ)
+def get_ohlcv_last_rows(cursor: psycopg2.extensions.cursor, exchange_id: str) -> dict:
+    """ The latest (ExchangeTimestamp, Close) of every symbol of the exchange, in one query
+    """
+
+    cursor.execute(f'''SELECT MarketSymbol, ExchangeTimestamp, Close
+                        FROM '{OHLCV_PRICE_TABLE}'
+                        WHERE Exchange = %s
+                        LATEST ON ExchangeDate PARTITION BY MarketSymbol;
+                        ''',
+                   (exchange_id,))
+    return {symbol: (timestamp, close) for symbol, timestamp, close in cursor.fetchall()}
+
+
+def get_deribit_day_trades(exchange, currencies: list, day_timestamp: int, end_timestamp: int) -> dict:
+    """ Deribit instrument name to its [timestamp, price, amount] trades between the start of the day and end_timestamp,
+        oldest first, for every instrument of the given currencies; a request per page of trades per currency
+    """
+
+    trades = {}
+
+    for currency in currencies:
+        start_timestamp = day_timestamp
+        seen = set()
+
+        while True:
+            time.sleep(exchange.rateLimit / 1000)
+            with instrumentation.stage(EXCHANGE_FETCH):
+                response = exchange.public_get_get_last_trades_by_currency_and_time(
+                    {'currency': currency, 'start_timestamp': start_timestamp, 'end_timestamp': end_timestamp,
+                     'count': TRADES_PAGE_SIZE, 'sorting': 'asc'})
+            instrumentation.count(exchange.id, HTTP_CALLS)
+
+            page = response['result']['trades']
+
+            for trade in page:
+                # pages overlap on the timestamp they start from
+                if trade['trade_id'] in seen:
+                    continue
+                seen.add(trade['trade_id'])
+                trades.setdefault(trade['instrument_name'], []).append(
+                    [int(trade['timestamp']), float(trade['price']), float(trade['amount'])])
+
+            if not page or not response['result'].get('has_more'):
+                break
+
+            # a full page of trades on a single millisecond would otherwise be fetched forever
+            last_timestamp = int(page[-1]['timestamp'])
+            start_timestamp = last_timestamp if last_timestamp > start_timestamp else start_timestamp + 1
+
+    return trades
+
+
+def day_trades_ohlcv(exchange_id: str, symbol: str, trades: list, day_timestamp: int, previous_close: float,
+                     amount_in_usd: bool = False) -> list:
+    """ The day's row so far, laid out as get_exchange_ohlcv returns them, from the instrument's trades since 00:00 UTC;
+        the same window as the day's candle. A day without trades is flat at the previous close, with no volume,
+        as deribit's candle for it is.
+
+        :param amount_in_usd: the trade amounts are in USD (deribit futures and perpetuals) and are converted to
+                              the currency, as candle volumes are
+    """
+
+    if not trades:
+        return [exchange_id, symbol, day_timestamp, previous_close, previous_close, previous_close, previous_close, 0.0]
+
+    prices = [price for _, price, _ in trades]
+    volume = sum(amount / price if amount_in_usd else amount for _, price, amount in trades)
+
+    return [exchange_id, symbol, day_timestamp, prices[0], max(prices), min(prices), prices[-1], volume]
+
+
+def update_deribit_day_trades(exchange, markets: dict, market_symbols: list, connection, cursor, written_keys: set) -> list:
+    """ Deribit fast path; the day's row for every future, perpetual and option that is up to date bar today,
+        built from the currency wide trades since 00:00 UTC (a request per 1000 trades) instead of a fetch_ohlcv
+        per instrument. The rows cover the same window as the candles fetched one by one.
+
+        Returns the symbols it could not serve, for the per instrument path; those with days missing (or no history
+        at all), and spot markets. Symbols that already have today's row are left alone.
+    """
+
+    now = exchange.milliseconds()
+    # candles are keyed by their UTC day
+    day_timestamp = now // DAY_MS * DAY_MS
+
+    last_rows = get_ohlcv_last_rows(cursor, exchange.id)
+    currencies = sorted({markets[symbol]['settle'] for symbol in market_symbols
+                         if markets[symbol]['type'] in DERIVATIVE_TYPES and markets[symbol].get('settle')})
+
+    trades = get_deribit_day_trades(exchange, currencies, day_timestamp, now)
 
+    remaining = []
+    exchange_ohlcv = []
 
-def load_config(db_config: dict, ccxt_markets: dict, logging_config: dict) -> None:
-    with open("CryptoPriceDBGateway.toml", mode="rb") as cf:
-        config = tomli.load(cf)
+    for symbol in market_symbols:
+        market = markets[symbol]
+        last_row = last_rows.get(symbol)
 
-        # database config
-        db_config['user'] = config['database']['user']
-        db_config['password'] = config['database']['password']
-        db_config['host'] = config['database']['host']
-        db_config['port'] = config['database']['port']
-        db_config['database'] = config['database']['database']
+        if market['type'] not in DERIVATIVE_TYPES or not market.get('settle') or last_row is None:
+            remaining.append(symbol)
+            continue
 
-        # ccxt exchanges & markets
-        ccxt_markets.update(config['ccxt'])
+        last_update, last_close = last_row
 
-        # logging
-        logging_config['filename'] = config['logging']['filename']
-        logging_config['level'] = config['logging']['level']
+        if last_update >= day_timestamp:
+            continue
+
+        if last_update < day_timestamp - DAY_MS:
+            remaining.append(symbol)
+            continue
+
+        exchange_ohlcv.append(day_trades_ohlcv(exchange.id, symbol, trades.get(market['id'], []), day_timestamp,
+                                               last_close, amount_in_usd=market['type'] != 'option'))
+
+    instrumentation.count(exchange.id, ROWS_FETCHED, len(exchange_ohlcv))
+    rows_inserted = update_ohlcv_table(connection, cursor, exchange_ohlcv, written_keys=written_keys)
+    instrumentation.count(exchange.id, ROWS_INSERTED, rows_inserted)
+
+    logger.info(f"{rows_inserted} price rows inserted from the trades of {len(trades)} instruments of {currencies} on exchange {exchange.name}; "
+                f"{len(remaining)} markets left to fetch one by one.")
+
+    return remaining
+
+
+def load_pending_keys(pending_keys_file: str = PENDING_KEYS_FILE) -> set:
+    """ The (exchange, symbol, 'YYYY-MM-DD') keys of prices written by an earlier run that have not been given vols
+    """
+
+    if not os.path.exists(pending_keys_file):
+        return set()
+
+    with open(pending_keys_file) as pf:
+        return {tuple(key) for key in json.load(pf)}
+
+
+def save_pending_keys(keys: set, pending_keys_file: str = PENDING_KEYS_FILE) -> None:
+    """ Write the keys of the prices still waiting for vols, atomically so a failed write never loses the old ones
+    """
+
+    temp_file = pending_keys_file + '.tmp'
+
+    with open(temp_file, 'w') as pf:
+        json.dump(sorted(keys), pf)
+
+    os.replace(temp_file, pending_keys_file)
+
+
+def load_config(ccxt_markets: dict, logging_config: dict) -> None:
+    """ Load the ccxt and logging sections of the shared config; the database is configured by the pool
+    """
+
+    # ccxt exchanges & markets
+    ccxt_markets.update(load_config_section('ccxt'))
+
+    # logging
+    logging_config_section = load_config_section('logging')
+    logging_config['filename'] = logging_config_section['filename']
+    logging_config['level'] = logging_config_section['level']
 
 
 def get_market_symbols(market_id_pattern: str, markets: dict) -> list:
@@ -137,16 +318,39 @@ def is_option(symbol: str) -> bool:
 
     return False
 
-def update_markets(ccxt_markets: dict, connection, cursor) -> None:
+def update_markets(ccxt_markets: dict, connection, cursor, exchanges: dict = None, written_keys: set = None) -> set:
+    """ Update prices for all configured exchanges.
+        Returns the set of (exchange, symbol, 'YYYY-MM-DD') keys that were written.
+
+        Deribit instruments that are up to date bar today are priced from the day's trades (a few requests in all);
+        every other market has its daily candles fetched one market at a time. [ccxt] deribit.day_trades = false
+        fetches deribit one market at a time too.
+
+        :param exchanges: ccxt exchanges by id, kept between runs by a long lived caller (JobScheduler);
+                          an exchange in it is reused, with its markets reloaded, rather than connected afresh
+        :param written_keys: the caller's set to add the keys to as they are written; it keeps the keys of the
+                             prices committed before an exception, so they still get their vols
+    """
+    if written_keys is None:
+        written_keys = set()
     # exchange_ids = set(ccxt_markets.keys())
     # print("EXCH ID", ccxt_markets['exchanges'])
     exchange_ids: dict = ccxt_markets['exchanges']
 
+    ccxt_module = get_ccxt()
+
     for exchange_id in exchange_ids:
         print("PROCESS EXCHANGE", exchange_id)
-        if exchange_id in ccxt.exchanges:
-            exchange = eval('ccxt.%s ()' % exchange_id)  # Connect to exchange
-            markets = exchange.load_markets()  # Load all markets for that exchange
+        if exchange_id in ccxt_module.exchanges:
+            exchange = exchanges.get(exchange_id) if exchanges is not None else None
+            reload = exchange is not None
+            if exchange is None:
+                exchange = getattr(ccxt_module, exchange_id)()  # Connect to exchange
+                if exchanges is not None:
+                    exchanges[exchange_id] = exchange
+            with instrumentation.stage(EXCHANGE_FETCH):
+                markets = exchange.load_markets(reload)  # Load all markets for that exchange
+            instrumentation.count(exchange_id, HTTP_CALLS)
             # print(exchange_id)
             # print(list(markets.keys()))
             # # print(markets['AVAX/USDC:USDC'])
@@ -155,18 +359,24 @@ def update_markets(ccxt_markets: dict, connection, cursor) -> None:
 
             market_symbols: list = filter_swap_market_symbols(markets)
 
+            if exchange_id == 'deribit' and ccxt_markets.get('deribit', {}).get('day_trades', True):
+                market_symbols = update_deribit_day_trades(exchange, markets, market_symbols, connection, cursor, written_keys)
+
             for market_symbol in market_symbols:
                 market = markets[market_symbol]
                 exchange_ohlcv: list = get_exchange_ohlcv(exchange, market)
                 last_update: int = get_ohlcv_last_update_time(cursor, exchange_id, market_symbol)
                 if last_update:
-                    rows_inserted = update_ohlcv_table(connection, cursor, exchange_ohlcv, last_update)
+                    rows_inserted = update_ohlcv_table(connection, cursor, exchange_ohlcv, last_update, written_keys)
                 else:
-                    rows_inserted = update_ohlcv_table(connection, cursor, exchange_ohlcv)
+                    rows_inserted = update_ohlcv_table(connection, cursor, exchange_ohlcv, written_keys=written_keys)
+                instrumentation.count(exchange_id, ROWS_INSERTED, rows_inserted)
 
                 logger.info("{0} price rows inserted for market {2} on exchange {1}.".format(rows_inserted, exchange.name,
                                                                                  market_symbol))
 
+    return written_keys
+
 def set_up_logger(config: dict) -> logging.Logger:
     # logger
     logger = logging.getLogger()
@@ -203,59 +413,76 @@ def update_vols(db_connection, db_cursor):
 
 
 
-def process_ohlcv_price(db_cursor, db_connection, markets):
+def process_ohlcv_price(db_cursor, db_connection, markets, written_keys: set = None) -> set:
     # create table if needed, then update with 'new' records in the timeseries
     # check_ohlcv_table_exists(db_cursor)
-    update_markets(markets, db_connection, db_cursor)
+    return update_markets(markets, db_connection, db_cursor, written_keys=written_keys)
+
+
+def get_args(argv) -> bool:
+    """ Returns whether the run should be profiled
+    """
+
+    opts, args = getopt.getopt(argv, "-hp", ["profile"])
+
+    profile = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('python3 -m CryptoPriceDBGateway -h -p (--profile)')
+            sys.exit()
+
+        if opt in ("-p", "--profile"):
+            profile = True
+
+    return profile
 
 
 if __name__ == "__main__":
 
-    db_config: dict = {}
+    instrumentation.start_run('CryptoPriceDBGateway', get_args(sys.argv[1:]))
+
     markets: dict = {}
     logging_config: dict = {}
 
-    load_config(db_config, markets, logging_config)
+    load_config(markets, logging_config)
 
     # override exhanges
     # markets = {'exchanges': ['binance']}
 
     logger: logging.Logger = set_up_logger(logging_config)
 
-    try:
-        # Connect to DB
-        db_connection = psycopg2.connect(user=db_config['user'], password=db_config['password'], host=db_config['host'], port=db_config['port'], database=db_config['database'])
-        logger.info('Postgres connection is established.')
-    except Exception as e:
-        logger.exception(f"An exception has occurred: {e}")
-        raise e
+    db_pool = get_database_pool()
 
     try:
-        # open connection for read/write
+        # Check out a pooled connection for read/write
+        db_connection = db_pool.get_connection()
         db_cursor = db_connection.cursor()
         logger.info('Postgres connection is opened.')
     except Exception as e:
         logger.exception(f"An exception has occurred: {e}")
-        if db_connection:
-            db_connection.close()
-        logger.info('Postgres connection is closed.')
         raise e
 
+    written_keys: set = set()
+
     try:
-        process_ohlcv_price(db_cursor, db_connection, markets)
+        # filled in as prices are committed, so a failure part way still leaves the keys written so far
+        process_ohlcv_price(db_cursor, db_connection, markets, written_keys)
     except Exception as e:
         logger.exception(f"An exception has occurred: {e}")
     finally:
-        if db_cursor:
-            db_cursor.close()
-        if db_connection:
-            db_connection.close()
-        logger.info('Postgres connection is closed.')
+        db_cursor.close()
+        # returned to the pool, for the vol update to reuse
+        db_pool.put_connection(db_connection)
+        logger.info('Postgres connection is returned to the pool.')
 
-    now = datetime.now()
+    # kept until the vol update has processed them, with those an earlier run wrote but did not give vols
+    price_keys = load_pending_keys() | written_keys
+    save_pending_keys(price_keys)
 
-    year = now.year
-    month = now.month
+    # Now update Vol History for any new prices; the vol job (and QuantLib) is only loaded once the prices are in
+    from DeribitVolHistoryDBUpdate import DeribitVolHistoryDBUpdate
+    vol_update = DeribitVolHistoryDBUpdate(db_pool)
+    vol_update._update_vol_data_for_keys(price_keys)
 
-    # Now update Vol History for any new prices
-    DeribitVolHistoryDBUpdate()._update_historic_vol_data(run_year=year, run_month=month)
\ No newline at end of file
+    save_pending_keys(set())
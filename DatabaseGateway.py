@@ -0,0 +1,377 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Sequence
+import tomli
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import logging
+import logging.handlers as handlers
+
+
+logger = logging.getLogger('DATABASE GATEWAY')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('database_gateway.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+# the one config file used by every job and migration
+CONFIG_FILE = "CryptoAlgo.toml"
+
+DEFAULT_POOL_CONFIG = {'min_connections': 1, 'max_connections': 8, 'reconnect_attempts': 3, 'reconnect_delay': 1.0}
+
+DEFAULT_CHUNK_ROWS = 20000
+DEFAULT_PAGE_SIZE = 1000
+
+# errors that mean the connection itself has gone, rather than the statement being bad
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# how long to wait for a WAL table to apply its pending writes
+WAL_WAIT_SECONDS = 600
+
+
+def load_config(section: str, defaults: dict = None, config_file: str = CONFIG_FILE) -> dict:
+    """ Load a section of the configuration .toml file.
+        With defaults given, the section is optional and only overrides the keys it contains.
+    """
+
+    with open(config_file, mode="rb") as cf:
+        config = tomli.load(cf)
+
+    if defaults is None:
+        return dict(config[section])
+
+    return dict(defaults, **config.get(section, {}))
+
+
+def load_database_config(config_file: str = CONFIG_FILE) -> (dict, dict):
+    """ Load up the database login details and the (optional) [pool] settings
+    """
+
+    database = load_config('database', config_file=config_file)
+
+    # database config
+    db_config = {'user': database['user'],
+                 'password': database['password'],
+                 'host': database['host'],
+                 'port': database['port'],
+                 'database': database['database']}
+
+    return db_config, load_config('pool', DEFAULT_POOL_CONFIG, config_file)
+
+
+def bulk_read(connection, query: str, params: tuple = None, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+              row_type: Callable = None) -> Iterator[list]:
+    """ Execute the given query on the connection and yield the result in chunks of at most 'chunk_rows' rows,
+        so that only a single chunk is alive at any one time.
+        If given, row_type is applied to each row (e.g. a namedtuple's _make).
+
+        A dedicated cursor is used, so the connection's other cursors remain free for inserts.
+    """
+
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute(query, params)
+
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield [row_type(row) for row in rows] if row_type else rows
+    finally:
+        cursor.close()
+
+
+def bulk_write(cursor, table: str, rows: Sequence[Sequence], page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """ Insert the given complete rows (every column, in table order) into the table in pages of 'page_size'.
+        The caller commits. Returns the number of rows written.
+    """
+
+    if not rows:
+        return 0
+
+    psycopg2.extras.execute_values(cursor, f'''INSERT INTO {table} VALUES %s''', rows, page_size=page_size)
+
+    return len(rows)
+
+
+def wait_for_wal(cursor, table: str, timeout: float = WAL_WAIT_SECONDS) -> None:
+    """ WAL writes are applied to the table asynchronously; wait until they all have been.
+        Returns straight away for a table that is not a WAL table.
+    """
+
+    deadline = time.time() + timeout
+
+    while True:
+        cursor.execute('''SELECT writerTxn, sequencerTxn FROM wal_tables() WHERE name = %s;''', (table,))
+        txns = cursor.fetchone()
+
+        if txns is None or txns[0] >= txns[1]:
+            return
+
+        if time.time() >= deadline:
+            raise RuntimeError(f"{table}: WAL still not applied after {timeout}s")
+
+        time.sleep(1)
+
+
+def get_table_storage(cursor, table: str) -> (bool, bool):
+    """ Whether the table is a WAL table, and whether it has DEDUP upsert keys; (False, False) if it does not exist
+    """
+
+    # read by column name; older servers have no dedup column
+    cursor.execute('''SELECT * FROM tables() WHERE name = %s;''', (table,))
+    row = cursor.fetchone()
+
+    if row is None:
+        return False, False
+
+    properties = dict(zip([column[0] for column in cursor.description], row))
+
+    return bool(properties.get('walEnabled')), bool(properties.get('dedup'))
+
+
+def _key_values(row: Sequence, positions) -> tuple:
+    """ The row's values at the positions, as a key; FLOAT columns are read back as 32 bit floats, so floats are
+        compared to 6 decimal places
+    """
+
+    return tuple(round(row[position], 6) if isinstance(row[position], float) else row[position] for position in positions)
+
+
+class DatabasePool:
+    """ Pool of QuestDB (PGWire) connections shared by the price, vol and migration jobs.
+
+        Connections are health checked as they are handed out; a dropped connection is discarded and
+        replaced with a fresh one. The pool is thread safe, so a prefetch thread or chained jobs
+        can take their own connection rather than reconnecting from scratch.
+
+        The bulk helpers check out a connection per call and retry once on a fresh connection
+        if the connection drops before any rows have been read, or before the write is committed.
+    """
+
+    def __init__(self, db_config: dict = None, pool_config: dict = None):
+
+        if db_config is None:
+            db_config, loaded_pool_config = load_database_config()
+            pool_config = pool_config or loaded_pool_config
+
+        self.db_config: dict = db_config
+        self.pool_config: dict = dict(DEFAULT_POOL_CONFIG, **(pool_config or {}))
+
+        self._pool = psycopg2.pool.ThreadedConnectionPool(self.pool_config['min_connections'],
+                                                          self.pool_config['max_connections'],
+                                                          **self.db_config)
+        self.info_logger(f"DATABASE POOL OPENED TO {self.db_config['host']}:{self.db_config['port']} "
+                         f"MAX CONNECTIONS {self.pool_config['max_connections']}")
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _is_healthy(self, connection) -> bool:
+
+        if connection.closed:
+            return False
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+                cursor.fetchone()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def get_connection(self):
+        """ Check out a healthy connection, replacing any that have dropped
+        """
+
+        attempts = self.pool_config['reconnect_attempts']
+
+        for attempt in range(1, attempts + 1):
+            try:
+                connection = self._pool.getconn()
+            except CONNECTION_ERRORS as e:
+                # the database itself is unreachable; wait and try again
+                self.info_logger(f"CONNECT FAILED ATTEMPT {attempt} OF {attempts}: {e}")
+                time.sleep(self.pool_config['reconnect_delay'] * attempt)
+                continue
+
+            if self._is_healthy(connection):
+                return connection
+
+            self.info_logger(f"DROPPED CONNECTION DISCARDED ATTEMPT {attempt} OF {attempts}")
+            self._pool.putconn(connection, close=True)
+
+        raise psycopg2.OperationalError(f"no healthy database connection after {attempts} attempts")
+
+    def put_connection(self, connection) -> None:
+        """ Return a connection to the pool; any uncommitted work is rolled back by the pool
+        """
+
+        self._pool.putconn(connection, close=bool(connection.closed))
+
+    def reconnect(self, connection):
+        """ Discard a dropped connection and check out a healthy replacement
+        """
+
+        self._pool.putconn(connection, close=True)
+
+        return self.get_connection()
+
+    def refresh(self, connection):
+        """ The connection if it is still healthy, otherwise a healthy replacement;
+            for connections held across idle periods (e.g. by the scheduler's long lived jobs)
+        """
+
+        return connection if self._is_healthy(connection) else self.reconnect(connection)
+
+    @contextmanager
+    def connection(self):
+        """ Check out a healthy connection for the duration of a with block
+        """
+
+        connection = self.get_connection()
+
+        try:
+            yield connection
+        finally:
+            self.put_connection(connection)
+
+    def bulk_read(self, query: str, params: tuple = None, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                  row_type: Callable = None) -> Iterator[list]:
+        """ Pooled version of bulk_read; the connection is held only while the result is being read
+        """
+
+        connection = self.get_connection()
+        started = False
+
+        try:
+            try:
+                for rows in bulk_read(connection, query, params, chunk_rows, row_type):
+                    started = True
+                    yield rows
+            except CONNECTION_ERRORS as e:
+                if started:
+                    raise
+
+                # nothing has been handed out yet, so the query can simply be run again
+                self.info_logger(f"CONNECTION DROPPED BEFORE READ; RETRYING: {e}")
+                connection, dropped = None, connection
+                connection = self.reconnect(dropped)
+                yield from bulk_read(connection, query, params, chunk_rows, row_type)
+        finally:
+            if connection is not None:
+                self.put_connection(connection)
+
+    def bulk_write(self, table: str, rows: Sequence[Sequence], page_size: int = DEFAULT_PAGE_SIZE) -> int:
+        """ Insert and commit the given complete rows (every column, in table order) into the table.
+            Returns the number of rows written.
+        """
+
+        if not rows:
+            return 0
+
+        connection = self.get_connection()
+
+        try:
+            try:
+                with connection.cursor() as cursor:
+                    rowcount = bulk_write(cursor, table, rows, page_size)
+                connection.commit()
+            except CONNECTION_ERRORS as e:
+                # nothing was committed, so the whole write can be run again
+                self.info_logger(f"CONNECTION DROPPED DURING WRITE; RETRYING: {e}")
+                connection, dropped = None, connection
+                connection = self.reconnect(dropped)
+                with connection.cursor() as cursor:
+                    rowcount = bulk_write(cursor, table, rows, page_size)
+                connection.commit()
+        finally:
+            if connection is not None:
+                self.put_connection(connection)
+
+        return rowcount
+
+    def replace_days(self, table: str, rows: Sequence[Sequence], keys: list, column: str = 'ExchangeDay') -> int:
+        """ Write and commit the given complete rows (every column, in table order) into a table partitioned by day
+            with DEDUP UPSERT KEYS on the keys, replacing what it held for the days of the rows.
+            Returns the number of rows written.
+
+            The rows are written first, so they replace the old rows with the same keys, and a failed write leaves
+            the days as they were. A day still holding keys the new rows do not have is then dropped and its rows
+            written again, as QuestDB has no DELETE. Days without rows are left alone.
+        """
+
+        rowcount = self.bulk_write(table, rows)
+
+        if not rowcount:
+            return 0
+
+        stale_rows = []
+
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'''SELECT * FROM {table} LIMIT 0;''')
+                columns = [description[0] for description in cursor.description]
+                cursor.fetchall()
+
+                positions = [columns.index(key) for key in keys]
+                day_position = columns.index(column)
+
+                day_rows = {}
+                for row in rows:
+                    day_rows.setdefault(row[day_position], []).append(row)
+
+                for day, new_rows in sorted(day_rows.items()):
+                    new_keys = {_key_values(row, positions) for row in new_rows}
+
+                    cursor.execute(f'''SELECT {', '.join(keys)} FROM {table} WHERE {column} = '{day:%Y-%m-%d}';''')
+
+                    if all(_key_values(row, range(len(keys))) in new_keys for row in cursor.fetchall()):
+                        continue
+
+                    cursor.execute(f'''ALTER TABLE {table} DROP PARTITION LIST '{day:%Y-%m-%d}';''')
+                    stale_rows.extend(new_rows)
+
+            connection.commit()
+
+        if stale_rows:
+            self.info_logger(f"{table}: {len(stale_rows)} ROWS WRITTEN AGAIN TO DROP KEYS THEIR DAYS NO LONGER HAVE")
+            self.bulk_write(table, stale_rows)
+
+        return rowcount
+
+    def close(self) -> None:
+
+        if not self._pool.closed:
+            self._pool.closeall()
+
+
+_database_pool = None
+_database_pool_lock = threading.Lock()
+
+
+def get_database_pool() -> DatabasePool:
+    """ The process wide pool, created from the [database] config on first use.
+        Jobs that run one after another in a process (price update then vol update) share it.
+    """
+
+    global _database_pool
+
+    with _database_pool_lock:
+        if _database_pool is None:
+            _database_pool = DatabasePool()
+            atexit.register(_database_pool.close)
+
+    return _database_pool
@@ -0,0 +1,117 @@
+import sys
+from datetime import datetime
+
+
+INSTRUMENTS_TABLE = 'INSTRUMENTS'
+
+
+class Instrument:
+    """ Compact, parsed form of a (ccxt style) deribit market symbol e.g.
+
+            BTC/USD:BTC                 perpetual
+            BTC/USD:BTC-240329          future
+            BTC/USD:BTC-240329-60000-C  option
+
+        'underlying' is the perpetual/curve name the instrument is priced against (e.g. BTC/USD:BTC),
+        'expiry' is the expiry date as a datetime (None for perpetuals) and 'option_type' is 'C' or 'P'.
+    """
+
+    __slots__ = ('symbol', 'underlying', 'kind', 'expiry', 'strike', 'option_type')
+
+    def __init__(self, symbol: str, underlying: str, kind: str, expiry: datetime = None, strike: float = None, option_type: str = None):
+        self.symbol = symbol
+        self.underlying = underlying
+        self.kind = kind
+        self.expiry = expiry
+        self.strike = strike
+        self.option_type = option_type
+
+    def __repr__(self):
+        return f"Instrument({self.symbol}, {self.kind}, {self.expiry}, {self.strike}, {self.option_type})"
+
+
+def parse_symbol(symbol: str) -> Instrument:
+    """ Parse a market symbol into an Instrument.
+        Anything that is not a perpetual, future or option is returned with kind 'other'.
+    """
+
+    split = symbol.split('-')
+    underlying = sys.intern(split[0])
+
+    try:
+        if len(split) == 4:
+            return Instrument(symbol, underlying, 'option',
+                              datetime.strptime(split[1], '%y%m%d'), float(split[2]), sys.intern(split[3]))
+
+        if ':' in symbol and len(split) == 2:
+            return Instrument(symbol, underlying, 'future', datetime.strptime(split[1], '%y%m%d'))
+
+    except ValueError:
+        return Instrument(symbol, underlying, 'other')
+
+    if ':' in symbol and len(split) == 1:
+        return Instrument(symbol, underlying, 'perpetual')
+
+    return Instrument(symbol, underlying, 'other')
+
+
+def check_instruments_table_exists(cursor) -> None:
+    """ IF Instruments table does not exist, then create it
+    """
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS '{INSTRUMENTS_TABLE}' (
+                        ts TIMESTAMP,
+                        Exchange STRING NOT NULL,
+                        MarketSymbol STRING NOT NULL,
+                        InstrumentName STRING NOT NULL,
+                        Underlying STRING NOT NULL,
+                        Kind STRING NOT NULL,
+                        OptionType STRING,
+                        Strike FLOAT,
+                        ExpiryTimestamp LONG,
+                        Expiry TIMESTAMP
+                ) timestamp(ts);''')
+
+
+class InstrumentCache:
+    """ In-memory map of market symbol to (interned) Instrument records.
+
+        The cache is seeded from the INSTRUMENTS reference table; any symbol not found there
+        (e.g. a still live instrument) is parsed once on first use and then held, so
+        symbol strings are never re-parsed in a hot loop.
+    """
+
+    def __init__(self):
+
+        self._instruments: dict = {}
+
+    def __len__(self):
+        return len(self._instruments)
+
+    def get(self, symbol: str) -> Instrument:
+        """ Return the Instrument for the given symbol, parsing and caching it if not already known
+        """
+
+        instrument = self._instruments.get(symbol)
+
+        if instrument is None:
+            symbol = sys.intern(symbol)
+            instrument = parse_symbol(symbol)
+            self._instruments[symbol] = instrument
+
+        return instrument
+
+    def load(self, cursor, exchange: str = 'deribit') -> int:
+        """ Seed the cache from the INSTRUMENTS reference table. Returns the number of instruments loaded.
+        """
+
+        cursor.execute(f'''SELECT MarketSymbol, Underlying, Kind, Expiry, Strike, OptionType
+                            FROM '{INSTRUMENTS_TABLE}'
+                            WHERE Exchange = %s;''', (exchange,))
+
+        for symbol, underlying, kind, expiry, strike, option_type in cursor.fetchall():
+            symbol = sys.intern(symbol)
+            self._instruments[symbol] = Instrument(symbol, sys.intern(underlying), sys.intern(kind), expiry, strike,
+                                                   sys.intern(option_type) if option_type else None)
+
+        return len(self._instruments)
@@ -1,8 +1,8 @@
-import tomli
 import requests
 from datetime import datetime
-import psycopg2
-from DeribitVolHistoryDBUpdate import DeribitVolHistoryDBUpdate
+from DatabaseGateway import DatabasePool, get_database_pool
+from DeribitInstruments import INSTRUMENTS_TABLE, check_instruments_table_exists
+from JobInstrumentation import instrumentation, timed, EXCHANGE_FETCH, JSON_PARSE, TRANSFORM, DB_READ, DB_WRITE, ROWS_FETCHED, ROWS_INSERTED, HTTP_CALLS
 import logging, time, sys, getopt
 import logging.handlers as handlers
 
@@ -33,59 +33,26 @@ class DeribitPriceHistoryDBGateway:
         The deribit Historic api only includes expired instruments; ie those expired prior to the date this script is run.
         """
 
-    def __init__(self):
+    def __init__(self, db_pool: DatabasePool = None):
 
         self.session = requests.Session()
         self.history_url = "https://history.deribit.com"
         self.live_url = "https://www.deribit.com"
         self.deribit_ohlcv = "OHLCV"
 
-        self.db_config: dict = self._load_config()
-        self.db_cursor = None
-        self.db_connection = None
-        self._connectDB(self.db_config)
-
-    def _connectDB(self, db_config):
-
-        try:
-            # Connect to DB
-            self.db_connection = psycopg2.connect(user=db_config['user'],
-                                             password=db_config['password'],
-                                             host=db_config['host'],
-                                             port=db_config['port'],
-                                             database=db_config['database']
-                                             )
-            print('Postgres connection is established.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            raise e
-
-        try:
-            # open connection for read/write
-            self.db_cursor = self.db_connection.cursor()
-            print('Postgres connection is opened.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            if self.db_connection:
-                self.db_connection.close()
-            print('Postgres connection is closed.')
-            raise e
-
-    def _load_config(self) -> dict:
-
-        db_config = {}
-
-        with open("DeribitPriceHistoryDBGateway.toml", mode="rb") as cf:
-            config = tomli.load(cf)
-
-            # database config
-            db_config['user'] = config['database']['user']
-            db_config['password'] = config['database']['password']
-            db_config['host'] = config['database']['host']
-            db_config['port'] = config['database']['port']
-            db_config['database'] = config['database']['database']
-
-        return db_config
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.db_connection = self.db_pool.get_connection()
+        self.db_cursor = self.db_connection.cursor()
+
+        check_instruments_table_exists(self.db_cursor)
+
+    def _release_connection(self) -> None:
+        """ Hand the connection back to the pool, for the next job in the run to pick up
+        """
+
+        self.db_cursor.close()
+        self.db_pool.put_connection(self.db_connection)
+        self.db_cursor, self.db_connection = None, None
 
     def _get_tokens(self) -> list:
 
@@ -134,7 +101,10 @@ class DeribitPriceHistoryDBGateway:
         if not (future or option):
             raise ValueError("ERROR UNKNOWN HISTORIC INSTRUMENT TYPE FOR", instrument_name)
 
-        symbol = base + '/' + quote + ':' + settle + '-' + expiry
+        underlying = base + '/' + quote + ':' + settle
+        symbol = underlying + '-' + expiry
+        strike = None
+        letter = None
 
         if option:
             strike = str(int(instrument['strike']))
@@ -145,8 +115,11 @@ class DeribitPriceHistoryDBGateway:
         result = {
             'symbol': symbol,
             'instrument_name': instrument_name,
+            'underlying': underlying,
             'expiry': expiry,
             'expiry_timestamp': expiry_timestamp,
+            'strike': float(strike) if strike else None,
+            'option_type': letter,
             'kind': kind,
             'get_history': True,
         }
@@ -158,11 +131,64 @@ class DeribitPriceHistoryDBGateway:
         action = "/api/v2/public/get_instruments"
         params = {'currency': currency, 'include_old': 'true', 'count': 10000, 'expired': 'true'}
 
-        response = self.session.get(self.history_url + action, params=params)
-        # for instrument in response.json()['result']:
+        with instrumentation.stage(EXCHANGE_FETCH):
+            response = self.session.get(self.history_url + action, params=params)
+        instrumentation.count('deribit', HTTP_CALLS)
+
+        with instrumentation.stage(JSON_PARSE):
+            instruments = response.json()['result']
+        # for instrument in instruments:
         #     if 'option' not in instrument['kind']:
         #         print("RAW INSTRUMENTS", instrument['kind'], instrument['instrument_name'])
-        return [self._get_ccxt_historic_market(instrument) for instrument in response.json()['result']]
+        with instrumentation.stage(TRANSFORM, count=len(instruments)):
+            markets = [self._get_ccxt_historic_market(instrument) for instrument in instruments]
+
+        self._push_instruments_to_db(markets)
+
+        return markets
+
+    @timed(DB_READ)
+    def _get_known_instruments(self) -> set:
+
+        self.db_cursor.execute(f'''SELECT MarketSymbol
+                                FROM '{INSTRUMENTS_TABLE}'
+                                WHERE Exchange = 'deribit';
+                                ''')
+
+        return {row[0] for row in self.db_cursor.fetchall()}
+
+    def _push_instruments_to_db(self, markets: list) -> int:
+        """ Add any futures/options not already in the INSTRUMENTS reference table,
+            so the vol job can look up underlying, expiry, strike and type without parsing symbols.
+        """
+
+        known_instruments = self._get_known_instruments()
+
+        rowcount = 0
+        now = datetime.utcnow()
+
+        with instrumentation.stage(DB_WRITE) as stage:
+            for market in markets:
+                if not market['get_history'] or market['symbol'] in known_instruments:
+                    continue
+
+                self.db_cursor.execute(f'''
+                        INSERT INTO '{INSTRUMENTS_TABLE}'
+                        VALUES(%s, %s, %s, %s,
+                                %s, %s, %s, %s,
+                                %s, %s);
+                        ''',
+                               (now, 'deribit', market['symbol'], market['instrument_name'],
+                                market['underlying'], market['kind'], market['option_type'], market['strike'],
+                                market['expiry_timestamp'], datetime.strptime(market['expiry'], '%y%m%d')))
+                known_instruments.add(market['symbol'])
+                rowcount += 1
+
+            self.db_connection.commit()
+            stage.count = rowcount
+        self.info_logger(f"INSTRUMENTS ADDED {rowcount}")
+
+        return rowcount
 
     def _get_ohlcv_day_data(self, market: dict) -> dict:
 
@@ -188,22 +214,29 @@ class DeribitPriceHistoryDBGateway:
                   'end_timestamp': expiry_timestamp,
                   'resolution': '1D'
                   }
-        response = self.session.get(self.history_url + action, params=params)
+        with instrumentation.stage(EXCHANGE_FETCH):
+            response = self.session.get(self.history_url + action, params=params)
+        instrumentation.count('deribit', HTTP_CALLS)
 
         # print("RESPONSE", market['instrument_name'], response.json())
 
         if response.status_code != 200:
             print(response)
             raise RuntimeError(response)
+
+        # parse the body just the once
+        with instrumentation.stage(JSON_PARSE):
+            response_json = response.json()
+
         # response = session.get(url + action + '?currency=BTC&include_old=true&count=10000&kind=option&expired=true')
-        if 'result' not in response.json():
+        if 'result' not in response_json:
             print("ERR", response)
             return {}
 
-        if response.json()['result']['status'] != 'ok':
+        if response_json['result']['status'] != 'ok':
             return {}
 
-        return response.json()['result']
+        return response_json['result']
 
     # def _get_tick_implied_vols(self, option_name, tick, price_data):
     #     # print("GET IMPLIED VOLS", option_name, tick, price_data)
@@ -245,6 +278,7 @@ class DeribitPriceHistoryDBGateway:
 
         return result
 
+    @timed(TRANSFORM)
     def _transform_to_date(self, ohlcv_history):
 
         result = {}
@@ -268,7 +302,7 @@ class DeribitPriceHistoryDBGateway:
 
         for future in historic_instruments['futures']:
             # print("FUTURE", future)
-            if future['symbol'].split('-')[1].startswith(period):
+            if future['expiry'] and future['expiry'].startswith(period):
                 # print("FUTURE HISTORY", future['symbol'])
                 time.sleep(0.02)
 
@@ -279,7 +313,7 @@ class DeribitPriceHistoryDBGateway:
 
         for option in historic_instruments['options']:
 
-            if option['symbol'].split('-')[1].startswith(period):
+            if option['expiry'] and option['expiry'].startswith(period):
                 # print("OPTION HISTORY", option['symbol'])
                 time.sleep(0.02)
                 option_history = self._get_ohlcv_day_data(option)
@@ -299,20 +333,24 @@ class DeribitPriceHistoryDBGateway:
                 'cost': tick['cost'],
                 }
 
+    @timed(DB_READ)
     def _get_last_price_update(self, symbol):
 
-        self.db_cursor.execute(f'''SELECT max(ExchangeTimestamp)
+        # the latest row for the symbol is found through the MarketSymbol index, newest partition first
+        self.db_cursor.execute(f'''SELECT ExchangeTimestamp
                                 FROM '{self.deribit_ohlcv}'
-                                WHERE MarketSymbol = '{symbol}'
-                                AND Exchange = 'deribit';
-                                ''')
+                                WHERE MarketSymbol = %s
+                                AND Exchange = 'deribit'
+                                LATEST ON ExchangeDate PARTITION BY MarketSymbol;
+                                ''', (symbol,))
         last_update_time_ms = self.db_cursor.fetchone()
 
-        if not last_update_time_ms[0]:
+        if not last_update_time_ms or not last_update_time_ms[0]:
             return 0
 
         return last_update_time_ms[0]
 
+    @timed(TRANSFORM)
     def _convert_prices_to_data_table(self, historic_prices) -> list:
 
         # print("FUTURES", historic_prices['futures'].keys())
@@ -343,30 +381,41 @@ class DeribitPriceHistoryDBGateway:
 
         return result_table
 
-    def _push_historic_prices_to_db(self, historic_prices):
+    def _push_historic_prices_to_db(self, historic_prices, written_keys: set = None) -> int:
+        """ Insert any prices newer than the last update for each symbol.
+            If given, the (exchange, symbol, 'YYYY-MM-DD') key of every row written is added to written_keys.
+        """
 
         historic_prices_data_table = self._convert_prices_to_data_table(historic_prices)
 
+        # watermark per symbol, looked up once; a symbol's ticks are in time order
+        last_updates = {}
+
         rowcount = 0
         for i, ohlcv_row in enumerate(historic_prices_data_table):
-            last_update = self._get_last_price_update(ohlcv_row['symbol'])
+            last_update = last_updates.get(ohlcv_row['symbol'])
+            if last_update is None:
+                last_update = last_updates[ohlcv_row['symbol']] = self._get_last_price_update(ohlcv_row['symbol'])
             # print(ohlcv_row['symbol'], ohlcv_row['timestamp'], last_update)
             if ohlcv_row['timestamp'] > last_update:
                 now = datetime.utcnow()
                 exchange_date = datetime.fromtimestamp(ohlcv_row['timestamp'] / 1000)
                 exchange_day = exchange_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                self.db_cursor.execute(f'''
-                        INSERT INTO {self.deribit_ohlcv}
-                        VALUES(%s, %s, %s, 
-                                %s, %s, %s,
-                                %s, %s, %s, %s, 
-                                %s);
-                        ''',
-                               (now, 'deribit', ohlcv_row['symbol'],
-                                exchange_day, ohlcv_row['exchange_date'], ohlcv_row['timestamp'],
-                                ohlcv_row['open'], ohlcv_row['high'], ohlcv_row['low'], ohlcv_row['close'],
-                                ohlcv_row['volume']))
+                with instrumentation.stage(DB_WRITE):
+                    self.db_cursor.execute(f'''
+                            INSERT INTO {self.deribit_ohlcv}
+                            VALUES(%s, %s, %s, 
+                                    %s, %s, %s,
+                                    %s, %s, %s, %s, 
+                                    %s);
+                            ''',
+                                   (now, 'deribit', ohlcv_row['symbol'],
+                                    exchange_day, ohlcv_row['exchange_date'], ohlcv_row['timestamp'],
+                                    ohlcv_row['open'], ohlcv_row['high'], ohlcv_row['low'], ohlcv_row['close'],
+                                    ohlcv_row['volume']))
                 rowcount += 1
+                if written_keys is not None:
+                    written_keys.add(('deribit', ohlcv_row['symbol'], exchange_day.strftime('%Y-%m-%d')))
 
             if (i + 1) % 1000 == 0:
                 self.db_connection.commit()
@@ -374,6 +423,10 @@ class DeribitPriceHistoryDBGateway:
 
         self.db_connection.commit()
         self.info_logger(f"COMMITTING PRICES {rowcount} out of {len(historic_prices_data_table)}")
+
+        instrumentation.count('deribit', ROWS_FETCHED, len(historic_prices_data_table))
+        instrumentation.count('deribit', ROWS_INSERTED, rowcount)
+
         return rowcount
 
     def info_logger(self, message):
@@ -381,7 +434,12 @@ class DeribitPriceHistoryDBGateway:
         logger.info(message)
         print("LOG", message)
 
-    def _process_historic_ohlcv(self, run_year=None, run_month=None):
+    def _process_historic_ohlcv(self, run_year=None, run_month=None, written_keys: set = None) -> set:
+        """ Insert missing historic prices for the given year/month (or all of them).
+            Returns the set of (exchange, symbol, 'YYYY-MM-DD') keys that were written.
+
+            :param written_keys: the caller's set to add the keys to as they are written, so it keeps them on a failure
+        """
 
         years = [2017, 2018, 2019, 2020, 2021, 2022, 2023, 2024]
         months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
@@ -399,6 +457,9 @@ class DeribitPriceHistoryDBGateway:
         historic_instruments = self._get_option_and_future_instruments()
         # print("HISTORIC INSTRUMENTS", historic_instruments)
 
+        if written_keys is None:
+            written_keys = set()
+
         # loop per year/month
         for year in years:
             for month in months:
@@ -406,14 +467,14 @@ class DeribitPriceHistoryDBGateway:
                 self.info_logger(f"PROCESSING PERIOD YYMM {period}")
                 historic_prices = self._get_option_and_future_prices(historic_instruments, period)
                 self.info_logger(f"PROCESSING PRICES futures count: {len(historic_prices['futures'])} options count: {len(historic_prices['options'])}")
-                self._push_historic_prices_to_db(historic_prices)
-        return
+                self._push_historic_prices_to_db(historic_prices, written_keys)
+        return written_keys
 
     def check_ohlcv_price_table_exists(self):
         self.db_cursor.execute(f'''CREATE TABLE IF NOT EXISTS {self.deribit_ohlcv} (
                             ts TIMESTAMP,
-                            Exchange  STRING NOT NULL,
-                            MarketSymbol  STRING NOT NULL,
+                            Exchange  SYMBOL CAPACITY 256 CACHE INDEX,
+                            MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
                             ExchangeDay TIMESTAMP NOT NULL,
                             ExchangeDate TIMESTAMP NOT NULL,
                             ExchangeTimestamp LONG NOT NULL,
@@ -422,21 +483,25 @@ class DeribitPriceHistoryDBGateway:
                             Low   FLOAT,
                             Close FLOAT,
                             Volume  FLOAT
-                    ) timestamp(ts);''')
+                    ) timestamp(ExchangeDate) PARTITION BY MONTH;''')
 
 
 def get_args(argv):
 
-    opts, args = getopt.getopt(argv,"-hy:m:", ["year=", "month="])
+    opts, args = getopt.getopt(argv,"-hy:m:p", ["year=", "month=", "profile"])
 
     year = None
     month = None
+    profile = False
 
     for opt, arg in opts:
         if opt == '-h':
-            print ('python3 -m DeribitPriceHistoryDBGateway -h -y <2023> -m <6>')
+            print ('python3 -m DeribitPriceHistoryDBGateway -h -y <2023> -m <6> -p (--profile)')
             sys.exit()
 
+        if opt in ("-p", "--profile"):
+            profile = True
+
         if opt in ("-y", "--year"):
             try:
                 year = int(arg)
@@ -455,15 +520,22 @@ def get_args(argv):
         print(f'error; month can only be provided if year is also provided')
         sys.exit()
 
-    return year, month
+    return year, month, profile
 
 
 if __name__ == "__main__":
 
-    year, month = get_args(sys.argv[1:])
+    year, month, profile = get_args(sys.argv[1:])
+
+    instrumentation.start_run('DeribitPriceHistoryDBGateway', profile)
 
     # Insert any Missing / Expired prices
-    DeribitPriceHistoryDBGateway()._process_historic_ohlcv(year, month)
+    deribit_price_history = DeribitPriceHistoryDBGateway()
+    written_keys = deribit_price_history._process_historic_ohlcv(year, month)
+    deribit_price_history._release_connection()
+
+    # Update Vol History for just the new price data, reusing the pooled connection;
+    # the vol job (and QuantLib) is only loaded once the prices are in
+    from DeribitVolHistoryDBUpdate import DeribitVolHistoryDBUpdate
+    DeribitVolHistoryDBUpdate()._update_vol_data_for_keys(written_keys)
 
-    # Update Vol History for any new price data
-    DeribitVolHistoryDBUpdate()._update_historic_vol_data(year, month)
@@ -0,0 +1,461 @@
+import asyncio
+import json
+import logging, sys, getopt, time
+import logging.handlers as handlers
+from datetime import datetime
+import aiohttp
+from CryptoPriceDBGateway import filter_swap_market_symbols, get_ccxt
+from DatabaseGateway import DatabasePool, get_database_pool, load_config
+
+
+logger = logging.getLogger('DERIBIT STREAM')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('deribit_stream.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+DERIBIT_WS_URL = 'wss://www.deribit.com/ws/api/v2'
+
+OHLCV_1M_TABLE = 'OHLCV_1M'
+OHLCV_1D_TABLE = 'OHLCV_1D'
+
+MINUTE_MS = 60 * 1000
+DAY_MS = 24 * 60 * MINUTE_MS
+
+# closed bars of each timeframe are written to; the daily bars are of marks, so are kept apart from the REST job's candles in OHLCV
+TIMEFRAME_TABLES = {MINUTE_MS: OHLCV_1M_TABLE, DAY_MS: OHLCV_1D_TABLE}
+
+DEFAULT_STREAM_CONFIG = {'url': DERIBIT_WS_URL, 'currencies': ['BTC', 'ETH'], 'flush_seconds': 5.0,
+                         'heartbeat_seconds': 30, 'reconnect_delay': 5.0}
+
+
+def check_ohlcv_1m_table_exists(cursor) -> None:
+    """ IF the one minute bar table does not exist, then create it; laid out as OHLCV, partitioned by day
+    """
+
+    _check_bar_table_exists(cursor, OHLCV_1M_TABLE, 'DAY')
+
+
+def check_ohlcv_1d_table_exists(cursor) -> None:
+    """ IF the streamed daily bar table does not exist, then create it; laid out as OHLCV, partitioned by month
+    """
+
+    _check_bar_table_exists(cursor, OHLCV_1D_TABLE, 'MONTH')
+
+
+def _check_bar_table_exists(cursor, table: str, partition_by: str) -> None:
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS '{table}' (
+                        ts TIMESTAMP,
+                        Exchange  SYMBOL CAPACITY 256 CACHE INDEX,
+                        MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
+                        ExchangeDay TIMESTAMP NOT NULL,
+                        ExchangeDate TIMESTAMP NOT NULL,
+                        ExchangeTimestamp LONG NOT NULL,
+                        Open  FLOAT,
+                        High  FLOAT,
+                        Low   FLOAT,
+                        Close FLOAT,
+                        Volume  FLOAT
+                ) timestamp(ExchangeDate) PARTITION BY {partition_by} WAL
+                DEDUP UPSERT KEYS(ExchangeDate, Exchange, MarketSymbol, ExchangeTimestamp);''')
+
+
+class Bar:
+    """ A single bar being built; start is the bar's open time in ms
+    """
+
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, start: int, price: float):
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = 0.0
+
+
+class BarAggregator:
+    """ Builds bars of a single timeframe (in ms) for every instrument from mark price and trade updates.
+
+        Prices are the mark; every instrument has one on every update, so even illiquid options get a bar for
+        each period they are quoted in. Volume is the traded amount. The clock is the latest exchange timestamp
+        seen, so a replayed stream closes bars exactly as the live one did. Updates arriving late, for a period
+        whose bar has already closed, are dropped, and so are the bars of the period the first update arrived in,
+        which the aggregator only saw part of.
+    """
+
+    def __init__(self, timeframe: int):
+
+        self.timeframe = timeframe
+        self.bars: dict = {}
+        self.closed: list = []
+        self.clock: int = 0
+        # start of each symbol's last closed bar
+        self.closed_starts: dict = {}
+        # time of the first update; bars starting before it are partial
+        self.started: int = None
+        self.partial_bars = 0
+
+    def on_price(self, symbol: str, timestamp: int, price: float) -> None:
+
+        start = timestamp - timestamp % self.timeframe
+        bar = self.bars.get(symbol)
+
+        # a late update for a bar already closed; whether rolled over (still held) or taken by close_bars
+        if bar is not None and start < bar.start or start <= self.closed_starts.get(symbol, -1):
+            return
+
+        if bar is None or bar.start != start:
+            if bar is not None:
+                self._close(symbol, bar)
+            self.bars[symbol] = Bar(start, price)
+        else:
+            if price > bar.high:
+                bar.high = price
+            elif price < bar.low:
+                bar.low = price
+            bar.close = price
+
+        if timestamp > self.clock:
+            self.clock = timestamp
+
+        if self.started is None:
+            self.started = timestamp
+
+    def on_trade(self, symbol: str, timestamp: int, price: float, amount: float) -> None:
+
+        self.on_price(symbol, timestamp, price)
+
+        bar = self.bars.get(symbol)
+        # not a late trade, which on_price dropped
+        if bar is not None and bar.start == timestamp - timestamp % self.timeframe:
+            bar.volume += amount
+
+    def _close(self, symbol: str, bar: Bar) -> None:
+
+        self.closed.append((symbol, bar))
+        self.closed_starts[symbol] = bar.start
+
+    def close_bars(self) -> list:
+        """ Take every bar closed so far; those rolled over by a later update, and those whose period the clock has passed
+        """
+
+        current = self.clock - self.clock % self.timeframe
+
+        for symbol, bar in list(self.bars.items()):
+            if bar.start < current:
+                self._close(symbol, self.bars.pop(symbol))
+
+        closed = [(symbol, bar) for symbol, bar in self.closed if bar.start >= self.started]
+        self.partial_bars += len(self.closed) - len(closed)
+        self.closed = []
+
+        return closed
+
+
+class DeribitStreamIngester:
+    """ Streams Deribit's public WebSocket api for the configured currencies (BTC and ETH by default) and
+        aggregates the updates into one minute and one day OHLCV bars in memory.
+
+        Subscribes to
+            markprice.options.<currency>_usd        the mark of every option, in a single message per update
+            ticker.<instrument>.100ms               each perpetual and future
+            trades.<kind>.<currency>.100ms          every option and future trade, for the volumes
+        Closed bars are flushed every 'flush_seconds' through the bulk writer; one minute bars to OHLCV_1M and
+        daily bars to OHLCV_1D. The daily bars are of marks, not trades, so they are kept apart from the REST job's
+        candles in OHLCV. Bars the ingester did not see from their start (those open when it started), and bars
+        still open when it stops, are dropped.
+
+        :param db_pool: where the bars are written
+        :param markets: Deribit instrument name to ccxt symbol; loaded through ccxt if not given
+        :param url: the WebSocket api; a local stand in when testing (see benchmarks/MockDeribitStream.py)
+        :param record_file: if given, every message received is appended to it, one per line, for replaying later
+
+        Listeners (add_listener) see every mark as it arrives, and have their own rows written with the bars.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None, markets: dict = None, url: str = None, record_file: str = None):
+
+        self.exchange_id = 'deribit'
+
+        self.stream_config: dict = load_config('stream', DEFAULT_STREAM_CONFIG)
+        self.url = url or self.stream_config['url']
+        self.currencies: list = self.stream_config['currencies']
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.markets: dict = markets if markets is not None else self._load_markets()
+
+        self.aggregators = {timeframe: BarAggregator(timeframe) for timeframe in TIMEFRAME_TABLES}
+        self.record_file = record_file
+
+        self.listeners: list = []
+
+        self.messages = 0
+        self.updates = 0
+        self.rows_written = 0
+        self._request_id = 0
+
+        with self.db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                check_ohlcv_1m_table_exists(cursor)
+                check_ohlcv_1d_table_exists(cursor)
+            connection.commit()
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def add_listener(self, listener) -> None:
+        """ Pass every streamed mark to listener.on_price(symbol, timestamp, price), on the streaming thread.
+            At each flush, the {table: rows} returned by listener.closed_rows() are written along with the bars.
+        """
+
+        self.listeners.append(listener)
+
+    def _load_markets(self) -> dict:
+        """ Deribit instrument name to ccxt symbol, for the live instruments of the configured currencies
+        """
+
+        markets = get_ccxt().deribit().load_markets()
+
+        return {markets[symbol]['id']: symbol for symbol in filter_swap_market_symbols(markets)
+                if markets[symbol]['base'] in self.currencies}
+
+    def _channels(self) -> list:
+
+        channels = []
+
+        for currency in self.currencies:
+            channels.append(f"markprice.options.{currency.lower()}_usd")
+            channels.append(f"trades.option.{currency}.100ms")
+            channels.append(f"trades.future.{currency}.100ms")
+
+        # perpetuals and futures; every other (listed) instrument name is an option
+        channels += [f"ticker.{name}.100ms" for name in self.markets if name.count('-') < 3]
+
+        return channels
+
+    def _request(self, method: str, params: dict) -> str:
+
+        self._request_id += 1
+
+        return json.dumps({'jsonrpc': '2.0', 'id': self._request_id, 'method': method, 'params': params})
+
+    def _on_message(self, message: str) -> str:
+        """ Apply a single WebSocket message to the bars. Returns the reply to send, if any
+        """
+
+        self.messages += 1
+        payload = json.loads(message)
+
+        if payload.get('method') == 'heartbeat':
+            if payload['params']['type'] == 'test_request':
+                return self._request('public/test', {})
+            return None
+
+        if payload.get('method') != 'subscription':
+            if 'error' in payload:
+                self.info_logger(f"ERROR FROM DERIBIT: {payload['error']}")
+            return None
+
+        channel = payload['params']['channel']
+        data = payload['params']['data']
+
+        if channel.startswith('markprice.'):
+            for mark in data:
+                self._on_price(mark['instrument_name'], mark['timestamp'], mark['mark_price'])
+        elif channel.startswith('ticker.'):
+            self._on_price(data['instrument_name'], data['timestamp'], data['mark_price'])
+        elif channel.startswith('trades.'):
+            for trade in data:
+                self._on_trade(trade['instrument_name'], trade['timestamp'], trade['price'], trade['amount'])
+
+        return None
+
+    def _on_price(self, name: str, timestamp: int, price: float) -> None:
+
+        symbol = self.markets.get(name)
+
+        if symbol is None or price is None:
+            return
+
+        self.updates += 1
+
+        for aggregator in self.aggregators.values():
+            aggregator.on_price(symbol, timestamp, price)
+
+        for listener in self.listeners:
+            listener.on_price(symbol, timestamp, price)
+
+    def _on_trade(self, name: str, timestamp: int, price: float, amount: float) -> None:
+
+        symbol = self.markets.get(name)
+
+        if symbol is None:
+            return
+
+        self.updates += 1
+
+        # option amounts are in the currency; future amounts are in USD, so are converted to the currency
+        if name.count('-') < 3:
+            amount = amount / price
+
+        for aggregator in self.aggregators.values():
+            aggregator.on_trade(symbol, timestamp, price, amount)
+
+    def _bar_rows(self, closed: list) -> list:
+        """ OHLCV rows for the closed bars, with the dates derived as update_ohlcv_table derives them
+        """
+
+        now = datetime.utcnow()
+        rows = []
+
+        for symbol, bar in closed:
+            exchange_date = datetime.fromtimestamp(bar.start / 1000)
+            exchange_day = exchange_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            rows.append((now, self.exchange_id, symbol, exchange_day, exchange_date, bar.start,
+                         bar.open, bar.high, bar.low, bar.close, bar.volume))
+
+        return rows
+
+    def _write_bars(self, table_rows: dict) -> int:
+
+        rowcount = 0
+
+        for table, rows in table_rows.items():
+            rowcount += self.db_pool.bulk_write(table, rows)
+
+        return rowcount
+
+    async def _flush(self) -> None:
+        """ Write the bars closed since the last flush (and the listeners' rows), off the event loop so updates keep being read meanwhile
+        """
+
+        table_rows = {TIMEFRAME_TABLES[timeframe]: self._bar_rows(aggregator.close_bars())
+                      for timeframe, aggregator in self.aggregators.items()}
+
+        for listener in self.listeners:
+            table_rows.update(listener.closed_rows())
+
+        if any(table_rows.values()):
+            self.rows_written += await asyncio.get_running_loop().run_in_executor(None, self._write_bars, table_rows)
+
+    async def _flush_periodically(self) -> None:
+
+        while True:
+            await asyncio.sleep(self.stream_config['flush_seconds'])
+            await self._flush()
+
+    async def _stream(self, session: aiohttp.ClientSession, record) -> None:
+
+        async with session.ws_connect(self.url, heartbeat=None, max_msg_size=0) as ws:
+
+            await ws.send_str(self._request('public/set_heartbeat', {'interval': self.stream_config['heartbeat_seconds']}))
+            await ws.send_str(self._request('public/subscribe', {'channels': self._channels()}))
+
+            self.info_logger(f"SUBSCRIBED TO {len(self._channels())} CHANNELS FOR {len(self.markets)} INSTRUMENTS AT {self.url}")
+
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+
+                if record:
+                    record.write(message.data + '\n')
+
+                reply = self._on_message(message.data)
+
+                if reply:
+                    await ws.send_str(reply)
+
+    async def run(self, duration: float = None, reconnect: bool = True) -> None:
+        """ Stream until stopped (or for 'duration' seconds), reconnecting whenever the connection drops.
+            With reconnect False, stops when the server closes the connection (e.g. a replay has finished).
+        """
+
+        started = time.time()
+        record = open(self.record_file, 'a') if self.record_file else None
+        flusher = asyncio.create_task(self._flush_periodically())
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                while True:
+                    try:
+                        await asyncio.wait_for(self._stream(session, record),
+                                               None if duration is None else max(0.0, duration - (time.time() - started)))
+                    except asyncio.TimeoutError:
+                        break
+                    except aiohttp.ClientError as e:
+                        self.info_logger(f"CONNECTION ERROR: {e}")
+
+                    if not reconnect or (duration is not None and time.time() - started >= duration):
+                        break
+
+                    self.info_logger(f"DISCONNECTED; RECONNECTING IN {self.stream_config['reconnect_delay']}s")
+                    await asyncio.sleep(self.stream_config['reconnect_delay'])
+        finally:
+            flusher.cancel()
+            await self._flush()
+
+            if record:
+                record.close()
+
+        open_bars = sum(len(aggregator.bars) for aggregator in self.aggregators.values())
+        partial_bars = sum(aggregator.partial_bars for aggregator in self.aggregators.values())
+        self.info_logger(f"STOPPED AFTER {time.time() - started:.0f}s; {self.messages} MESSAGES, {self.updates} UPDATES, "
+                         f"{self.rows_written} ROWS WRITTEN, {partial_bars} PARTIAL AND {open_bars} OPEN BARS DROPPED")
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv, "-hd:r:u:v", ["duration=", "record=", "url=", "vols"])
+
+    duration = None
+    record_file = None
+    url = None
+    vols = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('python3 -m DeribitStreamIngester -h -d <duration seconds> -r <record file> -u <websocket url> -v')
+            sys.exit()
+
+        if opt in ("-d", "--duration"):
+            try:
+                duration = float(arg)
+            except Exception as e:
+                print(f'error {e}; duration must be a number of seconds <3600>')
+                sys.exit()
+
+        if opt in ("-r", "--record"):
+            record_file = arg
+
+        if opt in ("-u", "--url"):
+            url = arg
+
+        if opt in ("-v", "--vols"):
+            vols = True
+
+    return duration, record_file, url, vols
+
+
+if __name__ == "__main__":
+
+    duration, record_file, url, vols = get_args(sys.argv[1:])
+
+    ingester = DeribitStreamIngester(url=url, record_file=record_file)
+
+    if vols:
+        # solve the option vols as the marks arrive, into VOL_INTRADAY
+        from StreamingVolEngine import StreamingVolEngine
+        ingester.add_listener(StreamingVolEngine(ingester.db_pool))
+
+    try:
+        asyncio.run(ingester.run(duration))
+    except KeyboardInterrupt:
+        pass
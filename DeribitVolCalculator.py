@@ -0,0 +1,455 @@
+from datetime import datetime, timedelta
+import numpy as np
+from DeribitInstruments import InstrumentCache
+from JobInstrumentation import instrumentation, IV_SOLVE
+
+
+# pre-solve rejection reasons; index is the reason code, 0 meaning the option is viable
+PREFILTER_REASONS = ['viable', 'zero_price', 'no_forward', 'below_intrinsic', 'above_forward', 'above_strike']
+# vol data is [open vol, strike, delta, close vol, strike, delta, term] followed by the open/close greeks
+VOL_DATA_TERM_END = 7
+
+# imported on first use (see get_quantlib); QuantLib takes a fifth of a second to import, and only the vol solve
+# needs it; the curve helpers (used by the option chain and streaming vols) do not
+ql = None
+
+
+def get_quantlib():
+    """ The QuantLib module, imported the first time it is needed
+    """
+
+    global ql
+
+    if ql is None:
+        import QuantLib as quantlib_module
+        ql = quantlib_module
+
+    return ql
+
+
+class DeribitVolCalculator:
+    """ The implied vol calculations for Deribit options, independent of any database connection,
+        so they can be run in worker processes (and benchmarked) as well as by DeribitVolHistoryDBUpdate.
+
+        Works on OHLCV price records (ts, exchange, symbol, day, date, timestamp, open, high, low, close, volume)
+        and futures 'curves' of those records keyed by (exchange, underlying, day) then term.
+
+        :param risk_free_rate: rate (%) used in the Black pricing of the options
+        :param delta_precision: deltas within this of 0, -1 or 1 are rounded to that value
+    """
+
+    def __init__(self, risk_free_rate: float = 0.0, delta_precision: float = 0.001, instruments: InstrumentCache = None):
+
+        self.risk_free_rate = risk_free_rate
+        self.delta_precision = delta_precision
+
+        self.instruments = instruments if instruments is not None else InstrumentCache()
+        self._expiry_dates: dict = {}
+
+    def _ensure_datetime(self, given_date) -> datetime:
+        """ Ensures given date is a python datetime object.
+            Converts type string to datetime if required.
+        """
+        if type(given_date) is str:
+            date_calc = self._expiry_dates.get(given_date)
+            if date_calc is None:
+                date_calc = self._expiry_dates[given_date] = datetime.strptime(given_date, '%y%m%d')
+        else:
+            date_calc = given_date
+
+        return date_calc
+
+    def _calculate_term(self, exchange_date, expiry) -> int:
+        """ Days from exchange date to given expiry date
+        """
+
+        date_calc = self._ensure_datetime(exchange_date)
+        date_exp = self._ensure_datetime(expiry)
+
+        delta = date_exp - date_calc
+        return delta.days
+
+    def _delta_as_float(self, x) -> float:
+        """ Ensure delta figure is presented as a float for DB insert
+        """
+
+        precision = self.delta_precision
+
+        if x < precision and x > -precision:
+            return 0
+
+        if x < -1 + precision:
+            return -1
+
+        if x > 1 - precision:
+            return 1
+
+        return x
+
+    def _convert_prices_to_curves(self, future_prices) -> dict:
+        """ Converts all the available perpetual and futures prices into curves.
+            Each curve is for a given token and exchange date and consists
+            of a set of future prices indexed by 'term' ie time to expiry.
+
+            Filters are also applied to restrict the curves to only those useful
+            as underlyings for options.
+
+        """
+
+        # print("CONVERTING FUTURE PRICES TO CURVES...")
+
+        curves = {}
+
+        for future in future_prices:
+
+            # skip if not deribit
+            if future[1] != 'deribit':
+                continue
+
+            # skip non BTC/ETH future price data
+            if future[2][:3] not in ['BTC', 'ETH']:
+                continue
+
+            # perpetuals have no expiry, so are given a term of zero
+            expiry = self.instruments.get(future[2]).expiry or future[3]
+
+            key = self._future_key_from_record(future)
+
+            if key not in curves:
+                curves[key] = {}
+
+            term = self._calculate_term(future[3], expiry)
+
+            if term not in curves[key]:
+                curves[key][term] = future
+
+        return curves
+
+    def _option_key_from_record(self, record) -> tuple:
+        """ return a standard unique 'key' from the given record data
+        """
+
+        # key is exchange + symbol + COB Date
+        return (record[1], record[2], str(record[3].strftime('%Y-%m-%d')))
+
+    def _future_key_from_record(self, record) -> tuple:
+        """ Calculate a unique future key as just the perpetual name or future name
+            or, if an option, the underlying future name
+        """
+        token = self.instruments.get(record[2]).underlying
+
+        # key is exchange + symbol (without strike/option_type, if present) + COB Date
+        return (record[1], token, record[3].strftime('%Y-%m-%d'))
+
+    def _underlying_price(self, oh_flag, future_curve, term) -> float:
+        """ Interpolate the future open/close prices
+            for the given future curve and term
+        """
+
+        future_terms = list(sorted(future_curve.keys()))
+
+        if oh_flag == 'open':
+            oh_price = 6
+        else:
+            oh_price = 9
+
+        if term in future_terms:
+            return future_curve[term][oh_price]
+
+        before_term = None
+        after_term = None
+
+        for future_term in future_terms:
+            if future_term < term:
+                before_term = future_term
+            if future_term > term:
+                after_term = future_term
+                break
+
+        if before_term is None:
+            # return data of first future price
+            # print(f"***** BEFORE; THIS IS VERY ODD!!! OPTION TERM {term} COMES BEFORE FIRST FUTURE {future_terms[0]}")
+            # print("INPUTS", oh_flag, future_curve, term)
+            term = future_terms[0]
+            return future_curve[term][oh_price]
+
+        if after_term is None:
+            # print(f"***** AFTER FINAL FUTURE - EXTRAPOLATING {term}")
+            # return data of final future price
+            term = future_terms[-1]
+            return future_curve[term][oh_price]
+
+        # print("LOOKING FOR", term, "BETWEEN", before_term, after_term)
+        factor = (term - before_term) / (after_term - before_term)
+
+        return future_curve[before_term][oh_price] * (1 - factor) + future_curve[after_term][oh_price] * factor
+
+    def _calc_implied_vol_strike_and_delta(self, oh_flag, option_price, future_curve, calculation_date, expiry_date, term, risk_free_rate=None) -> list:
+        """ Given the optionand future price data, calculate the associated
+            implied vol, strike_pct and delta using either the open or close prices.
+
+            Gamma, vega (per vol point) and theta (per calendar day) are taken from the same
+            analytic pricing used for delta, so come at almost no extra cost.
+
+            Returns [vol, strike_pct, delta, gamma, vega, theta] or [] if the vol cannot be implied
+        """
+        ql = get_quantlib()
+
+        if risk_free_rate is None:
+            risk_free_rate = self.risk_free_rate
+
+        instrument = self.instruments.get(option_price[2])
+        strike = instrument.strike
+        underlying_price = self._underlying_price(oh_flag, future_curve, term)
+
+        if oh_flag == 'open':
+            mark_price = option_price[6]
+        else:
+            mark_price = option_price[9]
+
+        call_put = instrument.option_type
+
+        # print("CALC IMPLIED VOL FOR DATE", calculation_date, 'EXPIRY', expiry_date, 'STRIKE', strike, 'FUTURE',
+        #       underlying_price, 'MARK', mark_price, 'type', call_put)
+
+        # Just in case!
+        if underlying_price <= 0:
+            return []
+
+        option_type = ql.Option.Call
+        if call_put == "P":
+            option_type = ql.Option.Put
+
+        def _date_split(given_date: datetime) -> (int, int, int):
+            """ Utility for converting datetime t """
+            return given_date.day, given_date.month, given_date.year
+
+        today = ql.Date(*_date_split(calculation_date))
+        if oh_flag == 'close':
+            # note that 'close' calculation date is 24hrs after the 'open' calculation date.
+            today = ql.Date(*_date_split(calculation_date + timedelta(days=1)))
+
+        expiry = ql.Date(*_date_split(expiry_date))
+
+        # set calc date
+        ql.Settings.instance().evaluationDate = today
+        # The Instrument
+        option = ql.EuropeanOption(ql.PlainVanillaPayoff(option_type, strike),
+                                   ql.EuropeanExercise(expiry))
+        # Calculate Implied Vol
+        # The Market
+        u = ql.SimpleQuote(underlying_price)  # set today's value of the underlying
+        r = ql.SimpleQuote(risk_free_rate / 100)  # set risk-free rate
+        sigma = ql.SimpleQuote(0.5)  # set volatility
+        riskFreeCurve = ql.FlatForward(0, ql.NullCalendar(), ql.QuoteHandle(r), ql.Actual360())
+        volatilityCurve = ql.BlackConstantVol(0, ql.NullCalendar(), ql.QuoteHandle(sigma), ql.Actual365Fixed())
+        # The Model
+        process = ql.BlackProcess(ql.QuoteHandle(u),
+                                  ql.YieldTermStructureHandle(riskFreeCurve),
+                                  ql.BlackVolTermStructureHandle(volatilityCurve))
+
+        try:
+            # Get USD (or, in general, quote ccy of underlying future) price for quantlib to use
+            mark_price_usd = mark_price * underlying_price
+            volatility = option.impliedVolatility(mark_price_usd, process) * 100
+        except RuntimeError as e:
+
+            if 'root not' in str(e):
+                # Vol exceeds bounds <0.0001, > 400.00
+                return []
+
+            print(f"ERROR CALC IMPLIED VOL: DATE {calculation_date} for {option_price[2]} : {e}")
+            return []
+
+        # Now calculate Delta
+        # The Market
+        sigma = ql.SimpleQuote(volatility / 100)  # set volatility
+        volatilityCurve = ql.BlackConstantVol(0, ql.NullCalendar(), ql.QuoteHandle(sigma), ql.Actual365Fixed())
+        # The Model
+        process = ql.BlackProcess(ql.QuoteHandle(u),
+                                  ql.YieldTermStructureHandle(riskFreeCurve),
+                                  ql.BlackVolTermStructureHandle(volatilityCurve))
+
+        engine = ql.AnalyticEuropeanEngine(process)
+        # The Result
+        option.setPricingEngine(engine)
+        # print("OPTION PRICER", option.NPV(), option.delta(), option.gamma(), option.impliedVolatility(option.NPV(), process))
+        try:
+            # the engine calculates all the greeks in a single pass
+            delta = self._delta_as_float(option.delta())
+            gamma = option.gamma()
+            vega = option.vega() / 100
+            theta = option.theta() / 365
+        except RuntimeError as e:
+            print(f"ERROR CALC DELTA: DATE {calculation_date} for {option_price[2]}: {e}")
+            return []
+
+        # Given we have just priced the option, we could compare the usd price we get with
+        # the token price passed in to see if they are within some sort of tolerance.
+
+        strike_pct = 100 * strike / underlying_price
+
+        return [volatility, strike_pct, delta, gamma, vega, theta]
+
+    def _as_float_array(self, values) -> np.ndarray:
+        """ Convert a list of (possibly NULL) database prices to a float array, with NULLs as nan
+        """
+
+        return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+    def _prefilter_option_chunk(self, future_curves: dict, option_prices: list) -> (list, dict):
+        """ Vectorised no-arbitrage screen run over a chunk of options before any implied vol solve.
+
+            For each fix (open, and close unless term == 1) the forward is interpolated from the curve
+            and the USD mark price checked against the model free bounds;
+                intrinsic < price < forward (calls) or strike (puts).
+            Any option outside these bounds has no implied vol, so would only burn the solver's
+            iteration budget before failing with 'root not bracketed'.
+
+            Returns the viable options, and a count of rejected options per reason
+        """
+
+        n = len(option_prices)
+
+        if n == 0:
+            return [], {}
+
+        instruments = [self.instruments.get(option_price[2]) for option_price in option_prices]
+
+        strikes = np.fromiter((instrument.strike for instrument in instruments), dtype=float, count=n)
+        is_call = np.fromiter((instrument.option_type == 'C' for instrument in instruments), dtype=bool, count=n)
+        terms = np.fromiter((self._calculate_term(option_price[3], instrument.expiry)
+                             for option_price, instrument in zip(option_prices, instruments)), dtype=float, count=n)
+
+        curve_rows = {}
+        for row, option_price in enumerate(option_prices):
+            curve_rows.setdefault(self._future_key_from_record(option_price), []).append(row)
+
+        reasons = np.zeros(n, dtype=np.int8)
+
+        # the open/close price columns are 6 and 9 in both the option and future records
+        for oh_price, applies in ((6, np.ones(n, dtype=bool)), (9, terms != 1)):
+
+            forwards = np.empty(n)
+
+            for future_key, rows in curve_rows.items():
+                future_curve = future_curves[future_key]
+                future_terms = sorted(future_curve.keys())
+                forwards[rows] = np.interp(terms[rows], future_terms,
+                                           self._as_float_array([future_curve[term][oh_price] for term in future_terms]))
+
+            marks = self._as_float_array([option_price[oh_price] for option_price in option_prices])
+            mark_usd = marks * forwards
+            intrinsic = np.where(is_call, np.maximum(forwards - strikes, 0), np.maximum(strikes - forwards, 0))
+
+            checks = [
+                ~(marks > 0),
+                ~(forwards > 0),
+                mark_usd <= intrinsic,
+                is_call & (mark_usd >= forwards),
+                ~is_call & (mark_usd >= strikes),
+            ]
+
+            for reason, failed in enumerate(checks, start=1):
+                reasons[applies & (reasons == 0) & failed] = reason
+
+        viable = [option_price for option_price, reason in zip(option_prices, reasons) if reason == 0]
+
+        counts = np.bincount(reasons, minlength=len(PREFILTER_REASONS))
+        rejected = {PREFILTER_REASONS[reason]: int(count) for reason, count in enumerate(counts) if reason and count}
+
+        return viable, rejected
+
+    def _get_future_curve(self, option_price, future_curves) -> dict:
+        """ given the option record, return the future curve required for it to be priced
+        """
+
+        future_key = self._future_key_from_record(option_price)
+        # print("TRY KEY", future_key)
+        return future_curves[future_key]
+
+    def _calculate_missing_vol_data(self, future_curves: dict, option_price: list) -> list:
+        """ Calculates and returns a list of vol data that needs to be added to the
+            historic vol database. Any error and it will return None
+
+            The list is [open vol, strike, delta, close vol, strike, delta, term,
+                         open gamma, vega, theta, close gamma, vega, theta]
+        """
+
+        vol_data = []
+        greeks = []
+
+        oh_flags = ['open', 'close']
+
+        calculation_date = option_price[3]
+        expiry_date = self.instruments.get(option_price[2]).expiry
+        term = self._calculate_term(calculation_date, expiry_date)
+        # print("FUTRE FOR OPTION", option_price[2], option_price[3])
+        try:
+            future_curve = self._get_future_curve(option_price, future_curves)
+        except KeyError:
+            print(f"ERROR FUTURE CURVE NOT FOUND {option_price[2]}")
+            return None
+
+        for oh_flag in oh_flags:
+            vol_strike_delta = self._calc_implied_vol_strike_and_delta(oh_flag, option_price, future_curve, calculation_date, expiry_date, term)
+
+            # print("GOT VOL", option_price[2], vol_strike_delta)
+
+            if not vol_strike_delta:
+                return None
+
+            vol_data += vol_strike_delta[:3]
+            greeks += vol_strike_delta[3:]
+
+            if term == 1:
+                vol_data += vol_strike_delta[:3]
+                greeks += vol_strike_delta[3:]
+                break
+
+        vol_data.append(term)
+        vol_data += greeks
+
+        # print("OPTION VOL", vol_data)
+        return vol_data
+
+    def _vol_row(self, option_price, vol_data: list) -> list:
+        """ Assemble the OHLCV_VOL table row for an option price record and its calculated vol data
+        """
+
+        # Capture first few columns shared between prices and vols
+        # ts, exchange, symbol, close day, close datetime, timestamp
+        option_vol = list(option_price[:6])
+        # Add on vol results [open/close: vol, strike_pct, delta] and term
+        option_vol += vol_data[:VOL_DATA_TERM_END]
+        # Add residual elements of record [volume]
+        option_vol.append(option_price[10])
+        # Add on greeks [open/close: gamma, vega, theta]
+        option_vol += vol_data[VOL_DATA_TERM_END:]
+
+        return option_vol
+
+    def _solve_option_chunk(self, future_curves: dict, option_prices: list) -> (list, int, dict):
+        """ Pre-screen and then solve the vols for a chunk of options.
+
+            Returns the OHLCV_VOL rows for those options that solved, the count of failed solves
+            and the count of options rejected before solving per reason
+        """
+
+        viable_option_prices, rejected = self._prefilter_option_chunk(future_curves, option_prices)
+
+        vol_rows = []
+        failed = 0
+
+        for option_price in viable_option_prices:
+
+            with instrumentation.stage(IV_SOLVE):
+                vol_data = self._calculate_missing_vol_data(future_curves, option_price)
+
+            if vol_data:
+                # Only add rows where a Vol/delta etc was successfully calculated
+                vol_rows.append(self._vol_row(option_price, vol_data))
+            else:
+                failed += 1
+
+        return vol_rows, failed, rejected
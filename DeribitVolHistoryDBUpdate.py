@@ -1,9 +1,14 @@
-import tomli
-from datetime import datetime, timedelta
-import psycopg2
-import QuantLib as ql
-import logging, time, sys, getopt
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import logging, time, sys, getopt, os, resource, threading, queue
 import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool, load_config, bulk_write, get_table_storage
+from DeribitInstruments import check_instruments_table_exists
+from DeribitVolCalculator import DeribitVolCalculator
+from JobInstrumentation import instrumentation, TRANSFORM, DB_READ, DB_WRITE, ROWS_FETCHED, ROWS_INSERTED
+from DeribitVolSurfaceBuilder import DeribitVolSurfaceBuilder
+from VolMetricsEngine import VolMetricsEngine
+from OptionChainSnapshot import OptionChainBuilder
 
 
 logger = logging.getLogger('DERIBIT VOL UPDATER')
@@ -18,8 +23,40 @@ logHandler.setFormatter(formatter)
 
 logger.addHandler(logHandler)
 
+# rough in-memory footprint of one OHLCV row once converted to a python tuple
+# (datetimes, floats, symbol strings and the raw libpq buffer behind it)
+ESTIMATED_ROW_BYTES = 1024
+MIN_CHUNK_ROWS = 500
+# number of symbols per 'MarketSymbol IN (...)' restriction
+SYMBOL_BATCH_SIZE = 500
+# most year-months loaded or being processed at any one time when prefetching
+MONTHS_IN_FLIGHT = 2
 
-class DeribitVolHistoryDBUpdate:
+# registry of recomputed (versioned) vol tables
+VOL_VERSIONS_TABLE = 'VOL_VERSIONS'
+# the vol table's upsert keys, once the DEDUP migration (7) has run; recompute versions are given the same
+VOL_UPSERT_KEYS = ['ExchangeDate', 'Exchange', 'MarketSymbol', 'ExchangeTimestamp']
+
+# calculator used by each solver worker process
+_worker_calculator = None
+
+
+def _init_solver_worker(risk_free_rate: float, delta_precision: float) -> None:
+    """ Create the (database free) vol calculator for a solver worker process
+    """
+    global _worker_calculator
+    _worker_calculator = DeribitVolCalculator(risk_free_rate, delta_precision)
+
+
+def _solve_in_worker(payload: tuple) -> (list, int, dict):
+    """ Solve a chunk of options in a solver worker process;
+        payload is (future curves for the chunk, option price chunk)
+    """
+    future_curves, option_prices = payload
+    return _worker_calculator._solve_option_chunk(future_curves, option_prices)
+
+
+class DeribitVolHistoryDBUpdate(DeribitVolCalculator):
     """ This module will populate all rows missing from the historic vol table.
         It will create the vol history table if it does not exist.
 
@@ -29,51 +66,61 @@ class DeribitVolHistoryDBUpdate:
         Missing vol rows are calculated using data from the OHLCV price history table.
         So, to add missing Vol history, you first need to add any missing Price history (see DeribitPriceHistoryDBGateway.py)
 
-        The vol data consists of the open/close implied volatility, strike% and delta for Deribit options.
+        The vol data consists of the open/close implied volatility, strike% and delta for Deribit options,
+        along with the open/close gamma, vega and theta.
+
+        Each chunk of vols is written to the OPTION_CHAIN snapshot table too (see OptionChainSnapshot.py).
 
     """
 
-    def __init__(self):
+    def __init__(self, db_pool: DatabasePool = None):
 
         self.deribit_ohlcv = "OHLCV"
         self.deribit_ohlcv_vol = "OHLCV_VOL"
 
-        self.db_config: dict = self._load_config()
-        self.db_cursor = None
-        self.db_connection = None
-        self._connectDB(self.db_config)
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.db_connection = self.db_pool.get_connection()
+        self.db_cursor = self.db_connection.cursor()
+
+        self.vol_config: dict = self._load_vol_config()
+        self.max_memory_mb: int = self.vol_config['max_memory_mb']
+        self.chunk_rows: int = self._chunk_rows_for_ceiling(self.vol_config['chunk_rows'], self.max_memory_mb)
+
+        super().__init__(risk_free_rate=self.vol_config['risk_free_rate'],
+                         delta_precision=self.vol_config['delta_precision'])
 
         self._check_vol_history_table_exists()
 
-    def _ensure_datetime(self, given_date) -> datetime:
-        """ Ensures given date is a python datetime object.
-            Converts type string to datetime if required.
-        """
-        if type(given_date) is str:
-            date_calc = datetime.strptime(given_date, '%y%m%d')
-        else:
-            date_calc = given_date
+        self._load_instruments()
 
-        return date_calc
+        self.surface_builder = DeribitVolSurfaceBuilder(self.db_pool, self.instruments)
+        self.metrics_engine = VolMetricsEngine(self.db_pool)
+        self.chain_builder = OptionChainBuilder(self.db_pool, self.instruments)
 
-    def _calculate_term(self, exchange_date, expiry) -> int:
-        """ Days from exchange date to given expiry date
+    def _load_instruments(self) -> None:
+        """ Seed the instrument cache from the INSTRUMENTS reference table,
+            so the vol calculations never need to parse option/future symbols.
         """
 
-        date_calc = self._ensure_datetime(exchange_date)
-        date_exp = self._ensure_datetime(expiry)
-
-        delta = date_exp - date_calc
-        return delta.days
+        check_instruments_table_exists(self.db_cursor)
+        self.info_logger(f"LOADED {self.instruments.load(self.db_cursor)} INSTRUMENTS")
 
     def _check_vol_history_table_exists(self) -> None:
         """ IF Vol History table does not exist, then create it
         """
 
-        self.db_cursor.execute(f'''CREATE TABLE IF NOT EXISTS {self.deribit_ohlcv_vol} (
+        self._create_vol_table(self.deribit_ohlcv_vol)
+
+    def _create_vol_table(self, table_name: str, storage: str = '') -> None:
+        """ Create a vol history table (the live one, or a recompute version) if it does not exist
+
+            :param storage: WAL / DEDUP clauses following PARTITION BY (see _version_table_storage)
+        """
+
+        self.db_cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
                                     ts TIMESTAMP,
-                                    Exchange  STRING NOT NULL,
-                                    MarketSymbol  STRING NOT NULL,
+                                    Exchange  SYMBOL CAPACITY 256 CACHE INDEX,
+                                    MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
                                     ExchangeDay TIMESTAMP NOT NULL,
                                     ExchangeDate TIMESTAMP NOT NULL,
                                     ExchangeTimestamp LONG NOT NULL,
@@ -84,576 +131,704 @@ class DeribitVolHistoryDBUpdate:
                                     CloseStrike FLOAT,
                                     CloseDelta FLOAT, 
                                     Term FLOAT,
-                                    Volume  FLOAT
-                            ) timestamp(ts);''')
-
-    def _connectDB(self, db_config) -> None:
-        """ Establish connection to the database using given config
+                                    Volume  FLOAT,
+                                    OpenGamma FLOAT,
+                                    OpenVega FLOAT,
+                                    OpenTheta FLOAT,
+                                    CloseGamma FLOAT,
+                                    CloseVega FLOAT,
+                                    CloseTheta FLOAT
+                            ) timestamp(ExchangeDate) PARTITION BY MONTH{storage};''')
+
+    def _load_vol_config(self) -> dict:
+        """ Load the (optional) [vol] section of the configuration .toml file
+            that controls how much price data is held in memory at once.
         """
 
-        try:
-            # Connect to DB
-            self.db_connection = psycopg2.connect(user=db_config['user'],
-                                             password=db_config['password'],
-                                             host=db_config['host'],
-                                             port=db_config['port'],
-                                             database=db_config['database']
-                                             )
-            print('Postgres connection is established.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            raise e
+        return load_config('vol', {'chunk_rows': 20000, 'max_memory_mb': 1024, 'prefetch': True, 'prefetch_chunks': 4,
+                                   'risk_free_rate': 0.0, 'delta_precision': 0.001, 'solver_workers': 0})
 
-        try:
-            # open connection for read/write
-            self.db_cursor = self.db_connection.cursor()
-            print('Postgres connection is opened.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            if self.db_connection:
-                self.db_connection.close()
-            print('Postgres connection is closed.')
-            raise e
-
-    def _load_config(self) -> dict:
-        """ Load up the database configuration .toml file
+    def _chunk_rows_for_ceiling(self, chunk_rows: int, max_memory_mb: int) -> int:
+        """ Restrict the number of rows fetched per chunk so that a single chunk
+            can never take up more than a quarter of the configured memory ceiling.
         """
 
-        db_config = {}
-
-        # Use same .toml file as the Deribt Price History...
-        with open("DeribitPriceHistoryDBGateway.toml", mode="rb") as cf:
-            config = tomli.load(cf)
+        ceiling_rows = (max_memory_mb * 1024 * 1024) // (4 * ESTIMATED_ROW_BYTES)
 
-            # database config
-            db_config['user'] = config['database']['user']
-            db_config['password'] = config['database']['password']
-            db_config['host'] = config['database']['host']
-            db_config['port'] = config['database']['port']
-            db_config['database'] = config['database']['database']
+        return max(MIN_CHUNK_ROWS, min(chunk_rows, ceiling_rows))
 
-        return db_config
+    def _current_rss_mb(self) -> float:
+        """ Current resident memory of this process in MB.
+            Falls back to the peak resident memory where /proc is not available.
+        """
 
-    def _delta_as_float(self, x) -> float:
-        """ Ensure delta figure is presented as a float for DB insert
+        try:
+            with open('/proc/self/statm') as statm:
+                resident_pages = int(statm.read().split()[1])
+            return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+        except (OSError, ValueError, IndexError):
+            # ru_maxrss is in KB on linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _check_memory_ceiling(self) -> None:
+        """ If we have crept above the memory ceiling, halve the chunk size
+            so that subsequent chunks bring the resident memory back down.
         """
 
-        precision = 0.001
+        rss_mb = self._current_rss_mb()
 
-        if x < precision and x > -precision:
-            return 0
+        if rss_mb > self.max_memory_mb and self.chunk_rows > MIN_CHUNK_ROWS:
+            self.chunk_rows = max(MIN_CHUNK_ROWS, self.chunk_rows // 2)
+            self.info_logger(f"MEMORY {rss_mb:.0f}MB ABOVE CEILING {self.max_memory_mb}MB; CHUNK SIZE REDUCED TO {self.chunk_rows} ROWS")
 
-        if x < -1 + precision:
-            return -1
+    def _stream_rows(self, query: str, params: tuple = None):
+        """ Execute the given query and yield the result in chunks of at most 'chunk_rows' rows,
+            so that only a single chunk of python tuples is alive at any one time.
 
-        if x > 1 - precision:
-            return 1
+            Each query reads through its own pooled connection, so the main connection remains free
+            for inserts and the prefetch thread never shares a connection with the main thread.
+        """
 
-        return x
+        rows_read = self.db_pool.bulk_read(query, params, self.chunk_rows)
 
-    def _convert_prices_to_curves(self, future_prices) -> dict:
-        """ Converts all the available perpetual and futures prices into curves.
-            Each curve is for a given token and exchange date and consists
-            of a set of future prices indexed by 'term' ie time to expiry.
+        while True:
+            with instrumentation.stage(DB_READ) as stage:
+                rows = next(rows_read, None)
+                stage.count = len(rows) if rows else 0
+            if rows is None:
+                break
+            yield rows
 
-            Filters are also applied to restrict the curves to only those useful
-            as underlyings for options.
+    def _get_historic_future_curves(self, where_clause: str) -> dict:
+        """ Load the perpetual and future prices for the given date range and convert them to curves.
+            Only the (relatively few) future rows are loaded here; options are streamed separately.
 
+            :param where_clause: date restriction, for a month or a single COB date
         """
 
-        # print("CONVERTING FUTURE PRICES TO CURVES...")
-
-        curves = {}
+        self.query_string = f"""SELECT * from {self.deribit_ohlcv} 
+                                where {where_clause}
+                                AND Exchange = 'deribit'
+                                AND MarketSymbol LIKE '%:%'
+                                AND NOT (MarketSymbol LIKE '%-C' OR MarketSymbol LIKE '%-P')"""
 
-        for future in future_prices:
+        future_prices = []
 
-            # skip if not deribit
-            if future[1] != 'deribit':
-                continue
+        for rows in self._stream_rows(self.query_string):
+            # pick up perpetuals and futures
+            future_prices += [price for price in rows if self.instruments.get(price[2]).kind in ('future', 'perpetual')]
 
-            split = future[2].split('-')
+        # Collect future prices into a dictionary of 'curves' for each COB date
+        with instrumentation.stage(TRANSFORM, count=len(future_prices)):
+            return self._convert_prices_to_curves(future_prices)
 
-            # skip non BTC/ETH future price data
-            if future[2][:3] not in ['BTC', 'ETH']:
-                continue
+    def _stream_option_prices(self, day: str, symbols: list = None):
+        """ Yield the option prices for a single COB date in chunks of at most 'chunk_rows' rows.
 
-            try:
-                expiry = split[1]
-            except IndexError:
-                expiry = future[3]
+            :param day: the COB date to process as 'YYYY-MM-DD'
+            :param symbols: optionally, restrict to just these option symbols
+        """
 
-            key = self._future_key_from_record(future)
+        self.query_string = f"""SELECT * from {self.deribit_ohlcv} 
+                                where {self._day_where_clause(day)}
+                                AND Exchange = 'deribit'
+                                AND (MarketSymbol LIKE '%-C' OR MarketSymbol LIKE '%-P')"""
 
-            if key not in curves:
-                curves[key] = {}
+        if symbols is None:
+            symbol_batches = [None]
+        else:
+            symbol_batches = [symbols[i:i + SYMBOL_BATCH_SIZE] for i in range(0, len(symbols), SYMBOL_BATCH_SIZE)]
 
-            term = self._calculate_term(future[3], expiry)
+        for symbol_batch in symbol_batches:
 
-            if term not in curves[key]:
-                curves[key][term] = future
+            if symbol_batch is None:
+                query, params = self.query_string, None
+            else:
+                query = self.query_string + f" AND MarketSymbol IN ({', '.join(['%s'] * len(symbol_batch))})"
+                params = tuple(symbol_batch)
 
-        return curves
+            for rows in self._stream_rows(query, params):
+                # pick up just options
+                yield [price for price in rows if self.instruments.get(price[2]).kind == 'option']
 
-    def _get_historic_price_data(self, year: int, month: int) -> (dict, list):
+    def _get_historic_price_data(self, year: int, month: int) -> (dict, object):
         """ Load all historic price data required for Vol interpolation.
 
             :param year: the year to process
             :param month: the month to process
 
-            Return dictionary of future curves and list of available option prices
+            Return dictionary of future curves and a generator of (COB date, option price chunk) pairs.
+            Option prices are streamed a day at a time, and only for days that have a futures curve.
         """
 
-        # columns = ['ts', 'exchange', 'symbol', 'exchange_day', 'exchange_date', 'exchange_ts',
-        #            'open', 'high', 'low', 'close',
-        #            'volume']
+        future_curves = self._get_historic_future_curves(self._where_clause(year, month))
 
-        # print(f"LOADING PRICE DATA...{year}-{month}")
+        days = sorted({future_key[2] for future_key in future_curves})
 
-        where_clause = self._where_clause(year, month)
-        # print("WHERE CLAUSE", where_clause)
-        self.query_string = f"""SELECT * from {self.deribit_ohlcv} 
-                                where {where_clause}"""
+        def _option_chunks():
+            for day in days:
+                for option_prices in self._stream_option_prices(day):
+                    yield day, option_prices
 
-        # print(self.query_string)
+        return future_curves, _option_chunks()
 
-        self.db_cursor.execute(self.query_string)
-        result = self.db_cursor.fetchall()
+    def _get_existing_historic_vol_keys(self, day: str) -> set:
+        """ Load the historic vol keys for a single COB date and return a 'set' of 'keys'
+            to enable fast check if vol record already exists in the database
+            key is exchange + symbol + COB Date
 
-        future_prices = []
-        option_prices = []
+            :param day: the COB date to process as 'YYYY-MM-DD'
 
-        for price in result:
-            # pick up perpetuals and futures
-            if (':' in price[2]) and (len(price[2].split('-')) <= 2):
-                future_prices.append(price)
-                continue
+         """
 
-            # pick up just options
-            if len(price[2].split('-')) == 4:
-                option_prices.append(price)
+        self.query_string = f"""SELECT Exchange, MarketSymbol, ExchangeDay from {self.deribit_ohlcv_vol} 
+                                where {self._day_where_clause(day)}"""
 
-        # Collect future prices into a dictionary of 'curves' for each COB date
-        future_curves = self._convert_prices_to_curves(future_prices)
+        keys = set()
 
-        return future_curves, option_prices
+        for rows in self._stream_rows(self.query_string):
+            # key is exchange + symbol + COB Date
+            keys.update((row[0], row[1], row[2].strftime('%Y-%m-%d')) for row in rows)
 
-    def _get_existing_historic_vol_keys(self, year, month) -> set:
-        """ Load all historic vol data and return a 'set' of 'keys'
-            to enable fast check if vol record already exists in the database
-            key is exchange + symbol + COB Date
+        return keys
+
+    def _where_clause(self, year, month):
+        """ construct a date where clouse to restrict results to a single month;
+            on the designated timestamp, so only that month's partition is read
+        """
+        return f"ExchangeDate IN '{year}-{month:02}'"
+
+    def _day_where_clause(self, day: str) -> str:
+        """ construct a date where clause to restrict results to a single COB date 'YYYY-MM-DD'
+            (ExchangeDay is ExchangeDate truncated to the day)
+        """
+        return f"ExchangeDate IN '{day}'"
+
+    def _vol_record_exists(self, option, historic_vol_keys) -> bool:
+        """ Check if an option has already got a record in the historic vols table
+        """
+        return self._option_key_from_record(option) in historic_vol_keys
+
+    def _get_missing_historic_vols(self, year, month) -> (dict, object):
+        """ Determine the option prices that have no corresponding historic Vol data
+            and have a chance of being able to calculate a valid historic volatility.
 
             :param year: the year to process
             :param month: the month to process
 
-         """
+            Return the associated historic future curves, along with a generator
+            of chunks of options to consider
+        """
 
-        # print(f"LOADING HISTORIC VOL DATA...{year}-{month}")
+        future_curves, option_price_chunks = self._get_historic_price_data(year, month)
 
-        # columns = ['ts', 'exchange', 'symbol', 'exchange_day', 'exchange_date', 'exchange_ts',
-        #            'open_vol', 'high_vol', 'low_vol', 'close_vol',
-        #            'open_strike', 'high_strike', 'low_strike', 'close_strike',
-        #            'term', 'volume']
+        return future_curves, self._missing_option_chunks(future_curves, option_price_chunks)
 
-        where_clause = self._where_clause(year, month)
+    def _missing_option_chunks(self, future_curves: dict, option_price_chunks, skip_existing: bool = True):
+        """ Filter the given (COB date, option price chunk) pairs down to chunks of options
+            that are missing a vol and have a futures curve to price against.
 
-        self.query_string = f"""SELECT * from {self.deribit_ohlcv_vol} 
-                                where {where_clause}"""
+            With skip_existing False (a full recompute), options that already have a vol are kept.
+        """
 
-        # print(self.query_string)
+        key_count, term_count, exists_count, missing_count, process_count = 0, 0, 0, 0, 0
+        existing_day, existing_historic_vol_keys = None, set()
 
-        self.db_cursor.execute(self.query_string)
-        result = self.db_cursor.fetchall()
+        for day, option_prices in option_price_chunks:
 
-        # key is exchange + symbol + COB Date
-        return {self._option_key_from_record(option) for option in result}
+            # vol keys are only held for the day currently being streamed
+            if skip_existing and day != existing_day:
+                existing_day, existing_historic_vol_keys = day, self._get_existing_historic_vol_keys(day)
 
-    def _option_key_from_record(self, record) -> tuple:
-        """ return a standard unique 'key' from the given record data
-        """
+            missing_option_vols = []
 
-        # key is exchange + symbol + COB Date
-        return (record[1], record[2], str(record[3].strftime('%Y-%m-%d')))
+            # restrict set of options to only those that are missing and have a futures curve
+            for option_price in option_prices:
 
-    def _future_key_from_record(self, record) -> tuple:
-        """ Calculate a unique future key as just the perpetual name or future name
-            or, if an option, the underlying future name
-        """
-        split = record[2].split('-')
-        token = split[0]
+                if self._vol_record_exists(option_price, existing_historic_vol_keys):
+                    exists_count += 1
+                    continue
+                else:
+                    missing_count += 1
 
-        # key is exchange + symbol (without strike/option_type, if present) + COB Date
-        return (record[1], token, record[3].strftime('%Y-%m-%d'))
+                future_key = self._future_key_from_record(option_price)
+                expiry = self.instruments.get(option_price[2]).expiry
+                calc_date = option_price[3]
 
-    def _where_clause(self, year, month):
-        """ construct a date where clouse to restrict results to a single month
+                term = self._calculate_term(calc_date, expiry)
+
+                if term <= 0:
+                    term_count += 1
+                    continue
+
+                if future_key not in future_curves:
+                    key_count += 1
+                    continue
+
+                missing_option_vols.append(option_price)
+
+            process_count += len(missing_option_vols)
+
+            if missing_option_vols:
+                yield missing_option_vols
+
+        self.info_logger(f"PROCESSED: {process_count} SKIPPING: {exists_count} ALREADY EXIST, {term_count} HAVE TERM ZERO, AND {key_count} HAVE NO FUTURES PRICES")
+
+    def _insert_vol_rows(self, option_vol_rows: list, table_name: str = None) -> None:
+        """ Bulk insert the given rows into the historic vol database table (or the given version table)
         """
-        start_date = f"{year}-{month:02}-01"
-        end_month = month + 1 if month < 12 else 1
-        end_year = year if month < 12 else year + 1
-        end_date = f"{end_year}-{end_month:02}-01"
 
-        return f"ExchangeDay >= '{start_date}' AND ExchangeDay < '{end_date}'"
+        now = datetime.utcnow()
 
-    def _vol_record_exists(self, option, historic_vol_keys) -> bool:
-        """ Check if an option has already got a record in the historic vols table
+        bulk_write(self.db_cursor, table_name or self.deribit_ohlcv_vol,
+                   [(now, *option_vol_row[1:]) for option_vol_row in option_vol_rows])
+
+    def _process_option_chunks(self, future_curves: dict, missing_option_chunks) -> set:
+        """ Solve and insert the vols for the given chunks of options.
+            Each chunk is solved and committed before the next is loaded.
+
+            Returns the set of COB dates ('YYYY-MM-DD') for which vols were written
         """
-        return self._option_key_from_record(option) in historic_vol_keys
 
-    def _get_missing_historic_vols(self, year, month) -> (dict, list):
-        """ Determine list of option prices that have no corresponding historic Vol data
-            and have a chance of being able to calculate a valid historic volatility.
+        days_written = set()
+        failed = 0
+        succeded = 0
+        rejected = {}
 
-            :param year: the year to process
-            :param month: the month to process
+        for missing_option_vols in missing_option_chunks:
+
+            # reject options that cannot possibly have an implied vol, then solve the rest
+            vol_rows, chunk_failed, chunk_rejected = self._solve_option_chunk(future_curves, missing_option_vols)
 
-            Return list of options to consider, along with the associated historic future curves
+            for reason, count in chunk_rejected.items():
+                rejected[reason] = rejected.get(reason, 0) + count
+
+            # Commit each chunk, and its option chain rows, before the next one is loaded
+            with instrumentation.stage(DB_WRITE, count=len(vol_rows)):
+                if vol_rows:
+                    self._insert_vol_rows(vol_rows)
+                    self.chain_builder._write_chain_rows(self.db_cursor, future_curves, missing_option_vols, vol_rows)
+                self.db_connection.commit()
+
+            days_written.update(vol_row[3].strftime('%Y-%m-%d') for vol_row in vol_rows)
+            succeded += len(vol_rows)
+            failed += chunk_failed
+
+            instrumentation.count('deribit', ROWS_FETCHED, len(missing_option_vols))
+            instrumentation.count('deribit', ROWS_INSERTED, len(vol_rows))
+
+            self._check_memory_ceiling()
+
+        self.info_logger(f"TOTAL OF {succeded} WRITES AND {failed} FAILED SOLVES (probably vol>400)")
+        self.info_logger(f"REJECTED BEFORE SOLVING {sum(rejected.values())}: {rejected}")
+
+        return days_written
+
+    def _process_year_month(self, year: int, month: int) -> set:
+        """ Process the price data for the given year and month to find implied vols for options.
+            Returns the set of COB dates for which vols were written
         """
 
-        future_curves, option_prices = self._get_historic_price_data(year, month)
+        future_curves, missing_option_chunks = self._get_missing_historic_vols(year, month)
 
         if not future_curves:
-            return future_curves, option_prices
+            return set()
 
-        existing_historic_vol_keys = self._get_existing_historic_vol_keys(year, month)
+        self.info_logger(f"PROCESSING YEAR {year} MONTH {month}")
 
-        # print("EXISTING", list(existing_historic_vol_keys)[:50])
+        return self._process_option_chunks(future_curves, missing_option_chunks)
 
-        missing_option_vols = []
-        key_count, term_count, exists_count, missing_count = 0, 0, 0, 0
+    def _process_day(self, day: str, symbols: list = None) -> set:
+        """ Process the price data for a single COB date to find implied vols for options.
 
-        # option_prices = option_prices[1273000:]
+            :param day: the COB date to process as 'YYYY-MM-DD'
+            :param symbols: optionally, restrict to just these option symbols
+        """
 
-        # restrict set of options to only those that are missing and have a futures curve
-        for option_price in option_prices:
+        future_curves = self._get_historic_future_curves(self._day_where_clause(day))
 
-            # print(self._option_key_from_record(option_price))
+        if not future_curves:
+            return set()
 
-            if self._vol_record_exists(option_price, existing_historic_vol_keys):
-                # print("record exists", option_price)
-                exists_count += 1
-                continue
-            else:
-                missing_count += 1
+        self.info_logger(f"PROCESSING DAY {day} FOR {'ALL' if symbols is None else len(symbols)} OPTIONS")
 
-            # print("MISSING", self._option_key_from_record(option_price))
-            split = option_price[2].split('-')
-            future_key = self._future_key_from_record(option_price)
-            expiry = split[1]
-            calc_date = option_price[3]
+        option_price_chunks = ((day, option_prices) for option_prices in self._stream_option_prices(day, symbols))
 
-            term = self._calculate_term(calc_date, expiry)
+        return self._process_option_chunks(future_curves, self._missing_option_chunks(future_curves, option_price_chunks))
 
-            if term <= 0:
-                # print("term zero", term)
-                term_count += 1
-                continue
+    def _build_vol_surfaces(self, days: set) -> dict:
+        """ Surface building stage; refit the vol surface for each day that has had new vols written,
+            then update the vol metrics for just those days.
+        """
 
-            if future_key not in future_curves:
-                key_count +=1
-                # print("future missing", future_key)
-                continue
+        surfaces = self.surface_builder._build_surfaces(sorted(days))
 
-            # print("existing", calc_date, option_price[2], future_key)
-            missing_option_vols.append(option_price)
+        self.metrics_engine._update_vol_metrics(surfaces)
 
-        # print("VOL ANALYSIS: OUT OF", len(option_prices), "PRICES", exists_count, "VOLS ALREADY EXIST,", missing_count,"VOLS ARE MISSING")
-        self.info_logger(f"WILL PROCESS: {len(missing_option_vols)} SKIPPING: {term_count} HAVE TERM ZERO, AND {key_count} HAVE NO FUTURES PRICES" )
+        return surfaces
 
-        return future_curves, missing_option_vols
+    def info_logger(self, message):
 
-    def _underlying_price(self, oh_flag, future_curve, term) -> float:
-        """ Interpolate the future open/close prices
-            for the given future curve and term
+        logger.info(message)
+        print("LOG", message)
+
+    def _years_and_months(self, run_year: int=None, run_month: int=None) -> (list, list):
+        """ The years and months to process; everything unless restricted to a year or year and month
         """
 
-        future_terms = list(sorted(future_curve.keys()))
+        years = list(range(2017, datetime.now().year + 1))
+        months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 
-        if oh_flag == 'open':
-            oh_price = 6
-        else:
-            oh_price = 9
+        if run_year and not run_month:
+            years = [run_year]
+            months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 
-        if term in future_terms:
-            return future_curve[term][oh_price]
+        if run_year and run_month:
+            years = [run_year]
+            months = [run_month]
 
-        before_term = None
-        after_term = None
+        return years, months
 
-        for future_term in future_terms:
-            if future_term < term:
-                before_term = future_term
-            if future_term > term:
-                after_term = future_term
-                break
+    def _update_historic_vol_data(self, run_year: int=None, run_month: int=None) -> None:
+        """ Iterate through all the option & future price data that we have,
+            inserting any data missing from the Vol History table -y
+        """
+
+        years, months = self._years_and_months(run_year, run_month)
 
-        if before_term is None:
-            # return data of first future price
-            # print(f"***** BEFORE; THIS IS VERY ODD!!! OPTION TERM {term} COMES BEFORE FIRST FUTURE {future_terms[0]}")
-            # print("INPUTS", oh_flag, future_curve, term)
-            term = future_terms[0]
-            return future_curve[term][oh_price]
+        self.info_logger(f"STARTING DeribitVolUpdate: years: {years} months: {months}")
 
-        if after_term is None:
-            # print(f"***** AFTER FINAL FUTURE - EXTRAPOLATING {term}")
-            # return data of final future price
-            term = future_terms[-1]
-            return future_curve[term][oh_price]
+        if not self.vol_config['prefetch']:
+            for year in years:
+                for month in months:
+                    days_written = self._process_year_month(year, month)
+                    self._build_vol_surfaces(days_written)
+            return
 
-        # print("LOOKING FOR", term, "BETWEEN", before_term, after_term)
-        factor = (term - before_term) / (after_term - before_term)
+        for year, month, future_curves, missing_option_chunks in self._prefetch_year_months([(year, month) for year in years for month in months]):
 
-        return future_curve[before_term][oh_price] * (1 - factor) + future_curve[after_term][oh_price] * factor
+            if not future_curves:
+                # drain the (empty) month so the next one can be prefetched
+                for _ in missing_option_chunks:
+                    pass
+                continue
 
-    def _calc_implied_vol_strike_and_delta(self, oh_flag, option_price, future_curve, calculation_date, expiry_date, term, risk_free_rate=0.0) -> list:
-        """ Given the optionand future price data, calculate the associated
-            implied vol, strike_pct and delta using either the open or close prices.
+            self.info_logger(f"PROCESSING YEAR {year} MONTH {month}")
+
+            days_written = self._process_option_chunks(future_curves, missing_option_chunks)
+            self._build_vol_surfaces(days_written)
+
+    def _prefetch_year_months(self, year_months: list):
+        """ Yield (year, month, future curves, missing option chunks) for each of the given year-months,
+            with the loading done on a background thread, so the next month's curves and options
+            are read from the database while the current month is being solved and written.
+
+            Months are produced strictly in order through a bounded queue; at most MONTHS_IN_FLIGHT
+            months are held at once, and at most 'prefetch_chunks' option chunks are queued ahead.
         """
-        strike = float(option_price[2].split('-')[2])
-        underlying_price = self._underlying_price(oh_flag, future_curve, term)
 
-        if oh_flag == 'open':
-            mark_price = option_price[6]
-        else:
-            mark_price = option_price[9]
-
-        call_put = option_price[2].split('-')[3]
-
-        # print("CALC IMPLIED VOL FOR DATE", calculation_date, 'EXPIRY', expiry_date, 'STRIKE', strike, 'FUTURE',
-        #       underlying_price, 'MARK', mark_price, 'type', call_put)
-
-        # Just in case!
-        if underlying_price <= 0:
-            return []
-
-        option_type = ql.Option.Call
-        if call_put == "P":
-            option_type = ql.Option.Put
-
-        def _date_split(given_date: datetime) -> (int, int, int):
-            """ Utility for converting datetime t """
-            return given_date.day, given_date.month, given_date.year
-
-        today = ql.Date(*_date_split(calculation_date))
-        if oh_flag == 'close':
-            # note that 'close' calculation date is 24hrs after the 'open' calculation date.
-            today = ql.Date(*_date_split(calculation_date + timedelta(days=1)))
-
-        expiry = ql.Date(*_date_split(expiry_date))
-
-        # set calc date
-        ql.Settings.instance().evaluationDate = today
-        # The Instrument
-        option = ql.EuropeanOption(ql.PlainVanillaPayoff(option_type, strike),
-                                   ql.EuropeanExercise(expiry))
-        # Calculate Implied Vol
-        # The Market
-        u = ql.SimpleQuote(underlying_price)  # set today's value of the underlying
-        r = ql.SimpleQuote(risk_free_rate / 100)  # set risk-free rate
-        sigma = ql.SimpleQuote(0.5)  # set volatility
-        riskFreeCurve = ql.FlatForward(0, ql.NullCalendar(), ql.QuoteHandle(r), ql.Actual360())
-        volatilityCurve = ql.BlackConstantVol(0, ql.NullCalendar(), ql.QuoteHandle(sigma), ql.Actual365Fixed())
-        # The Model
-        process = ql.BlackProcess(ql.QuoteHandle(u),
-                                  ql.YieldTermStructureHandle(riskFreeCurve),
-                                  ql.BlackVolTermStructureHandle(volatilityCurve))
+        loaded = queue.Queue(maxsize=self.vol_config['prefetch_chunks'])
+        months_in_flight = threading.Semaphore(MONTHS_IN_FLIGHT)
+        stopping = threading.Event()
 
-        try:
-            # Get USD (or, in general, quote ccy of underlying future) price for quantlib to use
-            mark_price_usd = mark_price * underlying_price
-            volatility = option.impliedVolatility(mark_price_usd, process) * 100
-        except RuntimeError as e:
-
-            if 'root not' in str(e):
-                # Vol exceeds bounds <0.0001, > 400.00
-                return []
-
-            print(f"ERROR CALC IMPLIED VOL: DATE {calculation_date} for {option_price[2]} : {e}")
-            return []
-
-        # Now calculate Delta
-        # The Market
-        sigma = ql.SimpleQuote(volatility / 100)  # set volatility
-        volatilityCurve = ql.BlackConstantVol(0, ql.NullCalendar(), ql.QuoteHandle(sigma), ql.Actual365Fixed())
-        # The Model
-        process = ql.BlackProcess(ql.QuoteHandle(u),
-                                  ql.YieldTermStructureHandle(riskFreeCurve),
-                                  ql.BlackVolTermStructureHandle(volatilityCurve))
-
-        engine = ql.AnalyticEuropeanEngine(process)
-        # The Result
-        option.setPricingEngine(engine)
-        # print("OPTION PRICER", option.NPV(), option.delta(), option.gamma(), option.impliedVolatility(option.NPV(), process))
-        try:
-            delta = self._delta_as_float(option.delta())
-        except RuntimeError as e:
-            print(f"ERROR CALC DELTA: DATE {calculation_date} for {option_price[2]}: {e}")
-            return []
+        def _put(item) -> None:
+            while not stopping.is_set():
+                try:
+                    loaded.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
 
-        # Given we have just priced the option, we could compare the usd price we get with
-        # the token price passed in to see if they are within some sort of tolerance.
+        def _prefetch() -> None:
+            try:
+                for year, month in year_months:
+                    months_in_flight.acquire()
+                    if stopping.is_set():
+                        return
+
+                    future_curves, missing_option_chunks = self._get_missing_historic_vols(year, month)
+                    _put(('month', (year, month, future_curves)))
 
-        strike_pct = 100 * strike / underlying_price
+                    if future_curves:
+                        for missing_option_vols in missing_option_chunks:
+                            _put(('chunk', missing_option_vols))
 
-        return [volatility, strike_pct, delta]
+                    _put(('end', None))
+            except Exception as e:
+                _put(('error', e))
+            finally:
+                _put(('done', None))
+
+        def _month_chunks():
+            while True:
+                kind, item = loaded.get()
+                if kind == 'chunk':
+                    yield item
+                elif kind == 'end':
+                    months_in_flight.release()
+                    return
+                elif kind == 'error':
+                    raise item
+
+        prefetcher = threading.Thread(target=_prefetch, name='vol-prefetch', daemon=True)
+        prefetcher.start()
 
-    def _get_future_curve(self, option_price, future_curves) -> dict:
-        """ given the option record, return the future curve required for it to be priced
+        try:
+            while True:
+                kind, item = loaded.get()
+
+                if kind == 'month':
+                    year, month, future_curves = item
+                    yield year, month, future_curves, _month_chunks()
+                elif kind == 'error':
+                    raise item
+                elif kind == 'done':
+                    break
+        finally:
+            stopping.set()
+            # unblock the prefetch thread if it is waiting for a month slot
+            months_in_flight.release()
+
+    def _update_vol_data_for_keys(self, price_keys: set, build_surfaces: bool = True) -> set:
+        """ Insert missing vol data for just the price rows that have been written by an ingest job.
+            Returns the days that had vols written.
+
+            :param price_keys: set of (exchange, symbol, 'YYYY-MM-DD') keys written to the price table
+            :param build_surfaces: rebuild the surfaces (and metrics) of those days too; the scheduler runs that as its own job
+
+            Only deribit options on the given days are processed, priced against the curves for those days.
+            If any future or perpetual price was written for a day, then every option on that day
+            is re-examined, as options that previously had no curve may now be priceable.
         """
 
-        future_key = self._future_key_from_record(option_price)
-        # print("TRY KEY", future_key)
-        return future_curves[future_key]
+        day_symbols = {}
 
-    def _calculate_missing_vol_data(self, future_curves: dict, option_price: list) -> list:
-        """ Calculates and returns a list of vol data that needs to be added to the
-            historic vol database. Any error and it will return None
-        """
+        for exchange, symbol, day in price_keys:
+
+            if exchange != 'deribit':
+                continue
 
-        vol_data = []
+            symbols = day_symbols.setdefault(day, set())
 
-        oh_flags = ['open', 'close']
+            if symbols is None:
+                continue
 
-        calculation_date = option_price[3]
-        expiry_date = self._ensure_datetime(option_price[2].split('-')[1])
-        term = self._calculate_term(calculation_date, expiry_date)
-        # print("FUTRE FOR OPTION", option_price[2], option_price[3])
-        try:
-            future_curve = self._get_future_curve(option_price, future_curves)
-        except KeyError:
-            print(f"ERROR FUTURE CURVE NOT FOUND {option_price[2]}")
-            return None
+            kind = self.instruments.get(symbol).kind
 
-        for oh_flag in oh_flags:
-            vol_strike_delta = self._calc_implied_vol_strike_and_delta(oh_flag, option_price, future_curve, calculation_date, expiry_date, term)
+            if kind == 'option':
+                symbols.add(symbol)
+            elif kind in ('future', 'perpetual'):
+                # curve has changed, so look at the whole day
+                day_symbols[day] = None
 
-            # print("GOT VOL", option_price[2], vol_strike_delta)
+        self.info_logger(f"STARTING DeribitVolUpdate: {len(day_symbols)} days from {len(price_keys)} new prices")
 
-            if not vol_strike_delta:
-                return None
+        days_written = set()
 
-            vol_data += vol_strike_delta
+        for day, symbols in sorted(day_symbols.items()):
 
-            if term == 1:
-                vol_data += vol_strike_delta
-                break
+            if symbols is None:
+                days_written |= self._process_day(day)
+            elif symbols:
+                days_written |= self._process_day(day, sorted(symbols))
 
-        vol_data.append(term)
+        if build_surfaces:
+            self._build_vol_surfaces(days_written)
 
-        # print("OPTION VOL", vol_data)
-        return vol_data
+        return days_written
 
-    def _insert_missing_vol_row(self, option_vol_row: list) -> None:
-        """ Insert the given row into the historic vol database table
+    def _version_table(self, version: int) -> str:
+        """ Name of the table holding a recomputed vol dataset; version 0 is the original table
         """
 
-        now = datetime.utcnow()
+        return f"{self.deribit_ohlcv_vol}_V{version}"
+
+    def _version_table_storage(self) -> str:
+        """ The live table's WAL and DEDUP clauses, so a version swapped in keeps them
+        """
+
+        wal, dedup = get_table_storage(self.db_cursor, self.deribit_ohlcv_vol)
+
+        if dedup:
+            return f" WAL DEDUP UPSERT KEYS({', '.join(VOL_UPSERT_KEYS)})"
+
+        return ' WAL' if wal else ''
+
+    def _check_vol_versions_table_exists(self) -> None:
+        """ IF Vol Versions registry table does not exist, then create it
+        """
+
+        self.db_cursor.execute(f'''CREATE TABLE IF NOT EXISTS {VOL_VERSIONS_TABLE} (
+                                    ts TIMESTAMP,
+                                    Version INT NOT NULL,
+                                    TableName STRING NOT NULL,
+                                    RiskFreeRate FLOAT,
+                                    DeltaPrecision FLOAT,
+                                    Status STRING NOT NULL
+                            ) timestamp(ts);''')
+
+    def _get_vol_versions(self) -> dict:
+        """ Latest status of each registered vol version; version -> (table name, status)
+        """
+
+        self.db_cursor.execute(f'''SELECT Version, TableName, Status FROM {VOL_VERSIONS_TABLE};''')
+
+        # table is in ts order, so the last row for a version is its current status
+        return {version: (table_name, status) for version, table_name, status in self.db_cursor.fetchall()}
+
+    def _set_vol_version_status(self, version: int, status: str) -> None:
 
         self.db_cursor.execute(f'''
-                                INSERT INTO {self.deribit_ohlcv_vol}
-                                VALUES(%s, 
-                                        %s, %s, 
-                                        %s, %s, %s,
-                                        %s, %s, %s, 
-                                        %s, %s, %s,
-                                        %s, %s);
+                                INSERT INTO {VOL_VERSIONS_TABLE}
+                                VALUES(%s, %s, %s, %s, %s, %s);
                                 ''',
-                               (now,
-                                option_vol_row[1], option_vol_row[2],
-                                option_vol_row[3], option_vol_row[4], option_vol_row[5],
-                                option_vol_row[6], option_vol_row[7], option_vol_row[8],
-                                option_vol_row[9], option_vol_row[10], option_vol_row[11],
-                                option_vol_row[12], option_vol_row[13])
-                               )
-
-    def _process_year_month(self, year: int, month: int) -> None:
-        """ Process the price data for the given year and month to find implied vols for options
+                               (datetime.utcnow(), version, self._version_table(version),
+                                self.risk_free_rate, self.delta_precision, status))
+        self.db_connection.commit()
+
+    def _recompute_vol_data(self, version: int, run_year: int=None, run_month: int=None) -> None:
+        """ Recompute the complete vol dataset, using the current calculation settings
+            (risk_free_rate, delta_precision etc), into a fresh table tagged with the given calc version.
+
+            Existing vols are not skipped; every option with a futures curve is solved across a pool
+            of solver processes and written with bulk inserts. The live table is untouched until
+            the version is swapped in with _swap_vol_version.
         """
 
+        self._check_vol_versions_table_exists()
 
+        version_status = self._get_vol_versions().get(version, (None, None))[1]
+        if version_status not in (None, 'building'):
+            raise ValueError(f"vol version {version} already exists with status {version_status}")
 
-        future_curves, missing_option_vols = self._get_missing_historic_vols(year, month)
+        table_name = self._version_table(version)
 
-        if not future_curves:
-            return
+        # a previously interrupted build is started again from scratch
+        self.db_cursor.execute(f'''DROP TABLE IF EXISTS {table_name};''')
+        self._create_vol_table(table_name, self._version_table_storage())
+        self._set_vol_version_status(version, 'building')
 
-        self.info_logger(f"PROCESSING YEAR {year} MONTH {month}")
-        # print("FUTURE KEYS", list(future_curves.keys())[:50])
+        years, months = self._years_and_months(run_year, run_month)
+        workers = self.vol_config['solver_workers'] or os.cpu_count()
 
-        failed = 0
-        succeded = 0
+        self.info_logger(f"STARTING VOL RECOMPUTE V{version} INTO {table_name}: years: {years} months: {months} "
+                         f"risk_free_rate: {self.risk_free_rate} delta_precision: {self.delta_precision} workers: {workers}")
 
-        for i, option_price in enumerate(missing_option_vols):
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_solver_worker,
+                                 initargs=(self.risk_free_rate, self.delta_precision)) as executor:
 
-            missing_vol_data = self._calculate_missing_vol_data(future_curves, option_price)
+            for year in years:
+                for month in months:
+                    future_curves, option_price_chunks = self._get_historic_price_data(year, month)
 
-            if missing_vol_data:
-                # Only add rows where a Vol/delta etc was successfully calculated
+                    if not future_curves:
+                        continue
 
-                # Capture first few columns shared between prices and vols
-                # ts, exchange, symbol, close day, close datetime, timestamp
-                option_vol = list(option_price[:6])
-                # print("OPTION VOL", option_vol)
-                # Add on vol results [open/close: vol, strike_pct, delta]
-                option_vol += missing_vol_data
-                # Add residual elements of record [volume]
-                option_vol.append(option_price[10])
+                    self.info_logger(f"RECOMPUTING YEAR {year} MONTH {month}")
 
-                self._insert_missing_vol_row(option_vol)
-                succeded += 1
-            else:
-                failed += 1
+                    succeded, failed, rejected = 0, 0, 0
+                    in_flight = queue.Queue()
 
-            if (i + 1) % 1000 == 0:
-                # Commit updates as we go along...
-                self.db_connection.commit()
-                # print("PROCESSED VOLS", i + 1, "out of", len(missing_option_vols), "with", succeded, "writes and",
-                #       failed, "skipped (term=0 or vol>400)")
+                    def _write_solved_chunk():
+                        nonlocal succeded, failed, rejected
 
-        # Finish off any residual commits
-        self.db_connection.commit()
-        # print("PROCESSED VOLS", len(missing_option_vols), "out of", len(missing_option_vols))
-        self.info_logger(f"TOTAL OF {succeded} WRITES AND {failed} SKIPPED (probably already existing, term=0 or vol>400)")
+                        vol_rows, chunk_failed, chunk_rejected = in_flight.get().result()
+                        if vol_rows:
+                            with instrumentation.stage(DB_WRITE, count=len(vol_rows)):
+                                self._insert_vol_rows(vol_rows, table_name)
+                                self.db_connection.commit()
 
-    def info_logger(self, message):
+                        succeded += len(vol_rows)
+                        failed += chunk_failed
+                        rejected += sum(chunk_rejected.values())
+                        instrumentation.count('deribit', ROWS_INSERTED, len(vol_rows))
 
-        logger.info(message)
-        print("LOG", message)
+                    for option_prices in self._missing_option_chunks(future_curves, option_price_chunks, skip_existing=False):
+                        # only ship each chunk the curves it needs (chunks never span days)
+                        chunk_curves = {future_key: future_curves[future_key] for future_key in
+                                        {self._future_key_from_record(option_price) for option_price in option_prices}}
+                        in_flight.put(executor.submit(_solve_in_worker, (chunk_curves, option_prices)))
+                        instrumentation.count('deribit', ROWS_FETCHED, len(option_prices))
 
-    def _update_historic_vol_data(self, run_year: int=None, run_month: int=None) -> None:
-        """ Iterate through all the option & future price data that we have,
-            inserting any data missing from the Vol History table -y
+                        # keep the pool busy without holding the whole month of chunks in memory
+                        if in_flight.qsize() >= 2 * workers:
+                            _write_solved_chunk()
+                            self._check_memory_ceiling()
+
+                    while not in_flight.empty():
+                        _write_solved_chunk()
+
+                    self.info_logger(f"RECOMPUTED {succeded} VOLS, {failed} FAILED SOLVES, {rejected} REJECTED BEFORE SOLVING")
+
+        self._set_vol_version_status(version, 'complete')
+        self.info_logger(f"VOL RECOMPUTE V{version} COMPLETE")
+
+    def _swap_vol_version(self, version: int) -> None:
+        """ Swap a completed recompute version in as the live vol table.
+            The live table is kept, renamed to its own version table, so the swap can be reversed.
+
+            QuestDB has no transactional DDL, so the swap is two back to back renames;
+            the live table name is missing only for the instant between them.
         """
 
-        years = [2017, 2018, 2019, 2020, 2021, 2022, 2023, 2024]
-        months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+        self._check_vol_versions_table_exists()
+        versions = self._get_vol_versions()
 
-        if run_year and not run_month:
-            years = [run_year]
-            months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+        # a retired version is swapped back in the same way, reversing an earlier swap
+        if versions.get(version, (None, None))[1] not in ('complete', 'retired'):
+            raise ValueError(f"vol version {version} is not a completed recompute")
 
-        if run_year and run_month:
-            years = [run_year]
-            months = [run_month]
+        live_versions = [live_version for live_version, (_, status) in versions.items() if status == 'live']
+        # the original (never recomputed) table is version 0
+        live_version = max(live_versions) if live_versions else 0
 
-        self.info_logger(f"STARTING DeribitVolUpdate: years: {years} months: {months}")
+        # e.g. a version built before the DEDUP migration; swapped in, duplicates would come back
+        live_storage = get_table_storage(self.db_cursor, self.deribit_ohlcv_vol)
+        version_storage = get_table_storage(self.db_cursor, self._version_table(version))
+        if live_storage != version_storage:
+            raise ValueError(f"vol version {version} is not stored as the live table is (WAL, DEDUP {version_storage} "
+                             f"against {live_storage}); recompute it as a new version with -r <version>")
+
+        self.db_cursor.execute(f'''RENAME TABLE {self.deribit_ohlcv_vol} TO {self._version_table(live_version)};''')
+        self.db_cursor.execute(f'''RENAME TABLE {self._version_table(version)} TO {self.deribit_ohlcv_vol};''')
+        self.db_connection.commit()
 
-        for year in years:
-            for month in months:
-                self._process_year_month(year, month)
+        self._set_vol_version_status(live_version, 'retired')
+        self._set_vol_version_status(version, 'live')
+        self.info_logger(f"VOL VERSION {version} IS NOW LIVE; PREVIOUS VERSION {live_version} RETIRED TO {self._version_table(live_version)}")
+        self.info_logger(f"THE OPTION CHAIN STILL HOLDS VERSION {live_version} VOLS; REBUILD IT WITH 'python OptionChainSnapshot.py -y <year>'")
 
 
 def get_args(argv):
 
-    opts, args = getopt.getopt(argv,"-hy:m:", ["year=", "month="])
+    opts, args = getopt.getopt(argv,"-hy:m:r:s:p", ["year=", "month=", "recompute=", "swap=", "profile"])
 
     year = None
     month = None
+    recompute = None
+    swap = None
+    profile = False
 
     for opt, arg in opts:
         if opt == '-h':
-            print ('python3 -m DeribitPriceHistoryDBGateway -h -y <2023> -m <6>')
+            print ('python3 -m DeribitVolHistoryDBUpdate -h -y <2023> -m <6> -r <recompute version> -s <swap in version> -p (--profile)')
             sys.exit()
 
+        if opt in ("-p", "--profile"):
+            profile = True
+
+        if opt in ("-r", "--recompute", "-s", "--swap"):
+            try:
+                version = int(arg)
+            except Exception as e:
+                print(f'error {e}; version must be format <2>')
+                sys.exit()
+
+            if opt in ("-r", "--recompute"):
+                recompute = version
+            else:
+                swap = version
+
         if opt in ("-y", "--year"):
             try:
                 year = int(arg)
@@ -672,18 +847,26 @@ def get_args(argv):
         print(f'error; month can only be provided if year is also provided')
         sys.exit()
 
-    return year, month
+    return year, month, recompute, swap, profile
 
 
 if __name__ == "__main__":
 
-    year, month = get_args(sys.argv[1:])
+    year, month, recompute, swap, profile = get_args(sys.argv[1:])
+
+    instrumentation.start_run('DeribitVolHistoryDBUpdate', profile)
 
     # print("STARTING HISTORIC VOL UPDATES")
 
     deribit_history = DeribitVolHistoryDBUpdate()
 
-    deribit_history._update_historic_vol_data(year, month)
+    if recompute is not None:
+        deribit_history._recompute_vol_data(recompute, year, month)
+    elif swap is None:
+        deribit_history._update_historic_vol_data(year, month)
+
+    if swap is not None:
+        deribit_history._swap_vol_version(swap)
 
     # print("FINISHED HISTORIC VOL UPDATES")
 
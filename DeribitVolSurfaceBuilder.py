@@ -0,0 +1,370 @@
+from datetime import datetime, timedelta
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import logging, os, sys, getopt
+import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool, load_config
+from DeribitInstruments import InstrumentCache
+
+
+logger = logging.getLogger('DERIBIT VOL SURFACE')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('deribit_vol_surface.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+# Surface grid; deltas are forward call deltas, so 0.75 is the 25 delta put
+DELTA_GRID = np.array([0.10, 0.25, 0.50, 0.75, 0.90])
+# Surface grid; tenors are calendar days
+TENOR_GRID = np.array([7, 14, 30, 60, 90, 180, 365])
+
+VOL_SURFACE_TABLE = 'VOL_SURFACE'
+# a grid point; a day's rebuild replaces its old grid
+VOL_SURFACE_UPSERT_KEYS = ['ExchangeDay', 'Exchange', 'Underlying', 'Tenor', 'Delta']
+
+# fewest strikes we will fit a 5 parameter SVI smile to
+MIN_SMILE_POINTS = 6
+# log-moneyness grid (in units of ATM standard deviation) used for arbitrage checks and delta resampling
+STD_DEV_GRID = np.linspace(-6.0, 6.0, 481)
+
+
+def check_vol_surface_table_exists(cursor, table: str = VOL_SURFACE_TABLE) -> None:
+    """ IF Vol Surface table does not exist, then create it; a partition per day, so a day can be rebuilt in place
+    """
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                        ts TIMESTAMP,
+                        Exchange  SYMBOL CAPACITY 256 CACHE,
+                        Underlying  SYMBOL CAPACITY 256 CACHE,
+                        ExchangeDay TIMESTAMP NOT NULL,
+                        Tenor INT NOT NULL,
+                        Delta FLOAT NOT NULL,
+                        Vol FLOAT NOT NULL
+                ) timestamp(ExchangeDay) PARTITION BY DAY WAL
+                DEDUP UPSERT KEYS({', '.join(VOL_SURFACE_UPSERT_KEYS)});''')
+
+
+def svi_total_variance(params: np.ndarray, k: np.ndarray) -> np.ndarray:
+    """ Raw SVI total implied variance w(k) = a + b(rho(k - m) + sqrt((k - m)^2 + sigma^2))
+    """
+    a, b, rho, m, sigma = params
+    return a + b * (rho * (k - m) + np.sqrt((k - m) ** 2 + sigma ** 2))
+
+
+def fit_svi_smile(k: np.ndarray, w: np.ndarray) -> np.ndarray:
+    """ Least squares fit of a raw SVI smile to log-moneyness k and total variance w.
+        Returns the parameters [a, b, rho, m, sigma] or None if the fit fails.
+    """
+
+    # scipy is only imported by the processes that fit; importing DeribitVolSurfaceBuilder stays cheap
+    from scipy.optimize import least_squares
+
+    w_min = float(w.min())
+    k_at_min = float(k[np.argmin(w)])
+
+    initial = np.array([0.9 * w_min, 0.1, -0.3, k_at_min, 0.1])
+    lower = np.array([-w.max(), 0.0, -0.999, k.min() - 1.0, 1e-4])
+    upper = np.array([w.max(), 2.0, 0.999, k.max() + 1.0, 5.0])
+
+    try:
+        result = least_squares(lambda params: svi_total_variance(params, k) - w,
+                               np.clip(initial, lower, upper), bounds=(lower, upper), method='trf')
+    except ValueError:
+        return None
+
+    if not result.success:
+        return None
+
+    return result.x
+
+
+def svi_is_arbitrage_free(params: np.ndarray, k: np.ndarray) -> bool:
+    """ Sanity check a fitted smile;
+        - total variance must stay positive,
+        - wings must satisfy Roger Lee's moment bound b(1 + |rho|) <= 2,
+        - Gatheral's butterfly density g(k) must be non-negative across k.
+    """
+
+    a, b, rho, m, sigma = params
+
+    if a + b * sigma * np.sqrt(1 - rho ** 2) <= 0:
+        return False
+
+    if b * (1 + abs(rho)) > 2:
+        return False
+
+    x = k - m
+    root = np.sqrt(x ** 2 + sigma ** 2)
+    w = a + b * (rho * x + root)
+    dw = b * (rho + x / root)
+    d2w = b * sigma ** 2 / root ** 3
+
+    g = (1 - k * dw / (2 * w)) ** 2 - (dw ** 2 / 4) * (1 / w + 0.25) + d2w / 2
+
+    return bool(np.all(w > 0) and np.all(g >= -1e-8))
+
+
+def delta_slice(params: np.ndarray) -> np.ndarray:
+    """ Resample a fitted smile onto the delta grid, returning the total variance at each grid delta
+        or None if the smile cannot be resampled.
+    """
+
+    from scipy.special import ndtr
+
+    w_atm = max(float(svi_total_variance(params, np.zeros(1))[0]), 1e-8)
+    k = STD_DEV_GRID * np.sqrt(w_atm)
+
+    if not svi_is_arbitrage_free(params, k):
+        return None
+
+    w = svi_total_variance(params, k)
+
+    # forward call delta (zero rates) N(d1), which decreases as strike increases
+    call_delta = ndtr((-k + w / 2) / np.sqrt(w))
+
+    if np.any(np.diff(call_delta) > 0):
+        return None
+
+    # np.interp requires increasing x, so work from the high strike end
+    k_at_delta = np.interp(DELTA_GRID, call_delta[::-1], k[::-1])
+
+    return svi_total_variance(params, k_at_delta)
+
+
+def fit_day_surface(payload: tuple) -> list:
+    """ Fit each expiry smile for a single (day, exchange, underlying) and resample onto the
+        delta x tenor grid. Module level, so it can be farmed out to worker processes.
+
+        :param payload: (day, exchange, underlying, [(term, log_moneyness, total_variance), ...])
+
+        Returns a list of (exchange, underlying, day, tenor, delta, vol%) grid rows
+    """
+
+    day, exchange, underlying, smiles = payload
+
+    terms = []
+    slices = []
+
+    for term, k, w in sorted(smiles, key=lambda smile: smile[0]):
+
+        if len(k) < MIN_SMILE_POINTS:
+            continue
+
+        params = fit_svi_smile(k, w)
+        if params is None:
+            continue
+
+        w_grid = delta_slice(params)
+        if w_grid is None:
+            continue
+
+        terms.append(term)
+        slices.append(w_grid)
+
+    if not slices:
+        return []
+
+    terms = np.array(terms, dtype=float)
+    # calendar arbitrage; total variance at fixed delta must not fall as tenor increases
+    total_variance = np.maximum.accumulate(np.vstack(slices), axis=0)
+
+    tenors = TENOR_GRID[(TENOR_GRID >= terms[0]) & (TENOR_GRID <= terms[-1])]
+
+    rows = []
+
+    for j, delta in enumerate(DELTA_GRID):
+        w_tenor = np.interp(tenors, terms, total_variance[:, j])
+        vols = 100 * np.sqrt(w_tenor / (tenors / 365))
+
+        for tenor, vol in zip(tenors, vols):
+            rows.append((exchange, underlying, day, int(tenor), float(delta), float(vol)))
+
+    return rows
+
+
+class DeribitVolSurfaceBuilder:
+    """ Builds a per-day volatility surface from the scattered option vols in the OHLCV_VOL table.
+
+        For each (underlying, day, expiry) an SVI smile is fitted to the open fix vols and sanity checked
+        for arbitrage. The smiles are resampled onto a fixed delta x tenor grid, interpolating total variance
+        between expiries, and the grid is written to the VOL_SURFACE table.
+        Days are fitted in parallel across worker processes.
+
+        Rebuilding a day replaces its grid; the day's partition is dropped before the new grid is written.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None, instruments: InstrumentCache = None):
+
+        self.deribit_ohlcv_vol = "OHLCV_VOL"
+        self.vol_surface = VOL_SURFACE_TABLE
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.db_connection = self.db_pool.get_connection()
+        self.db_cursor = self.db_connection.cursor()
+
+        self.instruments = instruments if instruments is not None else InstrumentCache()
+        self.workers: int = self._load_surface_config()['surface_workers'] or os.cpu_count()
+
+        self._check_vol_surface_table_exists()
+
+    def _load_surface_config(self) -> dict:
+        """ Load the (optional) surface settings from the [vol] section of the configuration .toml file
+        """
+
+        return load_config('vol', {'surface_workers': 0})
+
+    def _check_vol_surface_table_exists(self) -> None:
+        """ IF Vol Surface table does not exist, then create it
+        """
+
+        check_vol_surface_table_exists(self.db_cursor, self.vol_surface)
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _get_day_smiles(self, day: str) -> list:
+        """ Load the open fix vols for a single COB date and group them into smiles.
+
+            :param day: the COB date to process as 'YYYY-MM-DD'
+
+            Returns a list of payloads (day, exchange, underlying, [(term, log_moneyness, total_variance), ...])
+        """
+
+        self.db_cursor.execute(f"""SELECT Exchange, MarketSymbol, OpenVol, OpenStrike, Term
+                                   FROM {self.deribit_ohlcv_vol}
+                                   WHERE ExchangeDate IN '{day}'""")
+
+        points = {}
+
+        for exchange, symbol, vol, strike_pct, term in self.db_cursor.fetchall():
+            if not vol or not strike_pct or not term or term <= 0:
+                continue
+
+            underlying = self.instruments.get(symbol).underlying
+            points.setdefault((exchange, underlying), {}).setdefault(term, []).append((strike_pct, vol))
+
+        payloads = []
+
+        for (exchange, underlying), smiles in points.items():
+            day_smiles = []
+
+            for term, strike_vols in smiles.items():
+                strike_vols = np.array(strike_vols, dtype=float)
+                k = np.log(strike_vols[:, 0] / 100)
+                w = (strike_vols[:, 1] / 100) ** 2 * (term / 365)
+                day_smiles.append((term, k, w))
+
+            payloads.append((day, exchange, underlying, day_smiles))
+
+        return payloads
+
+    def _insert_surface_rows(self, rows: list) -> None:
+        """ Bulk insert (and commit) the given surface grid rows, replacing any grid already written for their days
+        """
+
+        now = datetime.utcnow()
+
+        self.db_pool.replace_days(self.vol_surface,
+                                  [(now, exchange, symbol, datetime.strptime(day, '%Y-%m-%d'), *values)
+                                   for exchange, symbol, day, *values in rows],
+                                  VOL_SURFACE_UPSERT_KEYS)
+
+    def _build_surfaces(self, days: list) -> dict:
+        """ Fit and write the surfaces for the given COB dates ('YYYY-MM-DD').
+
+            Returns the grid rows written, keyed by day
+        """
+
+        surfaces = {}
+
+        if not days:
+            return surfaces
+
+        self.info_logger(f"BUILDING VOL SURFACES FOR {len(days)} DAYS WITH {self.workers} WORKERS")
+
+        days = sorted(days)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+
+            # load a batch of days at a time, so memory is bounded but every worker has a day to fit
+            for i in range(0, len(days), self.workers):
+                payloads = []
+
+                for day in days[i:i + self.workers]:
+                    payloads += self._get_day_smiles(day)
+
+                rows = []
+
+                for day_rows in executor.map(fit_day_surface, payloads):
+                    rows += day_rows
+
+                for row in rows:
+                    surfaces.setdefault(row[2], []).append(row)
+
+                if rows:
+                    self._insert_surface_rows(rows)
+
+        self.info_logger(f"VOL SURFACES WRITTEN FOR {len(surfaces)} OUT OF {len(days)} DAYS")
+
+        return surfaces
+
+    def _update_vol_surfaces(self, year: int, month: int) -> dict:
+        """ Build the surfaces for every day in the given year and month
+        """
+
+        day = datetime(year, month, 1)
+        days = []
+
+        while day.month == month:
+            days.append(day.strftime('%Y-%m-%d'))
+            day += timedelta(days=1)
+
+        return self._build_surfaces(days)
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv,"-hy:m:", ["year=", "month="])
+
+    year = None
+    month = None
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('python3 -m DeribitVolSurfaceBuilder -h -y <2023> -m <6>')
+            sys.exit()
+
+        if opt in ("-y", "--year"):
+            try:
+                year = int(arg)
+            except Exception as e:
+                print(f'error {e}; year must be format <2023>')
+                sys.exit()
+
+        if opt in ("-m", "--month"):
+            try:
+                month = int(arg)
+            except Exception as e:
+                print(f'error {e}; month must be format <8>')
+                sys.exit()
+
+    if not (year and month):
+        print(f'error; both year and month must be provided')
+        sys.exit()
+
+    return year, month
+
+
+if __name__ == "__main__":
+
+    year, month = get_args(sys.argv[1:])
+
+    DeribitVolSurfaceBuilder()._update_vol_surfaces(year, month)
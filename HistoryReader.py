@@ -0,0 +1,364 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import pandas as pd
+import logging
+import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool
+from DeribitInstruments import InstrumentCache
+
+
+logger = logging.getLogger('HISTORY READER')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('history_reader.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+OHLCV_TABLE = 'OHLCV'
+OHLCV_VOL_TABLE = 'OHLCV_VOL'
+OPTION_CHAIN_TABLE = 'OPTION_CHAIN'
+
+# the columns read for each table; every read is projected to (at most) these
+OHLCV_COLUMNS = ['ExchangeDate', 'Exchange', 'MarketSymbol', 'Open', 'High', 'Low', 'Close', 'Volume']
+OHLCV_VOL_COLUMNS = ['ExchangeDate', 'Exchange', 'MarketSymbol',
+                     'OpenVol', 'OpenStrike', 'OpenDelta', 'CloseVol', 'CloseStrike', 'CloseDelta', 'Term', 'Volume',
+                     'OpenGamma', 'OpenVega', 'OpenTheta', 'CloseGamma', 'CloseVega', 'CloseTheta']
+OPTION_CHAIN_COLUMNS = ['ExchangeDay', 'Exchange', 'Underlying', 'MarketSymbol', 'Expiry', 'Strike', 'OptionType', 'Term',
+                        'OpenPrice', 'ClosePrice', 'OpenForward', 'CloseForward', 'OpenVol', 'CloseVol', 'OpenDelta', 'CloseDelta', 'Volume']
+TABLE_COLUMNS = {OHLCV_TABLE: OHLCV_COLUMNS, OHLCV_VOL_TABLE: OHLCV_VOL_COLUMNS, OPTION_CHAIN_TABLE: OPTION_CHAIN_COLUMNS}
+
+# column types of an empty read
+DATETIME_COLUMNS = ['ExchangeDate', 'ExchangeDay', 'Expiry']
+CATEGORY_COLUMNS = ['Exchange', 'MarketSymbol', 'Underlying', 'OptionType']
+
+# candle aggregation of the daily prices into longer timeframes (weeks start on a Monday)
+TIMEFRAMES = {'1d': None, '1w': 'W-MON', '1M': 'MS'}
+OHLCV_AGGREGATION = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+# symbols per IN (...) list when reading selected symbols
+SYMBOL_BATCH_SIZE = 500
+
+DEFAULT_CACHE_MB = 256
+
+
+class PartitionCache:
+    """ Size bounded, least recently used cache of DataFrames for immutable (historical) partitions
+    """
+
+    def __init__(self, max_mb: int = DEFAULT_CACHE_MB):
+
+        self.max_bytes: int = max_mb * 1024 * 1024
+        self.size_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._frames: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key) -> pd.DataFrame:
+
+        with self._lock:
+            frame = self._frames.get(key)
+
+            if frame is None:
+                self.misses += 1
+                return None
+
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame: pd.DataFrame) -> None:
+
+        frame_bytes = int(frame.memory_usage(index=True, deep=True).sum())
+
+        if frame_bytes > self.max_bytes:
+            # never worth evicting everything else for
+            return
+
+        with self._lock:
+            if key in self._frames:
+                self.size_bytes -= self._frames.pop(key).attrs['cache_bytes']
+
+            frame.attrs['cache_bytes'] = frame_bytes
+            self._frames[key] = frame
+            self.size_bytes += frame_bytes
+
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.size_bytes -= evicted.attrs['cache_bytes']
+
+    def clear(self) -> None:
+
+        with self._lock:
+            self._frames.clear()
+            self.size_bytes = 0
+
+
+class HistoryReader:
+    """ Columnar (pandas) reads of the price and vol history.
+
+            get_ohlcv(symbols, start, end, timeframe)   daily candles, or aggregated to weekly/monthly
+            get_vols(symbols, start, end)               implied vols, strikes, deltas and greeks
+            get_chain(token, day)                       the option chain (prices, forwards and vols) for an underlying on a day
+
+        Reads are made a monthly partition at a time, projected to the table's columns and restricted on the
+        designated timestamp (ExchangeDate), so QuestDB only touches the partitions asked for.
+        Months before the current one are treated as immutable and cached (LRU, bounded by size), so
+        repeated reads of history are served from memory; the current month is always read afresh.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None, cache_mb: int = DEFAULT_CACHE_MB):
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.cache = PartitionCache(cache_mb)
+        self.instruments = InstrumentCache()
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _months(self, start: datetime, end: datetime) -> list:
+        """ 'YYYY-MM' of every month overlapping [start, end]
+        """
+
+        months = []
+        year, month = start.year, start.month
+
+        while (year, month) <= (end.year, end.month):
+            months.append(f"{year}-{month:02}")
+            year, month = year + month // 12, month % 12 + 1
+
+        return months
+
+    def _is_immutable(self, month: str) -> bool:
+
+        return month < datetime.utcnow().strftime('%Y-%m')
+
+    def _read_frame(self, table: str, where_clause: str, params: tuple = None) -> pd.DataFrame:
+        """ Read the table's projected columns for the given predicate into a DataFrame
+        """
+
+        columns = TABLE_COLUMNS[table]
+        query = f"""SELECT {', '.join(columns)} FROM {table} WHERE {where_clause}"""
+
+        chunks = [pd.DataFrame.from_records(rows, columns=columns) for rows in self.db_pool.bulk_read(query, params)]
+
+        if not chunks:
+            return self._read_frame_template(table)
+
+        frame = pd.concat(chunks, ignore_index=True)
+
+        # symbols repeat on every row, so are held as categories
+        frame['Exchange'] = frame['Exchange'].astype('category')
+        frame['MarketSymbol'] = frame['MarketSymbol'].astype('category')
+
+        return frame
+
+    def _read_month(self, table: str, month: str, exchange: str = None, symbols: list = None) -> pd.DataFrame:
+        """ The rows of a single monthly partition, for the given symbols (or all of them).
+            Immutable months are cached per symbol (or as a whole, when all symbols are read).
+        """
+
+        immutable = self._is_immutable(month)
+        where_clause = f"ExchangeDate IN '{month}'"
+        params = ()
+
+        if exchange:
+            where_clause += " AND Exchange = %s"
+            params += (exchange,)
+
+        if symbols is None:
+            key = (table, month, exchange, None)
+            frame = self.cache.get(key) if immutable else None
+
+            if frame is None:
+                frame = self._read_frame(table, where_clause, params)
+                if immutable:
+                    self.cache.put(key, frame)
+
+            return frame
+
+        frames = []
+        missing = []
+
+        for symbol in symbols:
+            frame = self.cache.get((table, month, exchange, symbol)) if immutable else None
+
+            if frame is None:
+                missing.append(symbol)
+            else:
+                frames.append(frame)
+
+        # everything not already held is read in batches, and split back out by symbol for the cache
+        for i in range(0, len(missing), SYMBOL_BATCH_SIZE):
+            batch = missing[i:i + SYMBOL_BATCH_SIZE]
+            batch_frame = self._read_frame(table,
+                                           where_clause + f" AND MarketSymbol IN ({', '.join(['%s'] * len(batch))})",
+                                           params + tuple(batch))
+
+            if immutable:
+                by_symbol = dict(tuple(batch_frame.groupby('MarketSymbol', observed=True)))
+                for symbol in batch:
+                    self.cache.put((table, month, exchange, symbol),
+                                   by_symbol.get(symbol, batch_frame.iloc[0:0]).reset_index(drop=True))
+
+            frames.append(batch_frame)
+
+        return self._concat(frames, table)
+
+    def _concat(self, frames: list, table: str) -> pd.DataFrame:
+
+        frames = [frame for frame in frames if len(frame)]
+
+        if not frames:
+            return self._read_frame_template(table)
+
+        frame = pd.concat(frames, ignore_index=True)
+
+        # concatenated categories only stay categorical if they match; re-categorise
+        frame['Exchange'] = frame['Exchange'].astype(str).astype('category')
+        frame['MarketSymbol'] = frame['MarketSymbol'].astype(str).astype('category')
+
+        return frame
+
+    def _read_frame_template(self, table: str) -> pd.DataFrame:
+
+        return pd.DataFrame({column: pd.Series(dtype='datetime64[ns]' if column in DATETIME_COLUMNS else
+                                               'category' if column in CATEGORY_COLUMNS else 'float64')
+                             for column in TABLE_COLUMNS[table]})
+
+    def _read_range(self, table: str, symbols, start, end, exchange: str = None) -> pd.DataFrame:
+        """ Rows of the table for [start, end] (dates or 'YYYY-MM-DD'), sorted by symbol and date
+        """
+
+        start, end = pd.Timestamp(start).to_pydatetime(), pd.Timestamp(end).to_pydatetime()
+
+        if isinstance(symbols, str):
+            symbols = [symbols]
+
+        frame = self._concat([self._read_month(table, month, exchange, symbols) for month in self._months(start, end)], table)
+
+        # the whole of 'end' is included when it is given as a date
+        if end == datetime(end.year, end.month, end.day):
+            end += timedelta(days=1) - timedelta(microseconds=1)
+
+        frame = frame[(frame['ExchangeDate'] >= start) & (frame['ExchangeDate'] <= end)]
+
+        return frame.sort_values(['MarketSymbol', 'ExchangeDate'], kind='stable').reset_index(drop=True)
+
+    def get_ohlcv(self, symbols, start, end, timeframe: str = '1d', exchange: str = None) -> pd.DataFrame:
+        """ OHLCV candles for the given symbol(s) between start and end (inclusive).
+
+            :param symbols: a market symbol, a list of them, or None for every symbol
+            :param timeframe: '1d' (as stored), '1w' or '1M'; longer candles are aggregated from the daily ones
+            :param exchange: optionally restrict to a single exchange
+
+            Returns a DataFrame of ExchangeDate, Exchange, MarketSymbol, Open, High, Low, Close, Volume
+        """
+
+        if timeframe not in TIMEFRAMES:
+            raise ValueError(f"timeframe must be one of {list(TIMEFRAMES)}")
+
+        frame = self._read_range(OHLCV_TABLE, symbols, start, end, exchange)
+
+        if TIMEFRAMES[timeframe] is None or frame.empty:
+            return frame
+
+        candles = (frame.set_index('ExchangeDate')
+                   .groupby(['Exchange', 'MarketSymbol'], observed=True)
+                   .resample(TIMEFRAMES[timeframe], label='left', closed='left')
+                   .agg(OHLCV_AGGREGATION)
+                   .dropna(subset=['Open'])
+                   .reset_index())
+
+        return candles[OHLCV_COLUMNS]
+
+    def get_vols(self, symbols, start, end, exchange: str = None) -> pd.DataFrame:
+        """ Implied vols (with strikes, deltas, term and greeks) for the given option symbol(s)
+            between start and end (inclusive); symbols may be None for every option.
+        """
+
+        return self._read_range(OHLCV_VOL_TABLE, symbols, start, end, exchange)
+
+    def get_chain(self, token: str, day, exchange: str = 'deribit') -> pd.DataFrame:
+        """ The option chain for an underlying on a single day, sorted by expiry, strike and call/put.
+
+            :param token: the currency (e.g. 'BTC') or the underlying (e.g. 'BTC/USD:BTC')
+            :param day: the COB date (date or 'YYYY-MM-DD')
+
+            Returns the day's OPTION_CHAIN rows; the Underlying, Expiry, Strike and OptionType of each option,
+            its open/close price (in token terms), forward, vol and delta, and its volume
+        """
+
+        day = pd.Timestamp(day).to_pydatetime()
+
+        # a single day of the designated timestamp; one partition, read as a range
+        where_clause = f"ExchangeDay IN '{day:%Y-%m-%d}'"
+        params = ()
+
+        if exchange:
+            where_clause += " AND Exchange = %s"
+            params += (exchange,)
+
+        if '/' in token:
+            where_clause += " AND Underlying = %s"
+            params += (token,)
+        else:
+            where_clause += " AND Underlying LIKE %s"
+            params += (f"{token}/%",)
+
+        immutable = self._is_immutable(f"{day:%Y-%m}")
+        key = (OPTION_CHAIN_TABLE, f"{day:%Y-%m-%d}", exchange, token)
+        chain = self.cache.get(key) if immutable else None
+
+        if chain is None:
+            chain = self._read_frame(OPTION_CHAIN_TABLE, where_clause, params)
+            chain = chain.sort_values(['Expiry', 'Strike', 'OptionType'], kind='stable').reset_index(drop=True)
+            if immutable:
+                self.cache.put(key, chain)
+
+        return chain
+
+
+_history_reader = None
+
+
+def _get_history_reader() -> HistoryReader:
+
+    global _history_reader
+
+    if _history_reader is None:
+        _history_reader = HistoryReader()
+
+    return _history_reader
+
+
+def get_ohlcv(symbols, start, end, timeframe: str = '1d', exchange: str = None) -> pd.DataFrame:
+    """ See HistoryReader.get_ohlcv; reads through a shared, cached reader
+    """
+
+    return _get_history_reader().get_ohlcv(symbols, start, end, timeframe, exchange)
+
+
+def get_vols(symbols, start, end, exchange: str = None) -> pd.DataFrame:
+    """ See HistoryReader.get_vols; reads through a shared, cached reader
+    """
+
+    return _get_history_reader().get_vols(symbols, start, end, exchange)
+
+
+def get_chain(token: str, day, exchange: str = 'deribit') -> pd.DataFrame:
+    """ See HistoryReader.get_chain; reads through a shared, cached reader
+    """
+
+    return _get_history_reader().get_chain(token, day, exchange)
@@ -0,0 +1,360 @@
+import atexit
+import cProfile
+import functools
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+import logging
+import logging.handlers as handlers
+from DatabaseGateway import get_database_pool
+
+
+logger = logging.getLogger('JOB TIMINGS')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('job_timings.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+# the hot stages shared by the price and vol jobs
+EXCHANGE_FETCH = 'exchange_fetch'
+JSON_PARSE = 'json_parse'
+TRANSFORM = 'transform'
+DB_READ = 'db_read'
+IV_SOLVE = 'iv_solve'
+DB_WRITE = 'db_write'
+STAGES = [EXCHANGE_FETCH, JSON_PARSE, TRANSFORM, DB_READ, IV_SOLVE, DB_WRITE]
+
+# latencies kept per stage for the percentiles; beyond this a uniform (reservoir) sample is kept
+MAX_SAMPLES = 10000
+PERCENTILES = [50, 90, 99]
+
+PROFILE_DIRECTORY = 'profiles'
+
+JOB_RUNS_TABLE = 'JOB_RUNS'
+
+# counted per exchange for the run record
+ROWS_FETCHED = 'rows_fetched'
+ROWS_INSERTED = 'rows_inserted'
+HTTP_CALLS = 'http_calls'
+ERRORS = 'errors'
+COUNTERS = [ROWS_FETCHED, ROWS_INSERTED, HTTP_CALLS, ERRORS]
+
+# the run record's row of totals across exchanges; errors not tied to an exchange are only counted there
+ALL_EXCHANGES = 'ALL'
+
+
+def check_job_runs_table_exists(cursor) -> None:
+    """ IF Job Runs table does not exist, then create it.
+
+        One row per exchange per job run, plus a row of totals (Exchange 'ALL'); start/end times, rows fetched and
+        inserted, HTTP calls, errors, rows inserted per second and peak memory (MB) of the job and of its worker processes.
+    """
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {JOB_RUNS_TABLE} (
+                        ts TIMESTAMP,
+                        Job  SYMBOL CAPACITY 256 CACHE INDEX,
+                        Exchange  SYMBOL CAPACITY 256 CACHE,
+                        Status  SYMBOL CAPACITY 8 CACHE,
+                        StartTime TIMESTAMP NOT NULL,
+                        EndTime TIMESTAMP,
+                        Seconds FLOAT,
+                        RowsFetched LONG,
+                        RowsInserted LONG,
+                        RowsPerSecond FLOAT,
+                        HttpCalls LONG,
+                        Errors LONG,
+                        PeakMemoryMB FLOAT,
+                        PeakWorkerMemoryMB FLOAT
+                ) timestamp(StartTime) PARTITION BY YEAR WAL;''')
+
+
+def peak_memory_mb() -> (float, float):
+    """ Peak resident memory (MB) of this process, and of the largest of its finished worker processes
+    """
+
+    # ru_maxrss is in kilobytes on Linux
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1))
+
+
+class _ErrorCounter(logging.Handler):
+    """ Counts the errors logged anywhere in the process, for the run record
+    """
+
+    def __init__(self, instrumentation):
+
+        super().__init__(logging.ERROR)
+        self.instrumentation = instrumentation
+
+    def emit(self, record) -> None:
+
+        self.instrumentation.count(ALL_EXCHANGES, ERRORS)
+
+
+class StageStats:
+    """ Call count, total time and a bounded sample of latencies (seconds) for one stage
+    """
+
+    __slots__ = ('count', 'total', 'samples', 'calls')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = []
+        self.calls = 0
+
+    def add(self, seconds: float, count: int) -> None:
+
+        self.count += count
+        self.total += seconds
+        self.calls += 1
+
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.calls)
+            if i < MAX_SAMPLES:
+                self.samples[i] = seconds
+
+    def percentile(self, pct: int) -> float:
+
+        if not self.samples:
+            return 0.0
+
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class _StageTimer:
+    """ Context manager timing a single pass through a stage
+    """
+
+    __slots__ = ('instrumentation', 'stage', 'count', 'start')
+
+    def __init__(self, instrumentation, stage: str, count: int):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self.stage, time.perf_counter() - self.start, self.count)
+        return False
+
+
+class JobInstrumentation:
+    """ Lightweight per-stage timing for the price and vol jobs.
+
+        Wrap a hot stage with
+
+            with instrumentation.stage(DB_WRITE, count=len(rows)):
+                ...
+
+        or decorate a function with @timed(DB_READ). Every stage records a count (calls, or the rows
+        given), the total time and latency percentiles. start_run() writes the summary for the run
+        at exit and, if asked, profiles the whole run with cProfile.
+
+        Rows fetched and inserted and HTTP calls are counted per exchange with count(); with the errors logged,
+        the run's duration and peak memory they make the run's record in JOB_RUNS (write_run_record).
+    """
+
+    def __init__(self):
+
+        self._stats: dict = {}
+        self._counters: dict = {}
+        self._error_counter = None
+        self._lock = threading.Lock()
+        self._job_name = None
+        self._started = None
+        self._failed = False
+        self._profiler = None
+
+    def stage(self, stage: str, count: int = 1) -> _StageTimer:
+
+        return _StageTimer(self, stage, count)
+
+    def record(self, stage: str, seconds: float, count: int = 1) -> None:
+
+        # the vol job reads on a prefetch thread while the main thread solves
+        with self._lock:
+            stats = self._stats.get(stage)
+            if stats is None:
+                stats = self._stats[stage] = StageStats()
+            stats.add(seconds, count)
+
+    def count(self, exchange: str, counter: str, value: int = 1) -> None:
+        """ Add to one of the run record's counters (ROWS_FETCHED, ROWS_INSERTED, HTTP_CALLS, ERRORS) for an exchange
+        """
+
+        with self._lock:
+            exchange_counters = self._counters.get(exchange)
+            if exchange_counters is None:
+                exchange_counters = self._counters[exchange] = dict.fromkeys(COUNTERS, 0)
+            exchange_counters[counter] += value
+
+    def watch_errors(self) -> None:
+        """ Count every error logged in the process (through the root logger) towards the run record
+        """
+
+        if self._error_counter is None:
+            self._error_counter = _ErrorCounter(self)
+            logging.getLogger().addHandler(self._error_counter)
+
+    def reset(self) -> None:
+
+        with self._lock:
+            self._stats = {}
+            self._counters = {}
+
+    def summary(self) -> list:
+        """ One line per stage recorded; count, calls, total seconds and latency percentiles in ms
+        """
+
+        lines = []
+
+        with self._lock:
+            # the known stages first, in pipeline order, then anything else recorded
+            stages = [stage for stage in STAGES if stage in self._stats]
+            stages += sorted(stage for stage in self._stats if stage not in STAGES)
+
+            for stage in stages:
+                stats = self._stats[stage]
+                percentiles = " ".join(f"p{pct}={stats.percentile(pct) * 1000:.2f}ms" for pct in PERCENTILES)
+                lines.append(f"{stage:<15} count={stats.count} calls={stats.calls} total={stats.total:.3f}s {percentiles}")
+
+        return lines
+
+    def start_run(self, job_name: str, profile: bool = False) -> None:
+        """ Mark the start of a job run; the timing summary is written when the process exits.
+            With profile set the run is also profiled and the stats dumped to
+            profiles/<job>_<YYYYmmdd_HHMMSS>.prof (pstats format; view with snakeviz, or
+            convert to a flamegraph with flameprof/gprof2dot).
+        """
+
+        if self._job_name is not None:
+            # jobs chain (price update then vol update); the first one owns the run
+            return
+
+        self._job_name = job_name
+        self._started = datetime.utcnow()
+
+        if profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+        self.watch_errors()
+
+        # a job that dies of an exception is recorded as failed
+        excepthook = sys.excepthook
+
+        def _failed_run(*args):
+            self._failed = True
+            self.count(ALL_EXCHANGES, ERRORS)
+            excepthook(*args)
+
+        sys.excepthook = _failed_run
+
+        # the pool is opened before _end_run is registered, so it is still open (atexit runs last in, first out)
+        # when the run record is written
+        get_database_pool()
+
+        atexit.register(self._end_run)
+
+    def _end_run(self) -> None:
+
+        if self._profiler:
+            self._profiler.disable()
+            os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+            profile_file = os.path.join(PROFILE_DIRECTORY, f"{self._job_name}_{self._started.strftime('%Y%m%d_%H%M%S')}.prof")
+            self._profiler.dump_stats(profile_file)
+            logger.info(f"PROFILE WRITTEN TO {profile_file}")
+
+        elapsed = (datetime.utcnow() - self._started).total_seconds()
+        logger.info(f"TIMING SUMMARY FOR {self._job_name} RUN STARTED {self._started:%Y-%m-%d %H:%M:%S} ELAPSED {elapsed:.1f}s")
+
+        for line in self.summary():
+            logger.info(line)
+
+        self.write_run_record(self._job_name, self._started, datetime.utcnow(), 'failed' if self._failed else 'succeeded')
+
+    def run_rows(self, job_name: str, started: datetime, finished: datetime, status: str) -> list:
+        """ The JOB_RUNS rows for a run; one per exchange counted, and the totals
+        """
+
+        seconds = (finished - started).total_seconds()
+        peak_memory, peak_worker_memory = peak_memory_mb()
+
+        with self._lock:
+            counters = {exchange: dict(exchange_counters) for exchange, exchange_counters in self._counters.items()}
+
+        totals = dict.fromkeys(COUNTERS, 0)
+        for exchange, exchange_counters in counters.items():
+            for counter, value in exchange_counters.items():
+                totals[counter] += value
+
+        now = datetime.utcnow()
+        rows = []
+
+        exchanges = [(exchange, exchange_counters) for exchange, exchange_counters in sorted(counters.items()) if exchange != ALL_EXCHANGES]
+
+        for exchange, exchange_counters in exchanges + [(ALL_EXCHANGES, totals)]:
+            rows.append((now, job_name, exchange, status, started, finished, round(seconds, 3),
+                         exchange_counters[ROWS_FETCHED], exchange_counters[ROWS_INSERTED],
+                         round(exchange_counters[ROWS_INSERTED] / seconds, 1) if seconds else 0.0,
+                         exchange_counters[HTTP_CALLS], exchange_counters[ERRORS], peak_memory, peak_worker_memory))
+
+        return rows
+
+    def write_run_record(self, job_name: str, started: datetime, finished: datetime, status: str) -> None:
+        """ Write the run's rows to JOB_RUNS. A failure to write is logged, never raised; the job's own work is done
+        """
+
+        rows = self.run_rows(job_name, started, finished, status)
+
+        try:
+            db_pool = get_database_pool()
+            with db_pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    check_job_runs_table_exists(cursor)
+                connection.commit()
+            db_pool.bulk_write(JOB_RUNS_TABLE, rows)
+        except Exception as e:
+            logger.warning(f"RUN RECORD NOT WRITTEN FOR {job_name}: {e}")
+            return
+
+        totals = rows[-1]
+        logger.info(f"RUN RECORD WRITTEN FOR {job_name}: {status} {totals[7]} ROWS FETCHED {totals[8]} INSERTED "
+                    f"({totals[9]} ROWS/s) {totals[10]} HTTP CALLS {totals[11]} ERRORS PEAK {totals[12]}MB")
+
+
+# shared by every job running in the process
+instrumentation = JobInstrumentation()
+
+
+def timed(stage: str):
+    """ Decorator timing every call of the wrapped function as the given stage
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with instrumentation.stage(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,415 @@
+import fcntl
+import json
+import os
+import signal
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+import threading
+import logging, sys, getopt
+import logging.handlers as handlers
+import CryptoPriceDBGateway
+from DatabaseGateway import DatabasePool, get_database_pool, load_config
+from DeribitPriceHistoryDBGateway import DeribitPriceHistoryDBGateway
+from DeribitVolHistoryDBUpdate import DeribitVolHistoryDBUpdate
+from JobInstrumentation import instrumentation
+
+
+logger = logging.getLogger('JOB SCHEDULER')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('job_scheduler.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+DEFAULT_SCHEDULER_CONFIG = {'run_at': '10:00', 'max_parallel_jobs': 2,
+                            'state_file': 'scheduler_state.json', 'lock_file': 'scheduler.lock'}
+
+# job states
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# a job of the daily run; run(inputs) is given the results of the jobs it depends on, by name.
+# It also waits for the jobs it runs 'after', but runs whether or not they succeeded
+Job = namedtuple('Job', ['name', 'depends_on', 'run', 'after'], defaults=[()])
+
+
+class JobScheduler:
+    """ Long running replacement for the cron entry; runs the daily jobs in one warm process.
+
+        The daily run is a dependency graph rather than a fixed timetable, and each job starts as soon
+        as the jobs it depends on have finished (independent jobs run side by side);
+
+            ingest   live prices of every configured exchange (CryptoPriceDBGateway)
+            history  expired deribit instruments' prices since the last run (DeribitPriceHistoryDBGateway)
+            vol      vols for the prices written by ingest and history (DeribitVolHistoryDBUpdate)
+            metrics  vol surfaces and VOL_METRICS for the days just given vols
+
+        A job that fails is recorded and the jobs that depend on it are skipped; vol depends on ingest, and runs
+        after history whether or not history succeeded. The keys of the prices ingest and history write (including
+        those written before a failure) are held in the state file until vol has processed them, so prices written
+        by a run whose vol job failed or was skipped are given vols by the next run. The database pool, the ccxt
+        exchanges (with their sessions) and the vol job (instrument cache, QuantLib) stay loaded between runs.
+
+        A run holds an exclusive lock on 'lock_file', so runs never overlap, even across processes.
+        The state, start, finish and duration of each job's last run are kept in 'state_file' (see -s),
+        and every run's throughput is recorded in JOB_RUNS (see JobInstrumentation.write_run_record).
+    """
+
+    def __init__(self, db_pool: DatabasePool = None):
+
+        config = load_config('scheduler', DEFAULT_SCHEDULER_CONFIG)
+        self.run_at = datetime.strptime(config['run_at'], '%H:%M').time()
+        self.max_parallel_jobs: int = config['max_parallel_jobs']
+        self.state_file: str = config['state_file']
+        self.lock_file: str = config['lock_file']
+
+        self.jobs = [Job('ingest', [], self._ingest),
+                     Job('history', [], self._history),
+                     Job('vol', ['ingest'], self._vol, ['history']),
+                     Job('metrics', ['vol'], self._metrics)]
+        self._check_jobs()
+
+        self.state: dict = load_state(self.state_file)
+        self._state_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        # errors logged by any job count towards the run's record in JOB_RUNS
+        instrumentation.watch_errors()
+
+        # the ingest job's logger is only set up when it is run as a script
+        self.markets_config: dict = {}
+        logging_config: dict = {}
+        CryptoPriceDBGateway.load_config(self.markets_config, logging_config)
+        CryptoPriceDBGateway.logger = CryptoPriceDBGateway.set_up_logger(logging_config)
+
+        # kept warm between runs
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.exchanges: dict = {}
+        self.vol_update = DeribitVolHistoryDBUpdate(self.db_pool)
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _check_jobs(self) -> None:
+        """ Every dependency must be a job listed before the jobs depending on it; so the graph has no cycles
+        """
+
+        seen = set()
+
+        for job in self.jobs:
+            for dependency in list(job.depends_on) + list(job.after):
+                if dependency not in seen:
+                    raise ValueError(f"job {job.name} depends on {dependency}, which is not listed before it")
+            seen.add(job.name)
+
+    def _save_state(self) -> None:
+        """ Write the state file, atomically so a reader never sees half of it
+        """
+
+        temp_file = self.state_file + '.tmp'
+
+        # jobs save their pending keys from their own threads
+        with self._state_lock:
+            with open(temp_file, 'w') as sf:
+                json.dump(self.state, sf, indent=2, default=str)
+
+            os.replace(temp_file, self.state_file)
+
+    def _set_job_state(self, name: str, state: str, **fields) -> None:
+
+        with self._state_lock:
+            job_state = self.state.setdefault('jobs', {}).setdefault(name, {})
+            job_state['state'] = state
+            job_state.update(fields)
+
+        self._save_state()
+
+    def _pending_keys(self) -> set:
+        """ (exchange, symbol, 'YYYY-MM-DD') keys of prices written that vol has not yet processed
+        """
+
+        with self._state_lock:
+            return {tuple(key) for key in self.state.get('pending_keys', [])}
+
+    def _update_pending_keys(self, add: set = frozenset(), remove: set = frozenset()) -> None:
+
+        with self._state_lock:
+            keys = ({tuple(key) for key in self.state.get('pending_keys', [])} | add) - remove
+            self.state['pending_keys'] = sorted(keys)
+
+        self._save_state()
+
+    def _refresh_connections(self) -> None:
+        """ The vol job holds its connections between runs; replace any that have dropped while idle
+        """
+
+        for component in (self.vol_update, self.vol_update.surface_builder, self.vol_update.metrics_engine):
+            connection = self.db_pool.refresh(component.db_connection)
+
+            if connection is not component.db_connection:
+                component.db_connection, component.db_cursor = connection, connection.cursor()
+
+    def _ingest(self, inputs: dict) -> set:
+
+        written_keys = set()
+
+        with self.db_pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                return CryptoPriceDBGateway.update_markets(self.markets_config, connection, cursor, self.exchanges, written_keys)
+            finally:
+                cursor.close()
+                self._update_pending_keys(add=written_keys)
+
+    def _history_months(self, today: datetime) -> list:
+        """ (year, month) from the month of the last successful history job to this one; just this month the first time
+        """
+
+        last_success = self.state.get('jobs', {}).get('history', {}).get('last_success')
+        start = datetime.fromisoformat(str(last_success)) if last_success else today
+
+        months = []
+        year, month = start.year, start.month
+
+        while (year, month) <= (today.year, today.month):
+            months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        return months
+
+    def _history(self, inputs: dict) -> set:
+
+        price_history = DeribitPriceHistoryDBGateway(self.db_pool)
+        written_keys = set()
+
+        try:
+            for year, month in self._history_months(datetime.now()):
+                price_history._process_historic_ohlcv(year, month, written_keys)
+        finally:
+            price_history._release_connection()
+            self._update_pending_keys(add=written_keys)
+
+        return written_keys
+
+    def _vol(self, inputs: dict) -> set:
+        """ Vols for this run's prices, and for any an earlier run wrote but did not give vols
+        """
+
+        price_keys = self._pending_keys()
+        days_written = self.vol_update._update_vol_data_for_keys(price_keys, build_surfaces=False)
+        self._update_pending_keys(remove=price_keys)
+
+        return days_written
+
+    def _metrics(self, inputs: dict) -> dict:
+
+        return self.vol_update._build_vol_surfaces(inputs['vol'])
+
+    def _run_dag(self) -> bool:
+        """ Run every job once, each as soon as its dependencies have succeeded. Returns whether all of them succeeded
+        """
+
+        pending = {job.name: job for job in self.jobs}
+        results, running, started = {}, {}, {}
+
+        for name in pending:
+            self._set_job_state(name, PENDING, error=None)
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel_jobs, thread_name_prefix='job') as executor:
+            while pending or running:
+
+                finished_states = (SUCCEEDED, FAILED, SKIPPED)
+
+                for name, job in list(pending.items()):
+                    blocked = [dependency for dependency in job.depends_on if self.state['jobs'][dependency]['state'] in (FAILED, SKIPPED)]
+                    waiting = [dependency for dependency in job.after if self.state['jobs'][dependency]['state'] not in finished_states]
+
+                    if blocked or self._stop.is_set():
+                        del pending[name]
+                        self._set_job_state(name, SKIPPED, error=f"{', '.join(blocked)} did not succeed" if blocked else 'stopped')
+                        self.info_logger(f"JOB {name} SKIPPED")
+
+                    elif all(dependency in results for dependency in job.depends_on) and not waiting:
+                        del pending[name]
+                        started[name] = datetime.now()
+                        self._set_job_state(name, RUNNING, started=started[name], finished=None, seconds=None)
+                        self.info_logger(f"JOB {name} STARTED")
+                        running[executor.submit(job.run, {dependency: results[dependency] for dependency in job.depends_on})] = name
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    finished = datetime.now()
+                    seconds = round((finished - started[name]).total_seconds(), 1)
+
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logger.exception(f"JOB {name} FAILED: {e}")
+                        self._set_job_state(name, FAILED, finished=finished, seconds=seconds, error=repr(e))
+                        self.info_logger(f"JOB {name} FAILED AFTER {seconds}s: {e!r}")
+                        continue
+
+                    self._set_job_state(name, SUCCEEDED, finished=finished, seconds=seconds, last_success=finished,
+                                        count=len(results[name]) if hasattr(results[name], '__len__') else None)
+                    self.info_logger(f"JOB {name} SUCCEEDED IN {seconds}s")
+
+        return all(self.state['jobs'][job.name]['state'] == SUCCEEDED for job in self.jobs)
+
+    def run_once(self) -> bool:
+        """ One run of the jobs, unless one is already under way (here or in another process).
+            Returns whether every job succeeded
+        """
+
+        with open(self.lock_file, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.info_logger(f"RUN SKIPPED; ANOTHER RUN HOLDS {self.lock_file}")
+                return False
+
+            started = datetime.now()
+            self.state['run'] = {'state': RUNNING, 'started': started, 'finished': None, 'seconds': None}
+            self.info_logger(f"RUN STARTED {started:%Y-%m-%d %H:%M:%S}")
+
+            instrumentation.reset()
+            # JOB_RUNS times are UTC, as the jobs run from the command line record them
+            run_started = datetime.utcnow()
+            self._refresh_connections()
+
+            succeeded = self._run_dag()
+
+            finished = datetime.now()
+            self.state['run'] = {'state': SUCCEEDED if succeeded else FAILED, 'started': started, 'finished': finished,
+                                 'seconds': round((finished - started).total_seconds(), 1), 'day': started.date()}
+            self._save_state()
+
+            self.info_logger(f"RUN {self.state['run']['state'].upper()} IN {self.state['run']['seconds']}s")
+            for line in instrumentation.summary():
+                self.info_logger(f"    {line}")
+
+            instrumentation.write_run_record('JobScheduler', run_started, datetime.utcnow(), self.state['run']['state'])
+
+        return succeeded
+
+    def _next_run(self, now: datetime) -> datetime:
+        """ Today at 'run_at', or now if that has passed without a run today (e.g. the daemon was down); else tomorrow
+        """
+
+        run_time = datetime.combine(now.date(), self.run_at)
+        last_run_day = self.state.get('run', {}).get('day')
+
+        if now < run_time:
+            return run_time
+
+        if str(last_run_day) != str(now.date()):
+            return now
+
+        return run_time + timedelta(days=1)
+
+    def stop(self, *args) -> None:
+        """ Stop after the running jobs have finished; jobs not yet started are skipped
+        """
+
+        self.info_logger("STOPPING")
+        self._stop.set()
+
+    def run_forever(self) -> None:
+        """ Run the jobs every day at 'run_at' (local time) until stopped (SIGTERM or SIGINT)
+        """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self._stop.is_set():
+            next_run = self._next_run(datetime.now())
+            self.info_logger(f"NEXT RUN AT {next_run:%Y-%m-%d %H:%M:%S}")
+
+            # woken early by stop()
+            if self._stop.wait(max((next_run - datetime.now()).total_seconds(), 0)):
+                break
+
+            self.run_once()
+
+
+def load_state(state_file: str) -> dict:
+    """ The scheduler's last run, and each job's last state, start, finish and duration
+    """
+
+    if not os.path.exists(state_file):
+        return {}
+
+    with open(state_file) as sf:
+        return json.load(sf)
+
+
+def print_state(state: dict) -> None:
+
+    run = state.get('run')
+
+    if not run:
+        print("NO RUNS YET")
+        return
+
+    print(f"RUN {run['state']} STARTED {run['started']} FINISHED {run['finished']} ({run['seconds']}s)")
+
+    if state.get('pending_keys'):
+        print(f"{len(state['pending_keys'])} PRICES WAITING FOR VOLS")
+
+    for name, job in state.get('jobs', {}).items():
+        print(f"    {name:<10} {job['state']:<10} started {job.get('started')} finished {job.get('finished')}"
+              + (f" ({job['seconds']}s)" if job.get('seconds') is not None else "")
+              + f" last success {job.get('last_success')}"
+              + (f" error {job['error']}" if job.get('error') else ""))
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv, "-hos", ["once", "status"])
+
+    once = False
+    status = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('python3 -m JobScheduler -h -o (--once) -s (--status)')
+            sys.exit()
+
+        if opt in ("-o", "--once"):
+            once = True
+
+        if opt in ("-s", "--status"):
+            status = True
+
+    return once, status
+
+
+if __name__ == "__main__":
+
+    once, status = get_args(sys.argv[1:])
+
+    if status:
+        print_state(load_state(load_config('scheduler', DEFAULT_SCHEDULER_CONFIG)['state_file']))
+        sys.exit()
+
+    scheduler = JobScheduler()
+
+    if once:
+        sys.exit(0 if scheduler.run_once() else 1)
+
+    scheduler.run_forever()
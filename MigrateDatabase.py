@@ -1,23 +1,22 @@
 ### Module to run to ensure database is updated to latest version
-import tomli
 from datetime import datetime
-import psycopg2
 import glob
+from DatabaseGateway import get_database_pool
 
 
 class MigrateDatabase():
 
     def __init__(self):
         self.version_table = "DB_VERSION"
-        self.config = "MigrateDatabase.toml"
         self._migration_path = 'migrations/'
 
-        self.db_config: dict = self._load_config()
+        self.db_pool = get_database_pool()
         self.db_cursor = None
         self.db_connection = None
 
         try:
-            self._connectDB(self.db_config)
+            self.db_connection = self.db_pool.get_connection()
+            self.db_cursor = self.db_connection.cursor()
             self._check_db_version_table_exists()
             self.do_migrations()
         except Exception as e:
@@ -26,53 +25,7 @@ class MigrateDatabase():
             if self.db_cursor:
                 self.db_cursor.close()
             if self.db_connection:
-                self.db_connection.close()
-
-    def _load_config(self) -> dict:
-        """ Load up the database configuration .toml file
-        """
-
-        db_config = {}
-
-        with open(self.config, mode="rb") as cf:
-            config = tomli.load(cf)
-
-            # database config
-            db_config['user'] = config['database']['user']
-            db_config['password'] = config['database']['password']
-            db_config['host'] = config['database']['host']
-            db_config['port'] = config['database']['port']
-            db_config['database'] = config['database']['database']
-
-        return db_config
-
-    def _connectDB(self, db_config) -> None:
-        """ Establish connection to the database using given config
-        """
-
-        try:
-            # Connect to DB
-            self.db_connection = psycopg2.connect(user=db_config['user'],
-                                             password=db_config['password'],
-                                             host=db_config['host'],
-                                             port=db_config['port'],
-                                             database=db_config['database']
-                                             )
-            print('Postgres connection is established.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            raise e
-
-        try:
-            # open connection for read/write
-            self.db_cursor = self.db_connection.cursor()
-            print('Postgres connection is opened.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            if self.db_connection:
-                self.db_connection.close()
-            print('Postgres connection is closed.')
-            raise e
+                self.db_pool.put_connection(self.db_connection)
 
     def _check_db_version_table_exists(self) -> None:
         """ IF Vol History table does not exist, then create it
@@ -125,9 +78,10 @@ class MigrateDatabase():
     def _apply_migration_script(self, version: float, script: str) -> None:
         """ Execute the script for this version upgrade
         """
-        # execute script
+        # execute script in a namespace of its own, as if run directly; a bare exec() would leave the script's
+        # imports and constants in exec's locals, out of sight of the functions and methods it defines
         with open(script) as f:
-            exec(f.read())
+            exec(compile(f.read(), script, 'exec'), {'__name__': '__main__', '__file__': script})
 
         # update the database
         self._update_db_version_stamp(version, script)
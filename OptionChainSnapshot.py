@@ -0,0 +1,238 @@
+from datetime import datetime
+import logging, sys, getopt
+import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool, bulk_write
+from DeribitInstruments import InstrumentCache, check_instruments_table_exists
+from DeribitVolCalculator import DeribitVolCalculator
+
+
+logger = logging.getLogger('OPTION CHAIN')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('option_chain.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+OPTION_CHAIN_TABLE = 'OPTION_CHAIN'
+
+# OHLCV_VOL row columns used for the chain; the vol job's rows are laid out the same way
+VOL_OPEN_VOL, VOL_OPEN_DELTA, VOL_CLOSE_VOL, VOL_CLOSE_DELTA, VOL_TERM, VOL_VOLUME = 6, 8, 9, 11, 12, 13
+# OHLCV row columns of the open and close prices
+PRICE_OPEN, PRICE_CLOSE = 6, 9
+
+
+def check_option_chain_table_exists(cursor) -> None:
+    """ IF Option Chain table does not exist, then create it.
+
+        A WAL table, deduplicated on (ExchangeDay, Exchange, MarketSymbol), so rebuilding a day replaces its rows.
+    """
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {OPTION_CHAIN_TABLE} (
+                        ts TIMESTAMP,
+                        Exchange  SYMBOL CAPACITY 256 CACHE,
+                        Underlying  SYMBOL CAPACITY 256 CACHE INDEX,
+                        MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE,
+                        ExchangeDay TIMESTAMP NOT NULL,
+                        Expiry TIMESTAMP,
+                        Strike FLOAT,
+                        OptionType SYMBOL CAPACITY 4 CACHE,
+                        Term FLOAT,
+                        OpenPrice FLOAT,
+                        ClosePrice FLOAT,
+                        OpenForward FLOAT,
+                        CloseForward FLOAT,
+                        OpenVol FLOAT,
+                        CloseVol FLOAT,
+                        OpenDelta FLOAT,
+                        CloseDelta FLOAT,
+                        Volume FLOAT
+                ) timestamp(ExchangeDay) PARTITION BY MONTH WAL
+                DEDUP UPSERT KEYS(ExchangeDay, Exchange, MarketSymbol);''')
+
+
+class OptionChainBuilder:
+    """ Maintains the OPTION_CHAIN table; a denormalised snapshot of each day's option chain.
+
+        One row per (exchange, underlying, day, expiry, strike, call/put) holding the option's open/close price
+        (in token terms), the forward interpolated from that day's futures curve, and the vol, delta and volume,
+        so a day's chain is a single range read on the designated timestamp, with no join or curve rebuild.
+
+        The vol job writes the chain rows for each chunk of vols as it writes the vols themselves, in the same commit.
+        History (or a day whose vols have been recomputed) is rebuilt from OHLCV and OHLCV_VOL with _rebuild_chain.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None, instruments: InstrumentCache = None):
+
+        self.deribit_ohlcv = "OHLCV"
+        self.deribit_ohlcv_vol = "OHLCV_VOL"
+        self.option_chain = OPTION_CHAIN_TABLE
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+
+        self.instruments = instruments if instruments is not None else InstrumentCache()
+        self.calculator = DeribitVolCalculator(instruments=self.instruments)
+
+        with self.db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                check_option_chain_table_exists(cursor)
+            connection.commit()
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _chain_rows(self, future_curves: dict, option_prices: list, vol_rows: list) -> list:
+        """ The chain rows for the given vol rows.
+
+            :param future_curves: the futures curves the vols were solved against
+            :param option_prices: the OHLCV option records the vols were solved from
+            :param vol_rows: OHLCV_VOL rows (as written by the vol job, or read back from the table)
+        """
+
+        now = datetime.utcnow()
+        prices = {(price[1], price[2], price[3]): price for price in option_prices}
+        rows = []
+
+        for vol_row in vol_rows:
+            option_price = prices.get((vol_row[1], vol_row[2], vol_row[3]))
+            future_curve = future_curves.get(self.calculator._future_key_from_record(vol_row))
+
+            if option_price is None or not future_curve:
+                continue
+
+            instrument = self.instruments.get(vol_row[2])
+            term = vol_row[VOL_TERM]
+
+            open_forward = self.calculator._underlying_price('open', future_curve, term)
+            # a one day option is only solved at the open, so the close vol, delta (and forward) are the open ones
+            close_forward = open_forward if term == 1 else self.calculator._underlying_price('close', future_curve, term)
+
+            rows.append((now, vol_row[1], instrument.underlying, vol_row[2], vol_row[3],
+                         instrument.expiry, instrument.strike, instrument.option_type, term,
+                         option_price[PRICE_OPEN], option_price[PRICE_CLOSE], open_forward, close_forward,
+                         vol_row[VOL_OPEN_VOL], vol_row[VOL_CLOSE_VOL], vol_row[VOL_OPEN_DELTA], vol_row[VOL_CLOSE_DELTA],
+                         vol_row[VOL_VOLUME]))
+
+        return rows
+
+    def _write_chain_rows(self, cursor, future_curves: dict, option_prices: list, vol_rows: list) -> int:
+        """ Insert the chain rows for the given vol rows; the caller commits, along with the vols.
+            Returns the number of rows written
+        """
+
+        return bulk_write(cursor, self.option_chain, self._chain_rows(future_curves, option_prices, vol_rows))
+
+    def _get_future_curves(self, month: str) -> dict:
+        """ The futures curves of every day of the month ('YYYY-MM')
+        """
+
+        query = f"""SELECT * FROM {self.deribit_ohlcv}
+                    WHERE ExchangeDate IN '{month}'
+                    AND Exchange = 'deribit'
+                    AND MarketSymbol LIKE '%:%'
+                    AND NOT (MarketSymbol LIKE '%-C' OR MarketSymbol LIKE '%-P')"""
+
+        future_prices = []
+
+        for rows in self.db_pool.bulk_read(query):
+            future_prices += [price for price in rows if self.instruments.get(price[2]).kind in ('future', 'perpetual')]
+
+        return self.calculator._convert_prices_to_curves(future_prices)
+
+    def _read_day(self, table: str, day: str) -> list:
+        """ The deribit option rows of a table (OHLCV or OHLCV_VOL) for a single COB date
+        """
+
+        query = f"""SELECT * FROM {table}
+                    WHERE ExchangeDate IN '{day}'
+                    AND Exchange = 'deribit'
+                    AND (MarketSymbol LIKE '%-C' OR MarketSymbol LIKE '%-P')"""
+
+        day_rows = []
+
+        for rows in self.db_pool.bulk_read(query):
+            day_rows += rows
+
+        return day_rows
+
+    def _rebuild_chain(self, year: int, month: int) -> int:
+        """ Rebuild the chain for every day in the given year and month from the stored prices and vols.
+            Returns the number of chain rows written
+        """
+
+        future_curves = self._get_future_curves(f"{year}-{month:02}")
+        days = sorted({future_key[2] for future_key in future_curves})
+
+        rowcount = 0
+
+        for day in days:
+            vol_rows = self._read_day(self.deribit_ohlcv_vol, day)
+
+            if vol_rows:
+                rowcount += self.db_pool.bulk_write(self.option_chain,
+                                                    self._chain_rows(future_curves, self._read_day(self.deribit_ohlcv, day), vol_rows))
+
+        self.info_logger(f"OPTION CHAIN REBUILT {rowcount} ROWS FOR {len(days)} DAYS OF {year}-{month:02}")
+
+        return rowcount
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv,"-hy:m:", ["year=", "month="])
+
+    year = None
+    month = None
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('python3 -m OptionChainSnapshot -h -y <2023> -m <6>')
+            sys.exit()
+
+        if opt in ("-y", "--year"):
+            try:
+                year = int(arg)
+            except Exception as e:
+                print(f'error {e}; year must be format <2023>')
+                sys.exit()
+
+        if opt in ("-m", "--month"):
+            try:
+                month = int(arg)
+            except Exception as e:
+                print(f'error {e}; month must be format <8>')
+                sys.exit()
+
+    if month and not year:
+        print(f'error; month can only be provided if year is also provided')
+        sys.exit()
+
+    if not year:
+        print(f'error; year must be provided')
+        sys.exit()
+
+    return year, month
+
+
+if __name__ == "__main__":
+
+    year, month = get_args(sys.argv[1:])
+
+    db_pool = get_database_pool()
+    instruments = InstrumentCache()
+
+    with db_pool.connection() as connection:
+        with connection.cursor() as cursor:
+            check_instruments_table_exists(cursor)
+            instruments.load(cursor)
+
+    builder = OptionChainBuilder(db_pool, instruments)
+
+    for run_month in ([month] if month else range(1, 13)):
+        builder._rebuild_chain(year, run_month)
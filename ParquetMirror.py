@@ -0,0 +1,222 @@
+import json
+import os
+import shutil
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+import logging, sys, getopt
+import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool, load_config
+
+
+logger = logging.getLogger('PARQUET MIRROR')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('parquet_mirror.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+MIRROR_TABLES = ['OHLCV', 'OHLCV_VOL']
+MANIFEST_FILE = '_manifest.json'
+
+# QuestDB column types and their arrow equivalents
+ARROW_TYPES = {'TIMESTAMP': pa.timestamp('us'), 'DATE': pa.timestamp('ms'),
+               'SYMBOL': pa.string(), 'STRING': pa.string(),
+               'LONG': pa.int64(), 'INT': pa.int32(), 'SHORT': pa.int16(),
+               'DOUBLE': pa.float64(), 'FLOAT': pa.float32(), 'BOOLEAN': pa.bool_()}
+
+# rows per parquet row group; partitions are sorted by symbol then date, so row group statistics prune on both
+ROW_GROUP_ROWS = 100000
+
+
+class ParquetMirror:
+    """ Keeps a local Parquet copy of the price and vol history, so heavy historical reads
+        (backtests, notebooks) come off the database entirely.
+
+        The mirror is laid out as <path>/<table>/exchange=<exchange>/month=<YYYY-MM>/data.parquet.
+        Each sync compares the row count and latest ingestion time (ts) of every (exchange, month)
+        in QuestDB with the manifest of the last sync, and only re-exports the partitions that changed.
+        Partitions are written to a temporary file and then moved into place, so readers never see half a file.
+
+        Read the mirror with open_mirror(table); scans are memory mapped, and filters on
+        exchange/month prune whole partitions while filters on other columns are pushed down to the row groups.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None, mirror_path: str = None):
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.mirror_path: str = mirror_path or load_config('mirror', {'path': 'mirror'})['path']
+
+        os.makedirs(self.mirror_path, exist_ok=True)
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _load_manifest(self) -> dict:
+        """ The partition signatures from the last sync; table -> 'exchange/month' -> [rows, latest ts]
+        """
+
+        manifest_file = os.path.join(self.mirror_path, MANIFEST_FILE)
+
+        if not os.path.exists(manifest_file):
+            return {}
+
+        with open(manifest_file) as mf:
+            return json.load(mf)
+
+    def _save_manifest(self, manifest: dict) -> None:
+
+        manifest_file = os.path.join(self.mirror_path, MANIFEST_FILE)
+
+        with open(manifest_file + '.tmp', 'w') as mf:
+            json.dump(manifest, mf, indent=1, sort_keys=True)
+
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _get_schema(self, table: str) -> pa.Schema:
+
+        with self.db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'''SELECT "column", type FROM table_columns('{table}');''')
+                return pa.schema([(column, ARROW_TYPES[column_type]) for column, column_type in cursor.fetchall()])
+
+    def _get_partition_signatures(self, table: str) -> dict:
+        """ 'exchange/month' -> [rows, latest ts] for every partition of the table in the database;
+            a single pass over just the ExchangeDate, Exchange and ts columns
+        """
+
+        signatures = {}
+
+        query = f"""SELECT ExchangeDate, Exchange, count(), max(ts)
+                    FROM {table}
+                    SAMPLE BY 1M ALIGN TO CALENDAR"""
+
+        for rows in self.db_pool.bulk_read(query):
+            for month, exchange, row_count, last_ts in rows:
+                signatures[f"{exchange}/{month:%Y-%m}"] = [row_count, last_ts.isoformat() if last_ts else None]
+
+        return signatures
+
+    def _partition_directory(self, table: str, partition: str) -> str:
+
+        exchange, month = partition.split('/')
+
+        return os.path.join(self.mirror_path, table, f"exchange={exchange}", f"month={month}")
+
+    def _export_partition(self, table: str, partition: str, schema: pa.Schema) -> int:
+        """ Write a single (exchange, month) partition of the table. Returns the rows written.
+        """
+
+        exchange, month = partition.split('/')
+
+        query = f"""SELECT * FROM {table}
+                    WHERE ExchangeDate IN '{month}'
+                    AND Exchange = %s"""
+
+        batches = [pa.RecordBatch.from_pylist([dict(zip(schema.names, row)) for row in rows], schema=schema)
+                   for rows in self.db_pool.bulk_read(query, (exchange,))]
+
+        arrow_table = pa.Table.from_batches(batches, schema=schema).sort_by([('MarketSymbol', 'ascending'),
+                                                                             ('ExchangeDate', 'ascending')])
+
+        directory = self._partition_directory(table, partition)
+        os.makedirs(directory, exist_ok=True)
+
+        # the '_' prefix keeps the part written file out of readers' scans
+        data_file = os.path.join(directory, 'data.parquet')
+        temp_file = os.path.join(directory, '_data.parquet.tmp')
+        pq.write_table(arrow_table, temp_file, compression='zstd', row_group_size=ROW_GROUP_ROWS)
+        os.replace(temp_file, data_file)
+
+        return arrow_table.num_rows
+
+    def _sync_table(self, table: str, manifest: dict) -> int:
+        """ Bring the mirror of a single table up to date. Returns the number of partitions exported.
+        """
+
+        schema = self._get_schema(table)
+        signatures = self._get_partition_signatures(table)
+        mirrored = manifest.setdefault(table, {})
+
+        changed = [partition for partition, signature in sorted(signatures.items()) if mirrored.get(partition) != signature]
+
+        for partition in changed:
+            rows = self._export_partition(table, partition, schema)
+            mirrored[partition] = signatures[partition]
+
+            # saved as we go, so an interrupted sync picks up where it left off
+            self._save_manifest(manifest)
+            self.info_logger(f"{table} {partition}: EXPORTED {rows} ROWS")
+
+        # partitions dropped from the database (e.g. by compaction) are dropped from the mirror too
+        for partition in [partition for partition in mirrored if partition not in signatures]:
+            shutil.rmtree(self._partition_directory(table, partition), ignore_errors=True)
+            del mirrored[partition]
+            self._save_manifest(manifest)
+            self.info_logger(f"{table} {partition}: REMOVED")
+
+        self.info_logger(f"{table}: {len(changed)} OF {len(signatures)} PARTITIONS CHANGED SINCE THE LAST SYNC")
+
+        return len(changed)
+
+    def sync(self, tables: list = None) -> dict:
+        """ Incrementally mirror the given (default, the price and vol) tables. Returns the partitions exported per table.
+        """
+
+        started = datetime.utcnow()
+        manifest = self._load_manifest()
+
+        exported = {table: self._sync_table(table, manifest) for table in tables or MIRROR_TABLES}
+
+        self.info_logger(f"MIRROR SYNC EXPORTED {exported} PARTITIONS IN {(datetime.utcnow() - started).total_seconds():.0f}s")
+
+        return exported
+
+
+def open_mirror(table: str, mirror_path: str = None) -> ds.Dataset:
+    """ The mirrored table as a (memory mapped, hive partitioned) arrow dataset, e.g.
+
+            vols = open_mirror('OHLCV_VOL')
+            frame = vols.to_table(columns=['ExchangeDate', 'MarketSymbol', 'CloseVol'],
+                                  filter=(ds.field('month') >= '2023-01') & (ds.field('MarketSymbol') == 'BTC/USD:BTC-230630-30000-C')
+                                  ).to_pandas()
+    """
+
+    mirror_path = mirror_path or load_config('mirror', {'path': 'mirror'})['path']
+
+    return ds.dataset(os.path.abspath(os.path.join(mirror_path, table)), format='parquet', partitioning='hive',
+                      filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv,"-ht:", ["table="])
+
+    tables = None
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('python3 -m ParquetMirror -h -t <OHLCV>')
+            sys.exit()
+
+        if opt in ("-t", "--table"):
+            if arg not in MIRROR_TABLES:
+                print(f'error; table must be one of {MIRROR_TABLES}')
+                sys.exit()
+            tables = [arg]
+
+    return tables
+
+
+if __name__ == "__main__":
+
+    ParquetMirror().sync(get_args(sys.argv[1:]))
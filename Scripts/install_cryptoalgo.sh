@@ -28,5 +28,8 @@ sudo python3 -m pip install -r ~/CryptoAlgo/requirements.txt
 # Make all the scripts executable
 sudo chmod +x ~/CryptoAlgo/Scripts/*
 
-# Add crontab entry to run CryptoAlgo daily at 10am
-crontab -l | cat - ~/CryptoAlgo/Scripts/cryptoalgo.crontab | crontab -
+# Setup systemd to run the CryptoAlgo jobs daily at 10am (JobScheduler.py; replaces the old crontab entry)
+sudo cp ~/CryptoAlgo/Scripts/cryptoalgo-scheduler.service /etc/systemd/system/cryptoalgo-scheduler.service
+sudo systemctl daemon-reload
+sudo systemctl start cryptoalgo-scheduler.service
+sudo systemctl enable cryptoalgo-scheduler.service
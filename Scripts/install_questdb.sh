@@ -10,8 +10,8 @@ sudo timedatectl set-timezone Europe/London
 
 # Install QuestDB
 cd ~
-wget https://github.com/questdb/questdb/releases/download/6.4.3/questdb-6.4.3-rt-linux-amd64.tar.gz
-tar xvf questdb-6.4.3-rt-linux-amd64.tar.gz
+wget https://github.com/questdb/questdb/releases/download/7.3.10/questdb-7.3.10-rt-linux-amd64.tar.gz
+tar xvf questdb-7.3.10-rt-linux-amd64.tar.gz
 
 # Create QuestDB drive from snapshot
 sudo ~/CryptoAlgo/Scripts/restore_questdb_snapshot.sh
@@ -0,0 +1,337 @@
+import bisect
+import math
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+import logging
+import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool, load_config
+from DeribitInstruments import Instrument, InstrumentCache
+from DeribitVolCalculator import DeribitVolCalculator
+
+
+logger = logging.getLogger('STREAMING VOL')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('streaming_vol.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+VOL_INTRADAY_TABLE = 'VOL_INTRADAY'
+
+# bounds of the solve, as a fraction; the nightly (QuantLib) solve fails outside the same bounds
+MIN_VOL = 0.0001
+MAX_VOL = 4.0
+MAX_ITERATIONS = 50
+# price tolerance, as a fraction of the forward
+PRICE_TOLERANCE = 1e-10
+
+DAY_MS = 24 * 60 * 60 * 1000
+# Deribit expiries are at 08:00 UTC
+EXPIRY_HOUR_MS = 8 * 60 * 60 * 1000
+# latencies kept for latency_summary
+LATENCY_SAMPLES = 100000
+
+# vol and delta of an option at a tick; term in (fractional) days, strike as % of the forward, vol in %
+VolTick = namedtuple('VolTick', ['symbol', 'underlying', 'timestamp', 'term', 'forward', 'mark', 'vol', 'strike', 'delta'])
+
+
+def check_vol_intraday_table_exists(cursor) -> None:
+    """ IF Vol Intraday table does not exist, then create it
+    """
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {VOL_INTRADAY_TABLE} (
+                        ts TIMESTAMP,
+                        Exchange  SYMBOL CAPACITY 256 CACHE,
+                        Underlying  SYMBOL CAPACITY 256 CACHE INDEX,
+                        MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
+                        ExchangeDate TIMESTAMP NOT NULL,
+                        ExchangeTimestamp LONG NOT NULL,
+                        Term FLOAT,
+                        Forward FLOAT,
+                        Mark FLOAT,
+                        Vol FLOAT,
+                        Strike FLOAT,
+                        Delta FLOAT
+                ) timestamp(ExchangeDate) PARTITION BY DAY WAL;''')
+
+
+def _norm_cdf(x: float) -> float:
+
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+def black76(forward: float, strike: float, years: float, vol: float, is_call: bool, discount: float) -> (float, float, float):
+    """ Black 76 price, delta (to the forward) and vega (per unit vol) of a European option
+    """
+
+    deviation = vol * math.sqrt(years)
+    d1 = (math.log(forward / strike) + 0.5 * deviation * deviation) / deviation
+    n1, n2 = _norm_cdf(d1), _norm_cdf(d1 - deviation)
+
+    if is_call:
+        price, delta = discount * (forward * n1 - strike * n2), discount * n1
+    else:
+        price, delta = discount * (strike * (1 - n2) - forward * (1 - n1)), discount * (n1 - 1)
+
+    vega = discount * forward * math.sqrt(years) * math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi)
+
+    return price, delta, vega
+
+
+def implied_vol(target: float, forward: float, strike: float, years: float, is_call: bool, discount: float,
+                guess: float = 0.5) -> (float, float):
+    """ The Black 76 vol (as a fraction) and delta for a price, by Newton's method from 'guess' inside a bisection bracket.
+        Started from the option's previous vol, a tick's vol usually takes one or two steps.
+
+        Returns (None, None) if there is no vol within the bounds
+    """
+
+    intrinsic = discount * max(forward - strike, 0.0) if is_call else discount * max(strike - forward, 0.0)
+    upper = discount * (forward if is_call else strike)
+
+    if not intrinsic < target < upper:
+        return None, None
+
+    low, high = MIN_VOL, MAX_VOL
+    vol = min(max(guess, low), high)
+    tolerance = PRICE_TOLERANCE * forward
+
+    for _ in range(MAX_ITERATIONS):
+        price, delta, vega = black76(forward, strike, years, vol, is_call, discount)
+        error = price - target
+
+        if abs(error) < tolerance:
+            return vol, delta
+
+        if error > 0:
+            high = vol
+        else:
+            low = vol
+
+        step = vol - error / vega if vega > 0 else low
+        vol = step if low < step < high else 0.5 * (low + high)
+
+        if high - low < 1e-12:
+            break
+
+    # bracketed to nothing at a bound; the vol lies outside it
+    if vol <= MIN_VOL * 1.0001 or vol >= MAX_VOL * 0.9999:
+        return None, None
+
+    price, delta, _ = black76(forward, strike, years, vol, is_call, discount)
+
+    return (vol, delta) if abs(price - target) < 1e-6 * forward else (None, None)
+
+
+class FutureCurve:
+    """ The live futures curve of an underlying; the perpetual (at the time of the tick) and each future at its expiry
+    """
+
+    def __init__(self):
+
+        self.perpetual: float = None
+        self.futures: dict = {}
+        self._expiries: list = []
+        self._prices: list = []
+
+    def update(self, expiry_ms: int, price: float) -> None:
+        """ Set the price of the future expiring at expiry_ms, or of the perpetual if that is None
+        """
+
+        if expiry_ms is None:
+            self.perpetual = price
+            return
+
+        new_expiry = expiry_ms not in self.futures
+        self.futures[expiry_ms] = price
+
+        if new_expiry:
+            self._expiries = sorted(self.futures)
+            self._prices = [self.futures[expiry] for expiry in self._expiries]
+        else:
+            self._prices[bisect.bisect_left(self._expiries, expiry_ms)] = price
+
+    def forward(self, timestamp: int, expiry_ms: int) -> float:
+        """ The forward for the expiry, interpolated linearly in time between the futures either side;
+            flat beyond the last future, as the nightly solve does
+        """
+
+        # futures that have expired drop off the front of the curve
+        first = bisect.bisect_right(self._expiries, timestamp)
+        expiries, prices = self._expiries[first:], self._prices[first:]
+
+        if self.perpetual is not None:
+            expiries, prices = [timestamp] + expiries, [self.perpetual] + prices
+
+        if not expiries:
+            return None
+
+        after = bisect.bisect_left(expiries, expiry_ms)
+
+        if after == 0:
+            return prices[0]
+
+        if after == len(expiries):
+            return prices[-1]
+
+        before_expiry, after_expiry = expiries[after - 1], expiries[after]
+        factor = (expiry_ms - before_expiry) / (after_expiry - before_expiry)
+
+        return prices[after - 1] * (1 - factor) + prices[after] * factor
+
+
+class StreamingVolEngine(DeribitVolCalculator):
+    """ Implied vols tick by tick, from streamed prices (see DeribitStreamIngester.add_listener).
+
+        Future and perpetual prices keep a live futures curve per underlying. Each option mark is solved
+        (Black 76, as the nightly job prices them) against the forward interpolated from that curve at the
+        option's exact time to expiry, warm started from the option's previous vol, so a tick costs microseconds.
+
+        Every solved vol is published to the subscribers (subscribe) as it is solved. The latest vol of each
+        option is also written to VOL_INTRADAY every 'vol_write_seconds' (of exchange time) with the ingester's bars.
+
+        :param db_pool: where VOL_INTRADAY is written
+        :param instruments: instrument cache; symbols not in it are parsed on first use
+    """
+
+    def __init__(self, db_pool: DatabasePool = None, instruments: InstrumentCache = None):
+
+        vol_config = load_config('vol', {'risk_free_rate': 0.0, 'delta_precision': 0.001})
+        super().__init__(risk_free_rate=vol_config['risk_free_rate'], delta_precision=vol_config['delta_precision'],
+                         instruments=instruments)
+
+        self.exchange_id = 'deribit'
+        self.vol_write_ms: int = int(load_config('stream', {'vol_write_seconds': 60})['vol_write_seconds'] * 1000)
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+
+        self.curves: dict = {}
+        self.vols: dict = {}
+        self._pending: dict = {}
+        self._last_write: int = None
+        self._expiry_ms: dict = {}
+        self._subscribers: list = []
+
+        self.solved = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+        with self.db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                check_vol_intraday_table_exists(cursor)
+            connection.commit()
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def subscribe(self, callback) -> None:
+        """ Call callback(VolTick) with every vol solved; on the streaming thread, so callbacks should be quick
+        """
+
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback) -> None:
+
+        self._subscribers.remove(callback)
+
+    def _expiry_timestamp(self, instrument: Instrument) -> int:
+
+        expiry_ms = self._expiry_ms.get(instrument.symbol)
+
+        if expiry_ms is None:
+            expiry_ms = self._expiry_ms[instrument.symbol] = int((instrument.expiry - datetime(1970, 1, 1)).total_seconds() * 1000) + EXPIRY_HOUR_MS
+
+        return expiry_ms
+
+    def on_price(self, symbol: str, timestamp: int, price: float) -> None:
+        """ A streamed mark; updates the curve for a future or perpetual, solves the vol for an option
+        """
+
+        instrument = self.instruments.get(symbol)
+
+        if instrument.kind == 'option':
+            self._on_option(instrument, timestamp, price)
+        elif instrument.kind in ('future', 'perpetual'):
+            curve = self.curves.get(instrument.underlying)
+            if curve is None:
+                curve = self.curves[instrument.underlying] = FutureCurve()
+            curve.update(self._expiry_timestamp(instrument) if instrument.expiry else None, price)
+
+    def _on_option(self, instrument: Instrument, timestamp: int, mark: float) -> None:
+
+        started = time.perf_counter()
+
+        curve = self.curves.get(instrument.underlying)
+        expiry_ms = self._expiry_timestamp(instrument)
+
+        if curve is None or expiry_ms <= timestamp or not mark:
+            return
+
+        forward = curve.forward(timestamp, expiry_ms)
+
+        if not forward:
+            return
+
+        days = (expiry_ms - timestamp) / DAY_MS
+        discount = math.exp(-self.risk_free_rate / 100 * days / 360)
+
+        previous = self.vols.get(instrument.symbol)
+        vol, delta = implied_vol(mark * forward, forward, instrument.strike, days / 365, instrument.option_type == 'C',
+                                 discount, previous.vol / 100 if previous else 0.5)
+
+        if vol is None:
+            self.failed += 1
+            return
+
+        tick = VolTick(instrument.symbol, instrument.underlying, timestamp, days, forward, mark, vol * 100,
+                       100 * instrument.strike / forward, self._delta_as_float(delta))
+
+        self.vols[instrument.symbol] = tick
+        self._pending[instrument.symbol] = tick
+        self.solved += 1
+
+        for callback in self._subscribers:
+            callback(tick)
+
+        self.latencies.append(time.perf_counter() - started)
+
+    def closed_rows(self) -> dict:
+        """ The latest vol of each option solved since the last write, once every 'vol_write_seconds'; by table
+        """
+
+        if not self._pending:
+            return {}
+
+        clock = max(tick.timestamp for tick in self._pending.values())
+
+        if self._last_write is not None and clock - self._last_write < self.vol_write_ms:
+            return {}
+
+        pending, self._pending, self._last_write = self._pending, {}, clock
+        now = datetime.utcnow()
+
+        return {VOL_INTRADAY_TABLE: [(now, self.exchange_id, tick.underlying, tick.symbol,
+                                      datetime.fromtimestamp(tick.timestamp / 1000), tick.timestamp,
+                                      tick.term, tick.forward, tick.mark, tick.vol, tick.strike, tick.delta)
+                                     for tick in pending.values()]}
+
+    def latency_summary(self) -> dict:
+        """ Tick to vol latency (ms) over the most recent ticks; median, 99th percentile and worst
+        """
+
+        if not self.latencies:
+            return {}
+
+        latencies = sorted(self.latencies)
+
+        return {'p50_ms': round(latencies[len(latencies) // 2] * 1000, 4),
+                'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 4),
+                'max_ms': round(latencies[-1] * 1000, 4)}
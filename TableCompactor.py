@@ -0,0 +1,272 @@
+from datetime import datetime
+import logging, sys, getopt
+import logging.handlers as handlers
+import re
+from DatabaseGateway import DatabasePool, get_database_pool, wait_for_wal
+
+
+logger = logging.getLogger('TABLE COMPACTOR')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('table_compactor.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+# a row is a duplicate if another row in the table has the same key
+# (ExchangeDate, the designated timestamp, is always part of the key as it is ExchangeTimestamp as a date)
+DEDUP_KEYS = ['Exchange', 'MarketSymbol', 'ExchangeTimestamp']
+COMPACTION_TABLES = ['OHLCV', 'OHLCV_VOL']
+# each partition is compacted through its own scratch table, <table>_COMPACT_<yyyy_mm>
+SCRATCH_SUFFIX = '_COMPACT_'
+
+
+class TableCompactor:
+    """ Removes duplicate (Exchange, MarketSymbol, ExchangeTimestamp) rows from the price and vol tables.
+
+        Overlapping runs of the price gateways (and of the vol job on those duplicates) leave repeated rows.
+        QuestDB cannot delete rows, so each monthly partition that has duplicates is rewritten in bulk:
+        the partition is collapsed to one row per key (the last written) in a scratch table,
+        the partition is dropped and the compacted rows are inserted back.
+        A scratch table left by an interrupted run is restored from before anything else is compacted.
+
+        Once the DEDUP migration has run, new writes are upserted on the key and no longer duplicate.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None):
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.db_connection = self.db_pool.get_connection()
+        self.db_cursor = self.db_connection.cursor()
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _get_columns(self, table: str) -> list:
+        """ The table's columns, in table order
+        """
+
+        self.db_cursor.execute(f'''SELECT "column" FROM table_columns('{table}');''')
+
+        return [row[0] for row in self.db_cursor.fetchall()]
+
+    def _get_partition_months(self, table: str) -> list:
+        """ 'YYYY-MM' of every monthly partition holding data
+        """
+
+        self.db_cursor.execute(f'''SELECT min(ExchangeDate), max(ExchangeDate) FROM {table};''')
+        first_date, last_date = self.db_cursor.fetchone()
+
+        if first_date is None:
+            return []
+
+        months = []
+        year, month = first_date.year, first_date.month
+
+        while (year, month) <= (last_date.year, last_date.month):
+            months.append(f"{year}-{month:02}")
+            year, month = year + month // 12, month % 12 + 1
+
+        return months
+
+    def _count_rows(self, table: str, partition: str) -> int:
+
+        self.db_cursor.execute(f'''SELECT count() FROM {table} WHERE ExchangeDate IN '{partition}';''')
+
+        return self.db_cursor.fetchone()[0]
+
+    def _count_duplicates(self, table: str, partition: str) -> int:
+        """ Number of rows in the partition that repeat an earlier row's key
+        """
+
+        keys = ', '.join(DEDUP_KEYS)
+
+        self.db_cursor.execute(f'''SELECT sum(copies - 1) FROM (
+                                        SELECT {keys}, count() copies
+                                        FROM {table}
+                                        WHERE ExchangeDate IN '{partition}'
+                                    ) WHERE copies > 1;''')
+
+        return self.db_cursor.fetchone()[0] or 0
+
+    def _scratch_table(self, table: str, partition: str) -> str:
+        """ The partition's own scratch table, e.g. OHLCV_COMPACT_2023_06
+        """
+
+        return f"{table}{SCRATCH_SUFFIX}{partition.replace('-', '_')}"
+
+    def _restore_scratch_tables(self, tables: list) -> None:
+        """ A scratch table left by an interrupted run may hold the only copy of its partition's rows.
+            Put back any rows the partition is missing, then drop the scratch table; the partition is
+            compacted again as normal. Refuses to run if a scratch table cannot be matched to a partition.
+        """
+
+        self.db_cursor.execute('''SELECT name FROM tables();''')
+        scratch_tables = sorted(row[0] for row in self.db_cursor.fetchall() if SCRATCH_SUFFIX in row[0])
+
+        for scratch_table in scratch_tables:
+            table, _, month = scratch_table.partition(SCRATCH_SUFFIX)
+
+            if table not in tables or not re.fullmatch(r'\d{4}_\d{2}', month):
+                raise RuntimeError(f"{scratch_table} is left from an earlier compaction; restore or drop it by hand")
+
+            partition = month.replace('_', '-')
+
+            wait_for_wal(self.db_cursor, scratch_table)
+            wait_for_wal(self.db_cursor, table)
+
+            self.db_cursor.execute(f'''SELECT count() FROM {scratch_table};''')
+            scratch_rows = self.db_cursor.fetchone()[0]
+
+            # the partition was dropped, and not (all) written back; any rows written twice are compacted away
+            if self._count_rows(table, partition) < scratch_rows:
+                self.db_cursor.execute(f'''INSERT INTO {table} SELECT * FROM {scratch_table};''')
+                self.db_connection.commit()
+                wait_for_wal(self.db_cursor, table)
+
+                if self._count_rows(table, partition) < scratch_rows:
+                    raise RuntimeError(f"{table} {partition}: could not restore the rows held in {scratch_table}")
+
+                self.info_logger(f"{table} {partition}: RESTORED {scratch_rows} ROWS FROM {scratch_table}")
+
+            self.db_cursor.execute(f'''DROP TABLE {scratch_table};''')
+            self.db_connection.commit()
+
+    def _compact_partition(self, table: str, partition: str, columns: list) -> int:
+        """ Rewrite a single partition with one row per key. Returns the number of rows reclaimed.
+        """
+
+        scratch_table = self._scratch_table(table, partition)
+        group_columns = DEDUP_KEYS + ['ExchangeDate']
+
+        # keys are grouped on; every other column takes the last value written for the key
+        select_columns = ', '.join(column if column in group_columns else f'last({column}) {column}' for column in columns)
+
+        rows_before = self._count_rows(table, partition)
+
+        self.db_cursor.execute(f'''CREATE TABLE {scratch_table} AS (
+                                        SELECT {select_columns}
+                                        FROM {table}
+                                        WHERE ExchangeDate IN '{partition}'
+                                        ORDER BY ExchangeDate
+                                    ) timestamp(ExchangeDate) PARTITION BY MONTH;''')
+        self.db_connection.commit()
+        wait_for_wal(self.db_cursor, scratch_table)
+
+        self.db_cursor.execute(f'''SELECT count() FROM {scratch_table};''')
+        rows_after = self.db_cursor.fetchone()[0]
+
+        # only now is the partition replaced; the scratch table holds every key
+        self.db_cursor.execute(f'''ALTER TABLE {table} DROP PARTITION LIST '{partition}';''')
+        self.db_cursor.execute(f'''INSERT INTO {table} SELECT * FROM {scratch_table};''')
+        self.db_connection.commit()
+
+        # a WAL table applies the drop and the insert asynchronously
+        wait_for_wal(self.db_cursor, table)
+
+        if self._count_rows(table, partition) != rows_after:
+            raise RuntimeError(f"{table} {partition}: compacted rows were not all written back; "
+                               f"they are still held in {scratch_table}, and are restored by the next run")
+
+        self.db_cursor.execute(f'''DROP TABLE {scratch_table};''')
+        self.db_connection.commit()
+
+        return rows_before - rows_after
+
+    def _compact_table(self, table: str, run_year: int = None, run_month: int = None) -> int:
+        """ Compact every partition of the table with duplicates (optionally, just a year or year & month).
+            Returns the number of rows reclaimed.
+        """
+
+        columns = self._get_columns(table)
+        reclaimed = 0
+        compacted = 0
+
+        for partition in self._get_partition_months(table):
+
+            if run_year and not partition.startswith(f"{run_year}-"):
+                continue
+            if run_month and partition != f"{run_year}-{run_month:02}":
+                continue
+
+            duplicates = self._count_duplicates(table, partition)
+
+            if not duplicates:
+                continue
+
+            partition_reclaimed = self._compact_partition(table, partition, columns)
+            self.info_logger(f"{table} {partition}: RECLAIMED {partition_reclaimed} DUPLICATE ROWS")
+
+            reclaimed += partition_reclaimed
+            compacted += 1
+
+        self.info_logger(f"{table}: COMPACTED {compacted} PARTITIONS, RECLAIMED {reclaimed} ROWS IN TOTAL")
+
+        return reclaimed
+
+    def _compact_tables(self, tables: list = None, run_year: int = None, run_month: int = None) -> dict:
+        """ Compact the given (default, all price and vol) tables. Returns the rows reclaimed per table.
+        """
+
+        started = datetime.utcnow()
+
+        self._restore_scratch_tables(tables or COMPACTION_TABLES)
+
+        reclaimed = {table: self._compact_table(table, run_year, run_month) for table in tables or COMPACTION_TABLES}
+
+        self.info_logger(f"COMPACTION RECLAIMED {sum(reclaimed.values())} ROWS IN {(datetime.utcnow() - started).total_seconds():.0f}s: {reclaimed}")
+
+        return reclaimed
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv,"-ht:y:m:", ["table=", "year=", "month="])
+
+    tables = None
+    year = None
+    month = None
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('python3 -m TableCompactor -h -t <OHLCV> -y <2023> -m <6>')
+            sys.exit()
+
+        if opt in ("-t", "--table"):
+            if arg not in COMPACTION_TABLES:
+                print(f'error; table must be one of {COMPACTION_TABLES}')
+                sys.exit()
+            tables = [arg]
+
+        if opt in ("-y", "--year"):
+            try:
+                year = int(arg)
+            except Exception as e:
+                print(f'error {e}; year must be format <2023>')
+                sys.exit()
+
+        if opt in ("-m", "--month"):
+            try:
+                month = int(arg)
+            except Exception as e:
+                print(f'error {e}; month must be format <8>')
+                sys.exit()
+
+    if month and not year:
+        print(f'error; month can only be provided if year is also provided')
+        sys.exit()
+
+    return tables, year, month
+
+
+if __name__ == "__main__":
+
+    tables, year, month = get_args(sys.argv[1:])
+
+    TableCompactor()._compact_tables(tables, year, month)
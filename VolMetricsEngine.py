@@ -0,0 +1,221 @@
+from datetime import datetime, timedelta
+import logging, sys, getopt
+import logging.handlers as handlers
+from DatabaseGateway import DatabasePool, get_database_pool
+
+
+logger = logging.getLogger('VOL METRICS')
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logHandler = handlers.RotatingFileHandler('vol_metrics.log', maxBytes=50000, backupCount=5)
+logHandler.setLevel(logging.INFO)
+
+logHandler.setFormatter(formatter)
+
+logger.addHandler(logHandler)
+
+# surface deltas are forward call deltas; the 25 delta put is the 75 delta call
+ATM_DELTA = 0.5
+WING_DELTAS = {'25': (0.25, 0.75), '10': (0.1, 0.9)}
+# (short, long) tenors in days for the term structure slope metrics
+TERM_SLOPES = [(7, 30), (30, 90), (90, 180)]
+
+VOL_METRICS_TABLE = 'VOL_METRICS'
+# one value of a metric per underlying and day; a day's recalculation replaces its old metrics
+VOL_METRICS_UPSERT_KEYS = ['ExchangeDay', 'Exchange', 'MarketSymbol', 'Metric']
+
+
+def check_vol_metrics_table_exists(cursor, table: str = VOL_METRICS_TABLE) -> None:
+    """ IF Vol Metrics table does not exist, then create it; a partition per day, so a day can be recalculated in place
+    """
+
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                        ts TIMESTAMP,
+                        Exchange SYMBOL CAPACITY 256 CACHE,
+                        MarketSymbol SYMBOL CAPACITY 256 CACHE,
+                        ExchangeDay TIMESTAMP NOT NULL,
+                        Metric SYMBOL CAPACITY 1024 CACHE,
+                        Value FLOAT NOT NULL
+                ) timestamp(ExchangeDay) PARTITION BY DAY WAL
+                DEDUP UPSERT KEYS({', '.join(VOL_METRICS_UPSERT_KEYS)});''')
+
+
+class VolMetricsEngine:
+    """ Calculates the VOL_METRICS table from the vol surfaces built by DeribitVolSurfaceBuilder.
+
+        For every surface tenor the metrics are;
+            ATM_VOL_<tenor>D    at the money (50 delta) vol
+            RR<d>_<tenor>D      <d> delta risk reversal; call vol less put vol
+            BF<d>_<tenor>D      <d> delta butterfly; average of call & put vol less ATM vol
+        plus the term structure slopes TS_SLOPE_<short>D_<long>D; the ATM vol difference per 30 days.
+
+        Metrics are only calculated for days whose surfaces have just been rebuilt by the vol job,
+        so the table is up to date as soon as the vol update finishes. Values are in vol points (%).
+        Recalculating a day replaces all of its metrics.
+    """
+
+    def __init__(self, db_pool: DatabasePool = None):
+
+        self.vol_surface = "VOL_SURFACE"
+        self.vol_metrics = VOL_METRICS_TABLE
+
+        self.db_pool: DatabasePool = db_pool or get_database_pool()
+        self.db_connection = self.db_pool.get_connection()
+        self.db_cursor = self.db_connection.cursor()
+
+        self._check_vol_metrics_table_exists()
+
+    def _check_vol_metrics_table_exists(self) -> None:
+        """ IF Vol Metrics table does not exist, then create it
+        """
+
+        check_vol_metrics_table_exists(self.db_cursor, self.vol_metrics)
+
+    def info_logger(self, message):
+
+        logger.info(message)
+        print("LOG", message)
+
+    def _calculate_metrics(self, surface_rows: list) -> list:
+        """ Calculate the metrics for the given surface grid rows
+            (exchange, underlying, day, tenor, delta, vol%).
+
+            Returns a list of (exchange, underlying, day, metric, value) rows
+        """
+
+        # (exchange, underlying, day) -> tenor -> delta -> vol
+        surfaces = {}
+
+        for exchange, underlying, day, tenor, delta, vol in surface_rows:
+            surfaces.setdefault((exchange, underlying, day), {}).setdefault(int(tenor), {})[round(delta, 2)] = vol
+
+        metrics = []
+
+        for (exchange, underlying, day), surface in surfaces.items():
+
+            def _add(metric, value):
+                metrics.append((exchange, underlying, day, metric, value))
+
+            for tenor, smile in sorted(surface.items()):
+
+                if ATM_DELTA not in smile:
+                    continue
+
+                atm = smile[ATM_DELTA]
+                _add(f'ATM_VOL_{tenor}D', atm)
+
+                for name, (call_delta, put_delta) in WING_DELTAS.items():
+                    if call_delta in smile and put_delta in smile:
+                        _add(f'RR{name}_{tenor}D', smile[call_delta] - smile[put_delta])
+                        _add(f'BF{name}_{tenor}D', (smile[call_delta] + smile[put_delta]) / 2 - atm)
+
+            for short_tenor, long_tenor in TERM_SLOPES:
+                short_atm = surface.get(short_tenor, {}).get(ATM_DELTA)
+                long_atm = surface.get(long_tenor, {}).get(ATM_DELTA)
+
+                if short_atm is not None and long_atm is not None:
+                    _add(f'TS_SLOPE_{short_tenor}D_{long_tenor}D', 30 * (long_atm - short_atm) / (long_tenor - short_tenor))
+
+        return metrics
+
+    def _insert_metric_rows(self, rows: list) -> None:
+        """ Bulk insert (and commit) the given metric rows, replacing any metrics already written for their days
+        """
+
+        now = datetime.utcnow()
+
+        self.db_pool.replace_days(self.vol_metrics,
+                                  [(now, exchange, symbol, datetime.strptime(day, '%Y-%m-%d'), *values)
+                                   for exchange, symbol, day, *values in rows],
+                                  VOL_METRICS_UPSERT_KEYS)
+
+    def _update_vol_metrics(self, surfaces: dict) -> int:
+        """ Calculate and write the metrics for freshly built surfaces.
+
+            :param surfaces: surface grid rows keyed by day, as returned by DeribitVolSurfaceBuilder
+
+            Returns the number of metric rows written
+        """
+
+        rowcount = 0
+
+        for day, surface_rows in sorted(surfaces.items()):
+            metric_rows = self._calculate_metrics(surface_rows)
+
+            if metric_rows:
+                self._insert_metric_rows(metric_rows)
+                rowcount += len(metric_rows)
+
+        self.info_logger(f"VOL METRICS WRITTEN {rowcount} FOR {len(surfaces)} DAYS")
+
+        return rowcount
+
+    def _get_surfaces(self, day: str) -> dict:
+        """ Load the latest surface grid rows for the given COB date 'YYYY-MM-DD'
+        """
+
+        self.db_cursor.execute(f"""SELECT Exchange, Underlying, ExchangeDay, Tenor, Delta, Vol
+                                   FROM {self.vol_surface}
+                                   WHERE ExchangeDay = '{day}'""")
+
+        # a grid point has a single row; surfaces written before the table was keyed may still have several, the last is the latest
+        latest = {}
+        for exchange, underlying, exchange_day, tenor, delta, vol in self.db_cursor.fetchall():
+            latest[(exchange, underlying, tenor, round(delta, 2))] = (exchange, underlying, day, tenor, round(delta, 2), vol)
+
+        return {day: list(latest.values())} if latest else {}
+
+    def _recalculate_vol_metrics(self, year: int, month: int) -> int:
+        """ Recalculate the metrics for every day in the given year and month from the stored surfaces
+        """
+
+        day = datetime(year, month, 1)
+        surfaces = {}
+
+        while day.month == month:
+            surfaces.update(self._get_surfaces(day.strftime('%Y-%m-%d')))
+            day += timedelta(days=1)
+
+        return self._update_vol_metrics(surfaces)
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv,"-hy:m:", ["year=", "month="])
+
+    year = None
+    month = None
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('python3 -m VolMetricsEngine -h -y <2023> -m <6>')
+            sys.exit()
+
+        if opt in ("-y", "--year"):
+            try:
+                year = int(arg)
+            except Exception as e:
+                print(f'error {e}; year must be format <2023>')
+                sys.exit()
+
+        if opt in ("-m", "--month"):
+            try:
+                month = int(arg)
+            except Exception as e:
+                print(f'error {e}; month must be format <8>')
+                sys.exit()
+
+    if not (year and month):
+        print(f'error; both year and month must be provided')
+        sys.exit()
+
+    return year, month
+
+
+if __name__ == "__main__":
+
+    year, month = get_args(sys.argv[1:])
+
+    VolMetricsEngine()._recalculate_vol_metrics(year, month)
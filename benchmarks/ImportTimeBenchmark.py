@@ -0,0 +1,85 @@
+import json
+import os
+import statistics
+import subprocess
+import sys, getopt
+
+
+# the job entry points, as cron, the scheduler or a quick CLI call would start them
+ENTRY_POINTS = ['CryptoPriceDBGateway', 'DeribitPriceHistoryDBGateway', 'DeribitVolHistoryDBUpdate', 'DeribitVolSurfaceBuilder',
+                'VolMetricsEngine', 'OptionChainSnapshot', 'HistoryReader', 'ParquetMirror', 'TableCompactor',
+                'DeribitStreamIngester', 'StreamingVolEngine', 'JobScheduler', 'MigrateDatabase']
+
+# the dependencies worth keeping off the import path of a job that does not use them
+HEAVY_PACKAGES = ['ccxt', 'QuantLib', 'scipy', 'pandas', 'pyarrow', 'aiohttp', 'numpy']
+
+DEFAULT_REPEATS = 5
+
+# run in a fresh interpreter; times just the import, and lists the heavy packages it pulled in
+_IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+print(json.dumps({{'seconds': seconds, 'loaded': [package for package in {heavy!r} if package in sys.modules]}}))
+"""
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(module: str) -> dict:
+    """ Import the module in a new interpreter (run from the package directory, as the jobs are)
+    """
+
+    completed = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_PACKAGES)],
+                               cwd=PACKAGE_DIRECTORY, capture_output=True, text=True, check=True)
+
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_import_benchmark(modules: list, repeats: int = DEFAULT_REPEATS) -> dict:
+    """ Median cold import time (ms) over 'repeats' fresh interpreters, and the heavy packages loaded, per module.
+        The interpreter's own start up is not included; it is the same for every module.
+    """
+
+    results = {}
+
+    for module in modules:
+        timings = [time_import(module) for _ in range(repeats)]
+        results[module] = {'median_ms': round(statistics.median(timing['seconds'] for timing in timings) * 1000, 1),
+                           'loaded': timings[-1]['loaded']}
+
+    return results
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv, "-hn:m:", ["repeats=", "modules="])
+
+    repeats = DEFAULT_REPEATS
+    modules = list(ENTRY_POINTS)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('python3 -m benchmarks.ImportTimeBenchmark -h -n <repeats> -m <module,module>')
+            sys.exit()
+
+        if opt in ("-n", "--repeats"):
+            try:
+                repeats = int(arg)
+            except Exception as e:
+                print(f'error {e}; repeats must be a whole number')
+                sys.exit()
+
+        if opt in ("-m", "--modules"):
+            modules = arg.split(',')
+
+    return repeats, modules
+
+
+if __name__ == "__main__":
+
+    repeats, modules = get_args(sys.argv[1:])
+
+    for module, result in run_import_benchmark(modules, repeats).items():
+        print(f"LOG {module:<30} {result['median_ms']:>8.1f}ms  LOADS {', '.join(result['loaded']) or '-'}")
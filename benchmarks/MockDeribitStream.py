@@ -0,0 +1,165 @@
+import asyncio
+import json
+import socket
+from datetime import datetime, timedelta
+import numpy as np
+from aiohttp import web, WSMsgType
+from benchmarks.SyntheticDeribitMarket import SyntheticDeribitMarket
+
+
+def load_recording(path: str) -> list:
+    """ The messages of a recording made with 'DeribitStreamIngester.py -r <file>', one per line
+    """
+
+    with open(path) as rf:
+        return [line.rstrip('\n') for line in rf if line.strip()]
+
+
+def _notification(channel: str, data) -> str:
+
+    return json.dumps({'jsonrpc': '2.0', 'method': 'subscription', 'params': {'channel': channel, 'data': data}})
+
+
+def synthetic_stream(market: SyntheticDeribitMarket, minutes: int = 10, updates_per_minute: int = 60,
+                     trade_fraction: float = 0.02, seed: int = 7) -> list:
+    """ Deribit shaped WebSocket messages for the live instruments of a synthetic market, as a recording would hold them.
+
+        Starts 'minutes / 2' before the first midnight after the market's window, so the stream closes a day bar.
+        Every update carries the marks of all options of a currency (markprice.options.*), a ticker per future
+        and perpetual, and trades in about 'trade_fraction' of the options.
+    """
+
+    random = np.random.default_rng(seed)
+
+    live = market.live()
+    tokens = sorted({instrument.token for instrument in live})
+    futures = [instrument for instrument in live if instrument.kind != 'option']
+    options = {token: [instrument for instrument in live if instrument.kind == 'option' and instrument.token == token] for token in tokens}
+
+    start = market.end_date + timedelta(days=1) - timedelta(minutes=minutes // 2)
+    start_ms = int((start - datetime(1970, 1, 1)).total_seconds() * 1000)
+    step_ms = 60 * 1000 // updates_per_minute
+
+    last_close = {instrument.instrument_name: float(instrument.close[-1]) for instrument in live}
+    messages = []
+
+    for update in range(minutes * updates_per_minute):
+        timestamp = start_ms + update * step_ms
+
+        # every price drifts by the same small move per token, so the marks stay consistent with each other
+        moves = {token: float(np.exp(random.normal(0, 0.0005))) for token in tokens}
+
+        for instrument in futures:
+            last_close[instrument.instrument_name] *= moves[instrument.token]
+            messages.append(_notification(f"ticker.{instrument.instrument_name}.100ms",
+                                          {'instrument_name': instrument.instrument_name, 'timestamp': timestamp,
+                                           'mark_price': round(last_close[instrument.instrument_name], 2)}))
+
+        for token in tokens:
+            marks = []
+
+            for instrument in options[token]:
+                last_close[instrument.instrument_name] *= moves[token]
+                marks.append({'instrument_name': instrument.instrument_name, 'timestamp': timestamp,
+                              'mark_price': round(last_close[instrument.instrument_name], 4), 'iv': None})
+
+            messages.append(_notification(f"markprice.options.{token.lower()}_usd", marks))
+
+            traded = [instrument for instrument in options[token] if random.random() < trade_fraction]
+
+            if traded:
+                messages.append(_notification(f"trades.option.{token}.100ms",
+                                              [{'instrument_name': instrument.instrument_name, 'timestamp': timestamp,
+                                                'price': round(last_close[instrument.instrument_name], 4),
+                                                'amount': float(random.integers(1, 50)) / 10}
+                                               for instrument in traded]))
+
+    return messages
+
+
+class MockDeribitStreamServer:
+    """ A local WebSocket server standing in for Deribit's api (/ws/api/v2); it replays recorded messages.
+
+        On 'public/subscribe' it replies with the channels, then sends every recorded notification on those channels,
+        in order, and closes the connection. Other requests (set_heartbeat, test) are answered with 'ok'.
+
+            async with MockDeribitStreamServer(messages) as server:
+                await DeribitStreamIngester(db_pool, markets, server.url).run(reconnect=False)
+
+        :param messages: recorded messages (see load_recording and synthetic_stream)
+        :param pace: messages per second to replay at; 0 replays them as fast as the client reads them
+    """
+
+    def __init__(self, messages: list, pace: float = 0):
+
+        self.pace = pace
+        self._notifications = []
+
+        for message in messages:
+            payload = json.loads(message)
+            if payload.get('method') == 'subscription':
+                self._notifications.append((payload['params']['channel'], message))
+
+        self._runner = None
+        self.url = None
+
+    async def _replay(self, ws: web.WebSocketResponse, channels: set) -> None:
+
+        for channel, message in self._notifications:
+            if channel in channels:
+                await ws.send_str(message)
+                if self.pace:
+                    await asyncio.sleep(1 / self.pace)
+
+    async def _handle(self, request: web.Request) -> web.WebSocketResponse:
+
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                break
+
+            request_json = json.loads(message.data)
+
+            if request_json.get('method') == 'public/subscribe':
+                channels = request_json['params']['channels']
+                await ws.send_str(json.dumps({'jsonrpc': '2.0', 'id': request_json['id'], 'result': channels}))
+                await self._replay(ws, set(channels))
+                break
+
+            await ws.send_str(json.dumps({'jsonrpc': '2.0', 'id': request_json.get('id'), 'result': 'ok'}))
+
+        await ws.close()
+
+        return ws
+
+    async def start(self) -> str:
+
+        app = web.Application()
+        app.router.add_get('/ws/api/v2', self._handle)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(self._runner, sock).start()
+
+        self.url = f"ws://127.0.0.1:{sock.getsockname()[1]}/ws/api/v2"
+
+        return self.url
+
+    async def stop(self) -> None:
+
+        await self._runner.cleanup()
+
+    async def __aenter__(self):
+
+        await self.start()
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+
+        await self.stop()
@@ -0,0 +1,226 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from benchmarks.SyntheticDeribitMarket import SyntheticDeribitMarket, SyntheticInstrument
+
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+
+
+class MockDeribitExchange:
+    """ Stands in for a ccxt.deribit() exchange, serving the live instruments of a synthetic market.
+
+        Only what CryptoPriceDBGateway uses is provided; load_markets(), fetch_ohlcv(), milliseconds() and the trades
+        of a currency (public_get_get_last_trades_by_currency_and_time). Responses go through a JSON round trip, as
+        ccxt's would, so the fetch costs what parsing a real one does.
+
+        :param as_of: serve the market as it was at this time (ms); bars after it are not there yet
+    """
+
+    def __init__(self, market: SyntheticDeribitMarket, rate_limit: int = 0, as_of: int = None):
+
+        self.id = 'deribit'
+        self.name = 'Deribit'
+        self.has = {'fetchOHLCV': True}
+        self.rateLimit = rate_limit
+        self.markets = {}
+        self.as_of = as_of
+
+        self._instruments = {instrument.symbol: instrument for instrument in market.live()}
+
+        # without as_of the exchange's clock is 10:00 on the day of the latest bar
+        latest = max((bars[-1][0] for bars in (instrument.bars(0, as_of) for instrument in self._instruments.values()) if bars),
+                     default=0)
+        self._now = as_of if as_of is not None else latest + 10 * HOUR_MS
+
+    def _market(self, instrument: SyntheticInstrument) -> dict:
+
+        return {'id': instrument.instrument_name,
+                'symbol': instrument.symbol,
+                'base': instrument.token,
+                'quote': 'USD',
+                'settle': instrument.token,
+                'type': {'perpetual': 'swap'}.get(instrument.kind, instrument.kind),
+                'expiry': instrument.expiration_timestamp if instrument.expiry else None,
+                'strike': instrument.strike,
+                'optionType': {'C': 'call', 'P': 'put'}.get(instrument.option_type)}
+
+    def load_markets(self, reload: bool = False) -> dict:
+
+        self.markets = json.loads(json.dumps({symbol: self._market(instrument) for symbol, instrument in self._instruments.items()}))
+
+        return self.markets
+
+    def fetch_ohlcv(self, symbol: str, timeframe: str = '1d', since: int = None, limit: int = None) -> list:
+        """ The last 'limit' daily bars of the symbol (or those from 'since')
+        """
+
+        bars = self._instruments[symbol].bars(since or 0, self.as_of)
+
+        return json.loads(json.dumps(bars[-limit:] if limit else bars))
+
+    def milliseconds(self) -> int:
+
+        return self._now
+
+    def _day_trades(self, index: int, instrument: SyntheticInstrument, day_timestamp: int) -> list:
+        """ Four trades that make up the instrument's bar of the day (open, high, low, then close), a quarter of its
+            volume each; future amounts are in USD, as deribit's are
+        """
+
+        bars = instrument.bars(day_timestamp, day_timestamp)
+        if not bars or not bars[0][5]:
+            return []
+
+        timestamp, open_price, high, low, close, volume = bars[0]
+        trades = []
+
+        for hour, price in enumerate((open_price, high, low, close), 1):
+            amount = volume / 4 if instrument.kind == 'option' else volume / 4 * price
+            trades.append({'trade_id': f'{index}-{hour}', 'instrument_name': instrument.instrument_name,
+                           'timestamp': timestamp + hour * HOUR_MS + index, 'price': price, 'amount': amount})
+
+        return trades
+
+    def public_get_get_last_trades_by_currency_and_time(self, params: dict) -> dict:
+        """ Deribit's trades of a currency between two timestamps, oldest first, a page of 'count' at a time
+        """
+
+        start_timestamp, end_timestamp = int(params['start_timestamp']), int(params['end_timestamp'])
+        day_timestamp = start_timestamp // DAY_MS * DAY_MS
+        trades = []
+
+        for index, instrument in enumerate(self._instruments.values()):
+            if instrument.token == params['currency']:
+                trades.extend(trade for trade in self._day_trades(index, instrument, day_timestamp)
+                              if start_timestamp <= trade['timestamp'] <= end_timestamp)
+
+        trades.sort(key=lambda trade: trade['timestamp'])
+        count = int(params.get('count', 10))
+
+        return json.loads(json.dumps({'result': {'trades': trades[:count], 'has_more': len(trades) > count}}))
+
+
+class MockCcxt:
+    """ Stands in for the ccxt module itself; exchanges and a constructor per exchange id, as
+        CryptoPriceDBGateway looks them up (e.g. ccxt.deribit())
+    """
+
+    def __init__(self, market: SyntheticDeribitMarket, rate_limit: int = 0, as_of: int = None):
+
+        self.exchanges = ['deribit']
+        self.deribit = lambda: MockDeribitExchange(market, rate_limit, as_of)
+
+
+class _HistoryRequestHandler(BaseHTTPRequestHandler):
+
+    server_version = 'MockDeribitHistory/1.0'
+
+    def log_message(self, format, *args):
+        # the benchmark would otherwise print a line per request
+        pass
+
+    def _reply(self, status: int, body: dict) -> None:
+
+        payload = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        handler = self.server.routes.get(url.path)
+
+        if handler is None:
+            self._reply(400, {'jsonrpc': '2.0', 'error': {'code': -32601, 'message': 'Method not found'}})
+            return
+
+        try:
+            self._reply(200, {'jsonrpc': '2.0', 'result': handler(params)})
+        except KeyError as e:
+            self._reply(400, {'jsonrpc': '2.0', 'error': {'code': 10001, 'message': f'unknown {e}'}})
+
+
+class MockDeribitHistoryServer:
+    """ A local HTTP server answering the history.deribit.com calls made by DeribitPriceHistoryDBGateway
+        (get_instruments and get_tradingview_chart_data) from the expired instruments of a synthetic market.
+
+            with MockDeribitHistoryServer(market) as server:
+                gateway.history_url = server.url
+    """
+
+    def __init__(self, market: SyntheticDeribitMarket):
+
+        self._instruments = {instrument.instrument_name: instrument for instrument in market.expired()}
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _HistoryRequestHandler)
+        self._server.daemon_threads = True
+        self._server.routes = {'/api/v2/public/get_instruments': self._get_instruments,
+                               '/api/v2/public/get_tradingview_chart_data': self._get_tradingview_chart_data}
+        self._thread = None
+
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def _instrument(self, instrument: SyntheticInstrument) -> dict:
+
+        instrument_json = {'instrument_name': instrument.instrument_name,
+                           'kind': instrument.kind,
+                           'base_currency': instrument.token,
+                           'counter_currency': 'USD',
+                           'settlement_currency': instrument.token,
+                           'settlement_period': 'month' if instrument.kind == 'future' else 'week',
+                           'expiration_timestamp': instrument.expiration_timestamp,
+                           'is_active': False}
+
+        if instrument.kind == 'option':
+            instrument_json['strike'] = instrument.strike
+            instrument_json['option_type'] = 'call' if instrument.option_type == 'C' else 'put'
+
+        return instrument_json
+
+    def _get_instruments(self, params: dict) -> list:
+
+        return [self._instrument(instrument) for instrument in self._instruments.values()
+                if instrument.token == params['currency']]
+
+    def _get_tradingview_chart_data(self, params: dict) -> dict:
+
+        instrument = self._instruments[params['instrument_name']]
+        bars = instrument.bars(int(float(params['start_timestamp'])), int(float(params['end_timestamp'])))
+
+        result = {'status': 'ok' if bars else 'no_data'}
+
+        for column, name in enumerate(['ticks', 'open', 'high', 'low', 'close', 'volume']):
+            result[name] = [bar[column] for bar in bars]
+
+        result['cost'] = [bar[5] * bar[4] for bar in bars]
+
+        return result
+
+    def start(self) -> str:
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-deribit-history', daemon=True)
+        self._thread.start()
+
+        return self.url
+
+    def stop(self) -> None:
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+
+        self.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.stop()
@@ -0,0 +1,219 @@
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from DatabaseGateway import DatabasePool
+
+
+# QuestDB column types as sqlite declares them; TIMESTAMP is kept so the values come back as datetimes
+COLUMN_TYPES = [(r"SYMBOL(\s+CAPACITY\s+\d+)?(\s+(NO)?CACHE)?(\s+INDEX)?", 'TEXT'),
+                (r"\bSTRING\b", 'TEXT'),
+                (r"\bLONG\b", 'INTEGER'),
+                (r"\bFLOAT\b", 'REAL'),
+                (r"\bDOUBLE\b", 'REAL')]
+
+DESIGNATED_TIMESTAMP = re.compile(r"\)\s*timestamp\((\w+)\)[^;]*", re.IGNORECASE)
+CREATE_TABLE = re.compile(r"CREATE TABLE (IF NOT EXISTS )?'?(\w+)'?", re.IGNORECASE)
+INTERVAL_FILTER = re.compile(r"(\w+) IN '(\d{4}-\d{2})(-\d{2})?'")
+DAY_EQUALS = re.compile(r"(\w+) = '(\d{4}-\d{2}-\d{2})'")
+LATEST_ON = re.compile(r"LATEST ON (\w+) PARTITION BY (\w+)", re.IGNORECASE)
+
+
+def _adapt_datetime(value: datetime) -> str:
+
+    return value.isoformat(' ')
+
+
+def _convert_timestamp(value: bytes) -> datetime:
+
+    return datetime.fromisoformat(value.decode())
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter('TIMESTAMP', _convert_timestamp)
+
+
+def _sql_literal(value) -> str:
+
+    if value is None:
+        return 'NULL'
+
+    if isinstance(value, (int, float)):
+        return repr(value)
+
+    if isinstance(value, datetime):
+        value = _adapt_datetime(value)
+
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _interval(match) -> str:
+    """ QuestDB's "ts IN '2023-06'" (a month, or a day) as a range on the column, so an index can serve it
+    """
+
+    column, month, day = match.group(1), match.group(2), match.group(3)
+
+    start = datetime.strptime(month + (day or '-01'), '%Y-%m-%d')
+    end = start + timedelta(days=1) if day else datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+    return f"({column} >= '{_adapt_datetime(start)}' AND {column} < '{_adapt_datetime(end)}')"
+
+
+def translate(query: str, params: tuple = None) -> str:
+    """ Rewrite the QuestDB dialect used by the jobs into sqlite
+    """
+
+    if params is not None:
+        query = query.replace('%s', '?').replace('%%', '%')
+
+    if CREATE_TABLE.search(query):
+        for questdb_type, sqlite_type in COLUMN_TYPES:
+            query = re.sub(questdb_type, sqlite_type, query)
+
+        query = DESIGNATED_TIMESTAMP.sub(')', query)
+
+    query = INTERVAL_FILTER.sub(_interval, query)
+    query = DAY_EQUALS.sub(lambda match: f"{match.group(1)} = '{match.group(2)} 00:00:00'", query)
+    # sqlite takes the bare columns of a group from the row holding its max()
+    query = LATEST_ON.sub(lambda match: f"GROUP BY {match.group(2)} HAVING max({match.group(1)})", query)
+    query = query.replace('count()', 'count(*)')
+
+    return query
+
+
+class StandInCursor:
+    """ A psycopg2 like cursor over the shared sqlite connection
+    """
+
+    def __init__(self, connection):
+
+        self.connection = connection
+        self._cursor = connection._database.cursor()
+        self.rowcount = -1
+
+    def execute(self, query, params: tuple = None) -> None:
+
+        if isinstance(query, bytes):
+            query = query.decode()
+
+        with self.connection._lock:
+            self._cursor.execute(translate(query, params), params or ())
+
+        self.rowcount = self._cursor.rowcount
+
+        # QuestDB indexes the designated timestamp and SYMBOL ... INDEX columns; sqlite needs telling
+        created = CREATE_TABLE.search(query)
+        if created:
+            self.connection._index_table(created.group(2), query)
+
+    @property
+    def description(self):
+
+        return self._cursor.description
+
+    def mogrify(self, template: bytes, args) -> bytes:
+        """ Used by psycopg2.extras.execute_values to build multi row inserts
+        """
+
+        return (template.decode().replace('%s', '{}').format(*[_sql_literal(arg) for arg in args])).encode()
+
+    def fetchone(self):
+
+        with self.connection._lock:
+            return self._cursor.fetchone()
+
+    def fetchmany(self, size: int) -> list:
+
+        with self.connection._lock:
+            return self._cursor.fetchmany(size)
+
+    def fetchall(self) -> list:
+
+        with self.connection._lock:
+            return self._cursor.fetchall()
+
+    def close(self) -> None:
+
+        self._cursor.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+
+class StandInConnection:
+    """ A psycopg2 like connection; every connection of the pool shares the one in-memory database
+    """
+
+    encoding = 'UTF8'
+    closed = 0
+
+    def __init__(self, database: sqlite3.Connection, lock: threading.RLock):
+
+        self._database = database
+        self._lock = lock
+
+    def cursor(self) -> StandInCursor:
+
+        return StandInCursor(self)
+
+    def commit(self) -> None:
+
+        with self._lock:
+            self._database.commit()
+
+    def rollback(self) -> None:
+
+        with self._lock:
+            self._database.rollback()
+
+    def _index_table(self, table: str, create_query: str) -> None:
+
+        columns = [match.group(1) for match in re.finditer(r"(\w+)\s+SYMBOL[^,)]*\bINDEX", create_query, re.IGNORECASE)]
+        designated = DESIGNATED_TIMESTAMP.search(create_query)
+
+        if designated:
+            columns.append(designated.group(1))
+
+        with self._lock:
+            for column in columns:
+                self._database.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})")
+
+
+class QuestDBStandInPool(DatabasePool):
+    """ An in-process, in-memory stand in for a QuestDB pool, for benchmarking the jobs without a database server.
+
+        Backed by sqlite; the QuestDB SQL used by the price and vol jobs (SYMBOL columns, designated timestamps,
+        "ExchangeDate IN '2023-06'" intervals and LATEST ON) is rewritten on the way through.
+        Timings are indicative of the jobs' own cost, not QuestDB's; benchmark against a QuestDB instance for that.
+    """
+
+    def __init__(self):
+
+        self.db_config = {'host': 'sqlite', 'port': ':memory:'}
+        self.pool_config = {'min_connections': 1, 'max_connections': 1, 'reconnect_attempts': 1, 'reconnect_delay': 0}
+
+        self._database = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self._lock = threading.RLock()
+
+    def get_connection(self) -> StandInConnection:
+
+        return StandInConnection(self._database, self._lock)
+
+    def put_connection(self, connection) -> None:
+
+        # every connection shares the one database, so there is nothing to give back
+        # (and rolling back here would undo another connection's uncommitted work)
+        pass
+
+    def reconnect(self, connection):
+
+        return self.get_connection()
+
+    def close(self) -> None:
+
+        self._database.close()
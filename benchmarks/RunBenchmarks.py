@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import sys, getopt
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import CryptoPriceDBGateway
+import DeribitPriceHistoryDBGateway
+from DatabaseGateway import DatabasePool, load_config
+from DeribitVolHistoryDBUpdate import DeribitVolHistoryDBUpdate
+from JobInstrumentation import instrumentation
+from benchmarks.MockExchanges import MockCcxt, MockDeribitHistoryServer
+from benchmarks.QuestDBStandIn import QuestDBStandInPool
+from benchmarks.SyntheticDeribitMarket import SyntheticDeribitMarket, SCALES
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+BACKENDS = ['standin', 'questdb']
+BENCHMARK_TABLES = ['OHLCV', 'OHLCV_VOL', 'INSTRUMENTS', 'VOL_SURFACE', 'VOL_METRICS', 'OPTION_CHAIN']
+
+# a stage fails if its throughput falls more than this fraction below the baseline
+DEFAULT_TOLERANCE = 0.2
+
+# Deribit's own rate limit, when the benchmark is asked to keep the jobs' sleeps
+DERIBIT_RATE_LIMIT_MS = 50
+
+
+class _NoSleep:
+    """ The time module with sleep() a no-op; the mock exchanges have no rate limits to respect
+    """
+
+    def __getattr__(self, name):
+
+        return getattr(time, name)
+
+    def sleep(self, seconds: float) -> None:
+
+        pass
+
+
+@contextmanager
+def _patched(module, **attributes):
+    """ Set module attributes for the duration of a with block
+    """
+
+    originals = {name: getattr(module, name, None) for name in attributes}
+
+    for name, value in attributes.items():
+        setattr(module, name, value)
+
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(module, name, value)
+
+
+class JobBenchmark:
+    """ Times the ingest and vol jobs end to end against a synthetic Deribit market.
+
+        The market's live instruments are served through a mock ccxt exchange (CryptoPriceDBGateway), first as of
+        the day before the last (every candle fetched) and then for the last day (the daily run, from the day's trades),
+        its expired instruments through a mock history.deribit.com server (DeribitPriceHistoryDBGateway),
+        and the vol job then solves the vols for every price written, as it would after those jobs.
+
+        :param market: the synthetic market to serve
+        :param db_pool: an in-process stand in, or a pool onto a scratch QuestDB; the price and vol tables are dropped first
+        :param rate_limits: keep the jobs' rate limit sleeps, rather than skipping them
+    """
+
+    def __init__(self, market: SyntheticDeribitMarket, db_pool: DatabasePool, rate_limits: bool = False):
+
+        self.market = market
+        self.db_pool = db_pool
+        self.rate_limits = rate_limits
+
+        self.logger = logging.getLogger('BENCHMARK')
+
+    def info_logger(self, message):
+
+        self.logger.info(message)
+        print("LOG", message)
+
+    def _reset_tables(self) -> None:
+        """ Start from empty tables, so every run does the same work
+        """
+
+        with self.db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                for table in BENCHMARK_TABLES:
+                    cursor.execute(f'''DROP TABLE IF EXISTS {table};''')
+                CryptoPriceDBGateway.check_ohlcv_table_exists(cursor)
+            connection.commit()
+
+    def _count_rows(self, table: str) -> int:
+
+        with self.db_pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'''SELECT count() FROM {table};''')
+                return cursor.fetchone()[0]
+
+    def _timed(self, stage: str, job, rows) -> (dict, object):
+        """ Run the job, then count what it wrote with rows(result).
+            Returns the stage's result (with the job's own stage timings) and the job's return value.
+        """
+
+        instrumentation.reset()
+
+        started = time.perf_counter()
+        result = job()
+        seconds = time.perf_counter() - started
+
+        row_count = rows(result)
+
+        stage_result = {'rows': row_count, 'seconds': round(seconds, 3),
+                        'rows_per_second': round(row_count / seconds, 1) if seconds else 0.0,
+                        'timings': instrumentation.summary()}
+
+        self.info_logger(f"{stage.upper()}: {row_count} ROWS IN {seconds:.1f}s = {stage_result['rows_per_second']} ROWS/s")
+        for line in stage_result['timings']:
+            self.info_logger(f"    {line}")
+
+        return stage_result, result
+
+    def _run_price_update(self, as_of: int = None) -> set:
+
+        mock_ccxt = MockCcxt(self.market, DERIBIT_RATE_LIMIT_MS if self.rate_limits else 0, as_of)
+
+        # the gateway's logger is only set up when it is run as a script
+        with _patched(CryptoPriceDBGateway, ccxt=mock_ccxt, logger=self.logger):
+            with self.db_pool.connection() as connection:
+                cursor = connection.cursor()
+                written_keys = CryptoPriceDBGateway.update_markets({'exchanges': ['deribit']}, connection, cursor)
+                cursor.close()
+
+        return written_keys
+
+    def _run_price_history(self) -> set:
+
+        sleeps = {} if self.rate_limits else {'time': _NoSleep()}
+
+        with MockDeribitHistoryServer(self.market) as server, _patched(DeribitPriceHistoryDBGateway, **sleeps):
+            gateway = DeribitPriceHistoryDBGateway.DeribitPriceHistoryDBGateway(self.db_pool)
+            gateway.history_url = server.url
+            written_keys = gateway._process_historic_ohlcv()
+            gateway._release_connection()
+
+        return written_keys
+
+    def _run_vol_update(self, price_keys: set) -> None:
+
+        vol_update = DeribitVolHistoryDBUpdate(self.db_pool)
+        vol_update._update_vol_data_for_keys(price_keys)
+
+    def run(self) -> dict:
+        """ Run the jobs in turn. Returns the rows, seconds and rows per second of each.
+        """
+
+        self.info_logger(f"SYNTHETIC MARKET: {self.market.describe()}")
+
+        self._reset_tables()
+
+        results = {}
+
+        last_day = int((self.market.end_date - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+        results['price'], price_keys = self._timed('price', lambda: self._run_price_update(last_day - 1), len)
+        results['price_daily'], daily_keys = self._timed('price_daily', self._run_price_update, len)
+        results['history'], history_keys = self._timed('history', self._run_price_history, len)
+        results['vol'], _ = self._timed('vol', lambda: self._run_vol_update(price_keys | daily_keys | history_keys),
+                                        lambda _: self._count_rows('OHLCV_VOL'))
+
+        return results
+
+
+def baseline_key(backend: str, market: SyntheticDeribitMarket) -> str:
+
+    return f"{backend}/{market.options}x{market.days}"
+
+
+def load_baseline() -> dict:
+
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+
+    with open(BASELINE_FILE) as bf:
+        return json.load(bf)
+
+
+def save_baseline(key: str, results: dict) -> None:
+
+    baseline = load_baseline()
+    baseline[key] = {stage: result['rows_per_second'] for stage, result in results.items()}
+
+    with open(BASELINE_FILE, 'w') as bf:
+        json.dump(baseline, bf, indent=4, sort_keys=True)
+
+
+def find_regressions(key: str, results: dict, tolerance: float) -> list:
+    """ Stages whose throughput is more than 'tolerance' below the stored baseline for the same backend and scale
+    """
+
+    baseline = load_baseline().get(key)
+
+    if baseline is None:
+        print(f"LOG NO BASELINE FOR {key}; RUN WITH -u TO RECORD ONE")
+        return []
+
+    regressions = []
+
+    for stage, result in results.items():
+        expected = baseline.get(stage)
+        if expected and result['rows_per_second'] < expected * (1 - tolerance):
+            regressions.append(f"{stage}: {result['rows_per_second']} ROWS/s AGAINST A BASELINE OF {expected} ROWS/s")
+
+    return regressions
+
+
+def get_db_pool(backend: str) -> DatabasePool:
+    """ The stand in, or a pool onto the scratch QuestDB named in the [benchmark] section of the config;
+        never the [database] one, as the benchmark drops the price and vol tables
+    """
+
+    if backend == 'standin':
+        return QuestDBStandInPool()
+
+    db_config = load_config('benchmark', {})
+
+    if 'host' not in db_config:
+        print("error; the questdb backend needs a [benchmark] section in CryptoAlgo.toml naming a scratch QuestDB "
+              "(user, password, host, port, database); its price and vol tables are dropped")
+        sys.exit(1)
+
+    return DatabasePool(db_config, {'min_connections': 1, 'max_connections': 4})
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv, "-hs:o:d:b:t:ur", ["scale=", "options=", "days=", "backend=", "tolerance=", "update", "rate-limits"])
+
+    scale = dict(SCALES['small'])
+    backend = 'standin'
+    tolerance = DEFAULT_TOLERANCE
+    update = False
+    rate_limits = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('python3 -m benchmarks.RunBenchmarks -h -s <small|medium|large> -o <options> -d <days> '
+                  '-b <standin|questdb> -t <0.2> -u (--update baseline) -r (--rate-limits)')
+            sys.exit()
+
+        if opt in ("-s", "--scale"):
+            if arg not in SCALES:
+                print(f'error; scale must be one of {list(SCALES)}')
+                sys.exit()
+            scale = dict(SCALES[arg])
+
+        if opt in ("-o", "--options", "-d", "--days"):
+            try:
+                scale['options' if opt in ("-o", "--options") else 'days'] = int(arg)
+            except Exception as e:
+                print(f'error {e}; options and days must be whole numbers')
+                sys.exit()
+
+        if opt in ("-b", "--backend"):
+            if arg not in BACKENDS:
+                print(f'error; backend must be one of {BACKENDS}')
+                sys.exit()
+            backend = arg
+
+        if opt in ("-t", "--tolerance"):
+            try:
+                tolerance = float(arg)
+            except Exception as e:
+                print(f'error {e}; tolerance must be a fraction <0.2>')
+                sys.exit()
+
+        if opt in ("-u", "--update"):
+            update = True
+
+        if opt in ("-r", "--rate-limits"):
+            rate_limits = True
+
+    return scale, backend, tolerance, update, rate_limits
+
+
+if __name__ == "__main__":
+
+    scale, backend, tolerance, update, rate_limits = get_args(sys.argv[1:])
+
+    market = SyntheticDeribitMarket(scale['options'], scale['days'])
+    key = baseline_key(backend, market)
+
+    results = JobBenchmark(market, get_db_pool(backend), rate_limits).run()
+
+    if update:
+        save_baseline(key, results)
+        print(f"LOG BASELINE FOR {key} SAVED TO {BASELINE_FILE}")
+        sys.exit()
+
+    regressions = find_regressions(key, results, tolerance)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,116 @@
+import asyncio
+import sys, getopt
+import time
+from DeribitStreamIngester import DeribitStreamIngester
+from StreamingVolEngine import StreamingVolEngine
+from benchmarks.MockDeribitStream import MockDeribitStreamServer, synthetic_stream, load_recording
+from benchmarks.QuestDBStandIn import QuestDBStandInPool
+from benchmarks.SyntheticDeribitMarket import SyntheticDeribitMarket
+
+
+# about the size of Deribit's BTC and ETH option universe
+DEFAULT_OPTIONS = 2000
+DEFAULT_MINUTES = 10
+# Deribit sends option marks about once a second
+UPDATES_PER_MINUTE = 60
+
+
+async def _replay(ingester: DeribitStreamIngester, messages: list) -> None:
+
+    async with MockDeribitStreamServer(messages) as server:
+        ingester.url = server.url
+        await ingester.run(reconnect=False)
+
+
+def run_stream_benchmark(messages: list, markets: dict, live_updates_per_second: float = None, vols: bool = False) -> dict:
+    """ Replay the messages through the ingester as fast as it can take them, on one core, into the sqlite stand in.
+        The stand in server shares the ingester's event loop, so the rates are a lower bound.
+
+        :param live_updates_per_second: the update rate of the live stream the messages stand for; the headroom
+                                        is how many times faster than that the ingester keeps up
+        :param vols: solve the option vols tick by tick as well (StreamingVolEngine)
+    """
+
+    db_pool = QuestDBStandInPool()
+    ingester = DeribitStreamIngester(db_pool, markets, url='')
+
+    engine = None
+    if vols:
+        engine = StreamingVolEngine(db_pool)
+        ingester.add_listener(engine)
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    asyncio.run(_replay(ingester, messages))
+    seconds, cpu_seconds = time.perf_counter() - started, time.process_time() - cpu_started
+
+    result = {'messages': ingester.messages, 'updates': ingester.updates, 'rows': ingester.rows_written,
+              'seconds': round(seconds, 2), 'cpu_seconds': round(cpu_seconds, 2),
+              'updates_per_second': round(ingester.updates / seconds, 1) if seconds else 0.0}
+
+    if live_updates_per_second:
+        result['headroom'] = round(result['updates_per_second'] / live_updates_per_second, 1)
+
+    if engine:
+        result.update({'vols_solved': engine.solved, 'vols_failed': engine.failed}, **engine.latency_summary())
+
+    return result
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv, "-ho:m:f:v", ["options=", "minutes=", "file=", "vols"])
+
+    options = DEFAULT_OPTIONS
+    minutes = DEFAULT_MINUTES
+    recording = None
+    vols = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print('python3 -m benchmarks.StreamBenchmark -h -o <options> -m <minutes> -f <recording file> -v')
+            sys.exit()
+
+        if opt in ("-o", "--options", "-m", "--minutes"):
+            try:
+                if opt in ("-o", "--options"):
+                    options = int(arg)
+                else:
+                    minutes = int(arg)
+            except Exception as e:
+                print(f'error {e}; options and minutes must be whole numbers')
+                sys.exit()
+
+        if opt in ("-f", "--file"):
+            recording = arg
+
+        if opt in ("-v", "--vols"):
+            vols = True
+
+    return options, minutes, recording, vols
+
+
+if __name__ == "__main__":
+
+    options, minutes, recording, vols = get_args(sys.argv[1:])
+
+    if recording:
+        # a real recording; the instrument names are mapped to symbols through ccxt, as the live ingester does
+        result = run_stream_benchmark(load_recording(recording), None, vols=vols)
+    else:
+        market = SyntheticDeribitMarket(options, 30)
+        live = market.live()
+        print(f"LOG SYNTHETIC STREAM: {len(live)} LIVE INSTRUMENTS, {minutes} MINUTES AT {UPDATES_PER_MINUTE} UPDATES A MINUTE")
+
+        result = run_stream_benchmark(synthetic_stream(market, minutes, UPDATES_PER_MINUTE),
+                                      {instrument.instrument_name: instrument.symbol for instrument in live},
+                                      len(live) * UPDATES_PER_MINUTE / 60, vols)
+
+    print(f"LOG {result['messages']} MESSAGES, {result['updates']} UPDATES AND {result['rows']} ROWS WRITTEN IN {result['seconds']}s "
+          f"({result['cpu_seconds']}s CPU) = {result['updates_per_second']} UPDATES/s")
+
+    if 'headroom' in result:
+        print(f"LOG {result['headroom']}x THE LIVE UPDATE RATE ON ONE CORE")
+
+    if 'vols_solved' in result:
+        print(f"LOG {result['vols_solved']} VOLS SOLVED ({result['vols_failed']} FAILED); TICK TO VOL "
+              f"{result.get('p50_ms')}ms MEDIAN, {result.get('p99_ms')}ms P99, {result.get('max_ms')}ms MAX")
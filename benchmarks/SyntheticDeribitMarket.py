@@ -0,0 +1,280 @@
+import math
+from datetime import datetime, timedelta
+import numpy as np
+
+
+# spot at the start of the window, and the (annualised) vol of its random walk
+TOKENS = {'BTC': {'spot': 30000.0, 'vol': 0.60},
+          'ETH': {'spot': 2000.0, 'vol': 0.75}}
+
+# days before expiry each kind of instrument is listed
+WEEKLY_LISTING_DAYS = 28
+MONTHLY_LISTING_DAYS = 182
+
+# annualised basis of the futures over spot
+FUTURES_BASIS = 0.05
+
+# option prices are quoted in the token, to Deribit's minimum tick
+OPTION_TICK = 0.0001
+
+SCALES = {'small': {'options': 200, 'days': 60},
+          'medium': {'options': 1000, 'days': 180},
+          'large': {'options': 5000, 'days': 365}}
+
+
+class SyntheticInstrument:
+    """ A single synthetic perpetual, future or option and its daily OHLCV bars.
+
+        Bars are numpy arrays over the instrument's life within the window; ticks are
+        the (UTC midnight) bar timestamps in ms, as in Deribit's tradingview chart data.
+    """
+
+    __slots__ = ('token', 'kind', 'expiry', 'strike', 'option_type', 'ticks', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, token: str, kind: str, expiry: datetime = None, strike: float = None, option_type: str = None):
+
+        self.token = token
+        self.kind = kind
+        self.expiry = expiry
+        self.strike = strike
+        self.option_type = option_type
+
+    @property
+    def expiration_timestamp(self) -> int:
+        # Deribit expiries are at 08:00 UTC
+        return int((self.expiry + timedelta(hours=8) - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+    @property
+    def instrument_name(self) -> str:
+        """ Deribit's own name, e.g. BTC-29DEC23-30000-C
+        """
+
+        if self.kind == 'perpetual':
+            return f"{self.token}-PERPETUAL"
+
+        name = f"{self.token}-{self.expiry.day}{self.expiry.strftime('%b%y').upper()}"
+
+        if self.kind == 'option':
+            name += f"-{int(self.strike)}-{self.option_type}"
+
+        return name
+
+    @property
+    def symbol(self) -> str:
+        """ The ccxt style symbol, e.g. BTC/USD:BTC-231229-30000-C
+        """
+
+        symbol = f"{self.token}/USD:{self.token}"
+
+        if self.kind != 'perpetual':
+            symbol += f"-{self.expiry:%y%m%d}"
+
+        if self.kind == 'option':
+            symbol += f"-{int(self.strike)}-{self.option_type}"
+
+        return symbol
+
+    def bars(self, start_timestamp: int = 0, end_timestamp: int = None) -> list:
+        """ [timestamp, open, high, low, close, volume] rows between the given timestamps (ms), as ccxt returns them
+        """
+
+        rows = zip(self.ticks.tolist(), self.open.tolist(), self.high.tolist(), self.low.tolist(),
+                   self.close.tolist(), self.volume.tolist())
+
+        return [list(row) for row in rows if row[0] >= start_timestamp and (end_timestamp is None or row[0] <= end_timestamp)]
+
+
+class SyntheticDeribitMarket:
+    """ A reproducible, Deribit shaped market for benchmarking the price and vol jobs without the exchange.
+
+        For each token a daily spot path is simulated (a lognormal random walk); from it
+            - a perpetual, priced at spot,
+            - month end futures, listed six months ahead and priced at spot plus a basis,
+            - weekly and month end option chains, with strikes set around spot when listed and priced with
+              Black 76 on the future using a smiled vol, in token terms as Deribit quotes them.
+
+        :param options: number of options listed on any one day, across all tokens (the chain size)
+        :param days: number of days of history, ending on end_date
+        :param end_date: the last day of history; instruments expiring by then are 'expired' (history api),
+                         the rest are 'live' (ccxt)
+        :param seed: random seed; the same arguments always give the same market
+    """
+
+    def __init__(self, options: int = 200, days: int = 60, end_date: datetime = datetime(2023, 12, 29), seed: int = 7):
+
+        self.options = options
+        self.days = days
+        self.end_date = end_date
+        self.start_date = end_date - timedelta(days=days - 1)
+
+        self._random = np.random.default_rng(seed)
+
+        self.dates = [self.start_date + timedelta(days=i) for i in range(days)]
+        self.ticks = np.array([int((date - datetime(1970, 1, 1)).total_seconds() * 1000) for date in self.dates], dtype=np.int64)
+
+        self.instruments: list = []
+
+        for token in TOKENS:
+            self._add_token(token)
+
+    def _spot_path(self, token: str) -> (np.ndarray, np.ndarray):
+        """ Daily open and close spot prices; each day opens at the previous close
+        """
+
+        vol = TOKENS[token]['vol']
+        daily_returns = self._random.normal(-0.5 * vol ** 2 / 365, vol / math.sqrt(365), self.days)
+
+        close_prices = TOKENS[token]['spot'] * np.exp(np.cumsum(daily_returns))
+        open_prices = np.concatenate(([TOKENS[token]['spot']], close_prices[:-1]))
+
+        return open_prices, close_prices
+
+    def _expiries(self) -> list:
+        """ (expiry, listing days) of every Friday expiry alive at some point in the window
+            month end Fridays are listed six months ahead, the other Fridays four weeks ahead
+        """
+
+        expiries = []
+
+        expiry = self.start_date + timedelta(days=(4 - self.start_date.weekday()) % 7)
+        last_expiry = self.end_date + timedelta(days=MONTHLY_LISTING_DAYS)
+
+        while expiry <= last_expiry:
+            month_end = (expiry + timedelta(days=7)).month != expiry.month
+            expiries.append((expiry, MONTHLY_LISTING_DAYS if month_end else WEEKLY_LISTING_DAYS))
+            expiry += timedelta(days=7)
+
+        return expiries
+
+    def _live_days(self, expiry: datetime, listing_days: int) -> slice:
+        """ The window days on which an instrument listed 'listing_days' before expiry trades
+        """
+
+        first = max(0, (expiry - timedelta(days=listing_days) - self.start_date).days)
+        last = min(self.days - 1, (expiry - self.start_date).days)
+
+        return slice(first, last + 1)
+
+    def _set_bars(self, instrument: SyntheticInstrument, live: slice, open_prices: np.ndarray, close_prices: np.ndarray, tick: float) -> None:
+
+        days = live.stop - live.start
+
+        instrument.ticks = self.ticks[live]
+        # rounded to the tick, and then again to drop the float noise from the multiply
+        instrument.open = np.maximum(np.round(np.round(open_prices / tick) * tick, 8), 0)
+        instrument.close = np.maximum(np.round(np.round(close_prices / tick) * tick, 8), 0)
+        instrument.high = np.maximum(instrument.open, instrument.close) * (1 + self._random.uniform(0, 0.03, days))
+        instrument.low = np.minimum(instrument.open, instrument.close) * (1 - self._random.uniform(0, 0.03, days))
+        instrument.volume = np.round(self._random.exponential(50, days), 1)
+
+        self.instruments.append(instrument)
+
+    def _forward(self, spot: np.ndarray, years: np.ndarray) -> np.ndarray:
+
+        return spot * np.exp(FUTURES_BASIS * years)
+
+    def _years_to_expiry(self, expiry: datetime, live: slice, close: bool) -> np.ndarray:
+        """ Year fractions from each day's open (or close, a day later) to expiry
+        """
+
+        days = (expiry - self.start_date).days - np.arange(live.start, live.stop) - (1 if close else 0)
+
+        return np.maximum(days, 0) / 365
+
+    def _black76(self, forward: np.ndarray, strike: float, years: np.ndarray, vol: np.ndarray, is_call: bool) -> np.ndarray:
+
+        intrinsic = np.maximum(forward - strike, 0) if is_call else np.maximum(strike - forward, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deviation = vol * np.sqrt(years)
+            d1 = (np.log(forward / strike) + 0.5 * deviation ** 2) / deviation
+            d2 = d1 - deviation
+
+        erf = np.vectorize(math.erf)
+        n1, n2 = 0.5 * (1 + erf(d1 / math.sqrt(2))), 0.5 * (1 + erf(d2 / math.sqrt(2)))
+
+        price = forward * n1 - strike * n2 if is_call else strike * (1 - n2) - forward * (1 - n1)
+
+        return np.where(years > 0, price, intrinsic)
+
+    def _smile(self, token: str, forward: np.ndarray, strike: float) -> np.ndarray:
+
+        moneyness = np.log(strike / forward)
+
+        return TOKENS[token]['vol'] * (1 + 0.8 * moneyness ** 2 - 0.1 * moneyness)
+
+    def _strikes(self, spot: float, years: float, vol: float, count: int) -> list:
+        """ 'count' strikes spanning +/- 1.5 standard deviations, rounded to a 4 significant figure increment
+        """
+
+        increment = 10 ** max(0, math.floor(math.log10(spot)) - 3)
+        deviation = 1.5 * vol * math.sqrt(max(years, 1 / 365))
+
+        strikes = {round(spot * math.exp(x) / increment) * increment for x in np.linspace(-deviation, deviation, count)}
+
+        return sorted(strike for strike in strikes if strike > 0)
+
+    def _add_token(self, token: str) -> None:
+
+        spot_open, spot_close = self._spot_path(token)
+        all_days = slice(0, self.days)
+
+        self._set_bars(SyntheticInstrument(token, 'perpetual'), all_days, spot_open, spot_close, 0.5)
+
+        expiries = self._expiries()
+
+        # strikes per expiry and option type, for 'options' listed across all tokens on the average day
+        live_expiries = sum(listing_days for _, listing_days in expiries) / max(1, (expiries[-1][0] - expiries[0][0]).days)
+        strike_count = max(2, round(self.options / (len(TOKENS) * 2 * max(1.0, live_expiries))))
+
+        for expiry, listing_days in expiries:
+
+            live = self._live_days(expiry, listing_days)
+
+            if live.start >= live.stop:
+                continue
+
+            open_years = self._years_to_expiry(expiry, live, close=False)
+            close_years = self._years_to_expiry(expiry, live, close=True)
+            forward_open = self._forward(spot_open[live], open_years)
+            forward_close = self._forward(spot_close[live], close_years)
+
+            if listing_days == MONTHLY_LISTING_DAYS:
+                self._set_bars(SyntheticInstrument(token, 'future', expiry), live, forward_open, forward_close, 0.5)
+
+            listing_spot = spot_open[live][0]
+
+            for strike in self._strikes(listing_spot, open_years[0], TOKENS[token]['vol'], strike_count):
+                for option_type in ('C', 'P'):
+                    is_call = option_type == 'C'
+                    open_prices = self._black76(forward_open, strike, open_years, self._smile(token, forward_open, strike), is_call)
+                    close_prices = self._black76(forward_close, strike, close_years, self._smile(token, forward_close, strike), is_call)
+
+                    # quoted in the token, as a fraction of the forward
+                    self._set_bars(SyntheticInstrument(token, 'option', expiry, float(strike), option_type), live,
+                                   open_prices / forward_open, close_prices / forward_close, OPTION_TICK)
+
+    def expired(self) -> list:
+        """ Instruments that have expired by the end of the window; served by the history api
+        """
+
+        return [instrument for instrument in self.instruments if instrument.expiry is not None and instrument.expiry <= self.end_date]
+
+    def live(self) -> list:
+        """ Instruments still trading at the end of the window; served by the (ccxt) live api
+        """
+
+        return [instrument for instrument in self.instruments if instrument.expiry is None or instrument.expiry > self.end_date]
+
+    def price_rows(self) -> int:
+
+        return sum(len(instrument.ticks) for instrument in self.instruments)
+
+    def describe(self) -> str:
+
+        kinds = {}
+        for instrument in self.instruments:
+            kinds[instrument.kind] = kinds.get(instrument.kind, 0) + 1
+
+        return (f"{self.days} DAYS {self.start_date:%Y-%m-%d} TO {self.end_date:%Y-%m-%d}; INSTRUMENTS {kinds}; "
+                f"{len(self.expired())} EXPIRED, {len(self.live())} LIVE; {self.price_rows()} DAILY BARS")
@@ -0,0 +1,298 @@
+import math
+import sys, getopt
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from DeribitVolCalculator import DeribitVolCalculator
+
+
+# the grid; strikes as a fraction of the forward, terms in days, vols in %
+MONEYNESS_GRID = [0.5, 0.7, 0.8, 0.9, 0.95, 1.0, 1.05, 1.1, 1.25, 1.5, 2.0]
+TERM_GRID = [1, 2, 7, 14, 30, 90, 180, 365]
+VOL_GRID = [20.0, 50.0, 80.0, 120.0, 200.0]
+OPTION_TYPES = ['C', 'P']
+
+FORWARD = 30000.0
+CALCULATION_DATE = datetime(2023, 6, 1)
+
+# bounds of the (QuantLib) solver; vols outside these have no solution
+MIN_VOL = 0.0001
+MAX_VOL = 4.0
+
+# standard deviations out of the money beyond which an option counts as deep OTM
+DEEP_OTM_DEVIATIONS = 2.0
+
+# a vol point moving the mark (in token terms) by less than this is lost in the float precision of the price;
+# the vol of such a point cannot be recovered by any solver, so it is reported apart from the errors
+MIN_IDENTIFIABLE_VEGA = 1e-12
+
+
+def _norm_cdf(x: np.ndarray) -> np.ndarray:
+
+    return 0.5 * (1 + np.vectorize(math.erf)(x / math.sqrt(2)))
+
+
+def black76(forward: np.ndarray, strike: np.ndarray, years: np.ndarray, vol: np.ndarray, is_call: np.ndarray,
+            discount: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """ Black 76 price, delta (to the forward) and vega (per unit vol) of European options
+    """
+
+    deviation = vol * np.sqrt(years)
+    d1 = (np.log(forward / strike) + 0.5 * deviation ** 2) / deviation
+    d2 = d1 - deviation
+
+    n1, n2 = _norm_cdf(d1), _norm_cdf(d2)
+
+    price = discount * np.where(is_call, forward * n1 - strike * n2, strike * (1 - n2) - forward * (1 - n1))
+    delta = discount * np.where(is_call, n1, n1 - 1)
+    vega = discount * forward * np.sqrt(years) * np.exp(-0.5 * d1 ** 2) / math.sqrt(2 * math.pi)
+
+    return price, delta, vega
+
+
+class VolGrid:
+    """ Every combination of the strike, term, vol and call/put grids, priced with Black 76
+        to give the (token denominated, as Deribit quotes) mark prices to invert.
+
+        :param risk_free_rate: rate (%) the marks are discounted at, as the calculator does (continuous, Actual/360)
+        :param tick: if given, marks are rounded to this tick (Deribit's is 0.0001), as real marks are
+    """
+
+    def __init__(self, risk_free_rate: float = 0.0, tick: float = None):
+
+        points = [(moneyness, term, vol, option_type) for moneyness in MONEYNESS_GRID for term in TERM_GRID
+                  for vol in VOL_GRID for option_type in OPTION_TYPES]
+
+        self.moneyness = np.array([point[0] for point in points])
+        self.terms = np.array([point[1] for point in points])
+        self.vols = np.array([point[2] for point in points])
+        self.option_types = [point[3] for point in points]
+
+        self.strikes = np.round(FORWARD * self.moneyness)
+        self.is_call = np.array([option_type == 'C' for option_type in self.option_types])
+        self.years = self.terms / 365
+        self.discount = np.exp(-risk_free_rate / 100 * self.terms / 360)
+
+        usd_prices, self.deltas, vegas = black76(FORWARD, self.strikes, self.years, self.vols / 100, self.is_call, self.discount)
+
+        self.marks = usd_prices / FORWARD
+        if tick:
+            self.marks = np.round(self.marks / tick) * tick
+
+        # the mark moves by at least a tick (or by more than the float noise) per vol point
+        self.identifiable = vegas / 100 / FORWARD >= max(tick or 0, MIN_IDENTIFIABLE_VEGA)
+
+        self.regions = [self._region(term, moneyness, vol, is_call)
+                        for term, moneyness, vol, is_call in zip(self.terms, self.moneyness, self.vols, self.is_call)]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _region(self, term: int, moneyness: float, vol: float, is_call: bool) -> str:
+        """ term bucket / moneyness bucket, e.g. 'expiry/deep_otm'
+        """
+
+        if term == 1:
+            term_bucket = 'expiry'
+        elif term <= 7:
+            term_bucket = 'week'
+        elif term <= 90:
+            term_bucket = 'quarter'
+        else:
+            term_bucket = 'long'
+
+        # standard deviations out of the money (negative when in the money)
+        deviations = math.log(moneyness if is_call else 1 / moneyness) / (vol / 100 * math.sqrt(term / 365))
+
+        if abs(deviations) < 0.25:
+            moneyness_bucket = 'atm'
+        elif deviations < 0:
+            moneyness_bucket = 'itm'
+        elif deviations < DEEP_OTM_DEVIATIONS:
+            moneyness_bucket = 'otm'
+        else:
+            moneyness_bucket = 'deep_otm'
+
+        return f"{term_bucket}/{moneyness_bucket}"
+
+
+class QuantLibBackend:
+    """ The production solver; DeribitVolCalculator._calc_implied_vol_strike_and_delta, one option at a time
+    """
+
+    name = 'quantlib'
+
+    def __init__(self, risk_free_rate: float = 0.0):
+
+        self.calculator = DeribitVolCalculator(risk_free_rate=risk_free_rate)
+
+    def solve(self, grid: VolGrid) -> (np.ndarray, np.ndarray):
+        """ Implied vols (%) and deltas for every grid point; nan where the solve failed
+        """
+
+        vols = np.full(len(grid), np.nan)
+        deltas = np.full(len(grid), np.nan)
+
+        for i in range(len(grid)):
+            term = int(grid.terms[i])
+            expiry = CALCULATION_DATE + timedelta(days=term)
+            symbol = f"BTC/USD:BTC-{expiry:%y%m%d}-{int(grid.strikes[i])}-{grid.option_types[i]}"
+
+            # OHLCV records; the open price is column 6
+            option_price = (CALCULATION_DATE, 'deribit', symbol, CALCULATION_DATE, CALCULATION_DATE, 0,
+                            float(grid.marks[i]), None, None, None, None)
+            future_curve = {term: (CALCULATION_DATE, 'deribit', 'BTC/USD:BTC', CALCULATION_DATE, CALCULATION_DATE, 0,
+                                   FORWARD, None, None, FORWARD, None)}
+
+            result = self.calculator._calc_implied_vol_strike_and_delta('open', option_price, future_curve,
+                                                                        CALCULATION_DATE, expiry, term)
+            if result:
+                vols[i], deltas[i] = result[0], result[2]
+
+        return vols, deltas
+
+
+class Black76NewtonBackend:
+    """ A vectorised alternative; Newton steps on the Black 76 price, kept inside a bisection bracket
+        so steps that would leave it (flat vega in the wings) bisect instead
+    """
+
+    name = 'black76'
+
+    def __init__(self, risk_free_rate: float = 0.0, tolerance: float = 1e-10, max_iterations: int = 100):
+
+        self.risk_free_rate = risk_free_rate
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def solve(self, grid: VolGrid) -> (np.ndarray, np.ndarray):
+
+        target = grid.marks * FORWARD
+        forward = np.full(len(grid), FORWARD)
+
+        low = np.full(len(grid), MIN_VOL)
+        high = np.full(len(grid), MAX_VOL)
+
+        # Brenner-Subrahmanyam, a good start near the money
+        vol = np.clip(math.sqrt(2 * math.pi) * grid.marks / (grid.discount * np.sqrt(grid.years)), 0.05, 2.0)
+
+        for _ in range(self.max_iterations):
+            price, _, vega = black76(forward, grid.strikes, grid.years, vol, grid.is_call, grid.discount)
+            error = price - target
+
+            if np.all(np.abs(error) < self.tolerance * FORWARD):
+                break
+
+            high = np.where(error > 0, vol, high)
+            low = np.where(error < 0, vol, low)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = vol - error / vega
+
+            vol = np.where((step > low) & (step < high), step, 0.5 * (low + high))
+
+        price, deltas, _ = black76(forward, grid.strikes, grid.years, vol, grid.is_call, grid.discount)
+
+        # a mark with no time value has no vol, and nor has one with no root inside the bounds
+        intrinsic = grid.discount * np.where(grid.is_call, np.maximum(forward - grid.strikes, 0), np.maximum(grid.strikes - forward, 0))
+        failed = ((target <= intrinsic) | (np.abs(price - target) > 1e-6 * FORWARD)
+                  | (vol <= MIN_VOL * 1.0001) | (vol >= MAX_VOL * 0.9999))
+
+        return np.where(failed, np.nan, vol * 100), np.where(failed, np.nan, deltas)
+
+
+BACKENDS = {backend.name: backend for backend in (QuantLibBackend, Black76NewtonBackend)}
+
+
+def benchmark_backend(backend, grid: VolGrid, repeats: int = 1) -> dict:
+    """ Time the backend over the grid, then compare its vols and deltas with those the grid was priced with.
+        Returns options per second overall, and the failures and errors per region;
+        errors are over the identifiable points only, the others are counted as 'unidentifiable'.
+    """
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        vols, deltas = backend.solve(grid)
+    seconds = time.perf_counter() - started
+
+    vol_errors = np.abs(vols - grid.vols)
+    delta_errors = np.abs(deltas - grid.deltas)
+
+    regions = {}
+
+    for region in sorted(set(grid.regions)):
+        in_region = np.array([point_region == region for point_region in grid.regions])
+        failed = in_region & np.isnan(vols)
+        solved = in_region & ~failed & grid.identifiable
+
+        regions[region] = {'count': int(in_region.sum()),
+                           'failure_rate': float(failed.sum() / in_region.sum()),
+                           'unidentifiable': int((in_region & ~grid.identifiable).sum()),
+                           'max_vol_error': float(vol_errors[solved].max()) if solved.any() else None,
+                           'mean_vol_error': float(vol_errors[solved].mean()) if solved.any() else None,
+                           'max_delta_error': float(delta_errors[solved].max()) if solved.any() else None,
+                           'mean_delta_error': float(delta_errors[solved].mean()) if solved.any() else None}
+
+    return {'options_per_second': len(grid) * repeats / seconds,
+            'failure_rate': float(np.isnan(vols).mean()),
+            'regions': regions}
+
+
+def print_report(name: str, result: dict) -> None:
+
+    def _format(value) -> str:
+        return f"{value:>12.2e}" if value is not None else f"{'-':>12}"
+
+    print(f"\nBACKEND {name}: {result['options_per_second']:.0f} OPTIONS/s, {result['failure_rate']:.1%} FAILED")
+    print(f"{'REGION':<18}{'COUNT':>6}{'UNIDENT':>8}{'FAILED':>8}{'MAX VOL ERR':>12}{'MEAN VOL ERR':>13}{'MAX DELTA ERR':>14}{'MEAN DELTA ERR':>15}")
+
+    for region, stats in result['regions'].items():
+        print(f"{region:<18}{stats['count']:>6}{stats['unidentifiable']:>8}{stats['failure_rate']:>8.1%}{_format(stats['max_vol_error'])}"
+              f" {_format(stats['mean_vol_error'])}  {_format(stats['max_delta_error'])}   {_format(stats['mean_delta_error'])}")
+
+
+def get_args(argv):
+
+    opts, args = getopt.getopt(argv, "-hb:n:r:k:", ["backends=", "repeats=", "rate=", "tick="])
+
+    backends = list(BACKENDS)
+    repeats = 1
+    risk_free_rate = 0.0
+    tick = None
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(f'python3 -m benchmarks.VolSolverHarness -h -b <{",".join(BACKENDS)}> -n <repeats> -r <rate %> -k <0.0001>')
+            sys.exit()
+
+        if opt in ("-b", "--backends"):
+            backends = arg.split(',')
+            if any(backend not in BACKENDS for backend in backends):
+                print(f'error; backends must be from {list(BACKENDS)}')
+                sys.exit()
+
+        try:
+            if opt in ("-n", "--repeats"):
+                repeats = int(arg)
+            if opt in ("-r", "--rate"):
+                risk_free_rate = float(arg)
+            if opt in ("-k", "--tick"):
+                tick = float(arg)
+        except Exception as e:
+            print(f'error {e}; repeats must be a whole number, rate and tick numbers')
+            sys.exit()
+
+    return backends, repeats, risk_free_rate, tick
+
+
+if __name__ == "__main__":
+
+    backends, repeats, risk_free_rate, tick = get_args(sys.argv[1:])
+
+    grid = VolGrid(risk_free_rate, tick)
+
+    print(f"GRID OF {len(grid)} OPTIONS: MONEYNESS {MONEYNESS_GRID} TERMS {TERM_GRID} VOLS {VOL_GRID}"
+          f"{f' MARKS ROUNDED TO {tick}' if tick else ''}")
+
+    for backend_name in backends:
+        print_report(backend_name, benchmark_backend(BACKENDS[backend_name](risk_free_rate), grid, repeats))
@@ -0,0 +1,243 @@
+### A Resumable Data Migration Script ###
+import time
+from abc import abstractmethod
+from datetime import datetime
+import psycopg2
+from DatabaseGateway import load_config
+from migrations.DatabaseMigrationBaseClass import DatabaseMigration
+
+
+PROGRESS_TABLE = 'MIGRATION_PROGRESS'
+
+# progress markers recorded (in place of a partition) once a step has copied every partition / been finished
+STEP_COPIED = '<copied>'
+STEP_FINISHED = '<finished>'
+
+DEFAULT_THROTTLE = {'pause_seconds': 0.0, 'max_rows_per_second': 0}
+
+
+class DataMigration(DatabaseMigration):
+    """ Base class for migrations that copy or transform large tables, a partition at a time.
+
+        A data migration is a list of steps (typically one per table). Each step is started once,
+        then its partitions are migrated one by one, each committed and recorded in MIGRATION_PROGRESS
+        before the next, and finally the step is finished (e.g. the rebuilt table swapped in) once.
+        If the migration is interrupted it is not stamped as applied, so the next 'python MigrateDatabase.py'
+        runs it again; it then skips straight past everything recorded and continues from the partition it stopped at.
+
+        Between partitions the migration is throttled by the [migrations] config; a pause after each partition
+        and/or a ceiling on rows copied per second, to leave the database room for the live jobs.
+
+        # Example Skeleton Data Migration Script
+
+        from migrations.DataMigrationBaseClass import DataMigration
+
+        class MyUpdate(DataMigration):
+
+            name = 'add_column_to_ohlcv'
+            steps = ['OHLCV']
+
+            def _start_step(self, step):
+                self.db_cursor.execute(f'''CREATE TABLE {step}_NEW (...) timestamp(ExchangeDate) PARTITION BY MONTH;''')
+
+            def _get_partitions(self, step):
+                return self._month_partitions(step)
+
+            def _migrate_partition(self, step, partition):
+                return self._copy_partition(step, f'{step}_NEW', partition)
+
+            def _finish_step(self, step):
+                self._swap_tables(step, f'{step}_NEW')
+
+        if __name__ == "__main__":
+            MyUpdate()
+
+        A partition may be migrated a second time if the run stopped after its copy was committed but before its
+        progress was; override _reconcile_partition for copies that are not otherwise safe to repeat.
+    """
+
+    # unique name of the migration, the key of its progress records
+    name: str = None
+    # steps, in order
+    steps: list = []
+
+    def _run_script(self) -> None:
+
+        if not self.name:
+            raise RuntimeError(f"{type(self).__name__} needs a name to record its progress under")
+
+        self.throttle: dict = load_config('migrations', DEFAULT_THROTTLE)
+
+        self._check_progress_table_exists()
+
+        for step in self.steps:
+            self._run_step(step)
+
+    def _check_progress_table_exists(self) -> None:
+
+        self.db_cursor.execute(f'''CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+                                    ts TIMESTAMP,
+                                    Migration STRING NOT NULL,
+                                    Step STRING NOT NULL,
+                                    Partition STRING NOT NULL,
+                                    Rows LONG
+                            ) timestamp(ts);''')
+        self.db_connection.commit()
+
+    def _get_progress(self, step: str) -> set:
+        """ Partitions (and step markers) of the step already recorded as done
+        """
+
+        self.db_cursor.execute(f'''SELECT Partition FROM {PROGRESS_TABLE}
+                                    WHERE Migration = %s AND Step = %s;''', (self.name, step))
+
+        return {row[0] for row in self.db_cursor.fetchall()}
+
+    def _record_progress(self, step: str, partition: str, rows: int = None) -> None:
+
+        self.db_cursor.execute(f'''INSERT INTO {PROGRESS_TABLE} VALUES(%s, %s, %s, %s, %s);''',
+                               (datetime.utcnow(), self.name, step, partition, rows))
+        self.db_connection.commit()
+
+    def _run_step(self, step: str) -> None:
+
+        done = self._get_progress(step)
+
+        if STEP_FINISHED in done:
+            print(f"{self.name} {step}: ALREADY FINISHED")
+            return
+
+        if STEP_COPIED not in done:
+            if not done:
+                self._start_step(step)
+                self.db_connection.commit()
+            else:
+                print(f"{self.name} {step}: RESUMING; {len(done)} PARTITIONS ALREADY MIGRATED")
+
+            self._migrate_partitions(step, done)
+            self._record_progress(step, STEP_COPIED)
+
+        self._finish_step(step)
+        self.db_connection.commit()
+        self._record_progress(step, STEP_FINISHED)
+        print(f"{self.name} {step}: FINISHED")
+
+    def _migrate_partitions(self, step: str, done: set) -> None:
+
+        partitions = self._get_partitions(step)
+        pending = [partition for partition in partitions if partition not in done]
+
+        started = time.time()
+        rows_migrated = 0
+
+        for count, partition in enumerate(pending, start=1):
+            partition_started = time.time()
+
+            # the first partition after a restart may have been committed without its progress being recorded
+            if count == 1 and done and self._reconcile_partition(step, partition):
+                rows = None
+            else:
+                rows = self._migrate_partition(step, partition)
+                self.db_connection.commit()
+                rows_migrated += rows or 0
+
+            self._record_progress(step, partition, rows)
+            self._throttle(rows or 0, time.time() - partition_started)
+
+            elapsed = time.time() - started
+            remaining = elapsed / count * (len(pending) - count)
+            print(f"{self.name} {step} {partition}: {rows if rows is not None else 'ALREADY'} ROWS; "
+                  f"{len(partitions) - len(pending) + count}/{len(partitions)} PARTITIONS, "
+                  f"{rows_migrated} ROWS IN {elapsed:.0f}s ({rows_migrated / elapsed if elapsed else 0:.0f} ROWS/s), "
+                  f"ABOUT {remaining:.0f}s TO GO")
+
+    def _throttle(self, rows: int, seconds: float) -> None:
+        """ Pause after a partition, for at least pause_seconds and long enough to keep under max_rows_per_second
+        """
+
+        pause = self.throttle['pause_seconds']
+
+        if self.throttle['max_rows_per_second']:
+            pause = max(pause, rows / self.throttle['max_rows_per_second'] - seconds)
+
+        if pause > 0:
+            time.sleep(pause)
+
+    def _start_step(self, step: str) -> None:
+        """ Run once, before the step's first partition (e.g. create the new table)
+        """
+        pass
+
+    @abstractmethod
+    def _get_partitions(self, step: str) -> list:
+        """ The step's partition keys (e.g. 'YYYY-MM'), in the order to migrate them
+        """
+        pass
+
+    @abstractmethod
+    def _migrate_partition(self, step: str, partition: str) -> int:
+        """ Migrate a single partition; committed by the caller. Returns the rows migrated.
+        """
+        pass
+
+    def _reconcile_partition(self, step: str, partition: str) -> bool:
+        """ On a restart, whether the first pending partition was in fact migrated already
+        """
+        return False
+
+    def _finish_step(self, step: str) -> None:
+        """ Run once, after the step's last partition (e.g. verify and swap in the new table)
+        """
+        pass
+
+    def _table_exists(self, table: str) -> bool:
+
+        try:
+            self.db_cursor.execute(f'''SELECT count() FROM table_columns('{table}');''')
+            return self.db_cursor.fetchone()[0] > 0
+        except psycopg2.Error:
+            self.db_connection.rollback()
+            return False
+
+    def _month_partitions(self, table: str, column: str = 'ExchangeDate') -> list:
+        """ 'YYYY-MM' of every month from the table's first to last value of the column
+        """
+
+        self.db_cursor.execute(f'''SELECT min({column}), max({column}) FROM {table};''')
+        first_date, last_date = self.db_cursor.fetchone()
+
+        if first_date is None:
+            return []
+
+        months = []
+        year, month = first_date.year, first_date.month
+
+        while (year, month) <= (last_date.year, last_date.month):
+            months.append(f"{year}-{month:02}")
+            year, month = year + month // 12, month % 12 + 1
+
+        return months
+
+    def _copy_partition(self, source: str, target: str, partition: str, columns: str = '*', column: str = 'ExchangeDate') -> int:
+        """ Copy the rows of a single month (or day) from source to target. Returns the rows copied.
+        """
+
+        self.db_cursor.execute(f'''SELECT count() FROM {source} WHERE {column} IN '{partition}';''')
+        rows = self.db_cursor.fetchone()[0]
+
+        insert_columns = '' if columns == '*' else f' ({columns})'
+
+        self.db_cursor.execute(f'''INSERT INTO {target}{insert_columns}
+                                    SELECT {columns} FROM {source}
+                                    WHERE {column} IN '{partition}';''')
+
+        return rows
+
+    def _swap_tables(self, table: str, new_table: str) -> None:
+        """ Replace the table with its rebuilt copy; safe to run again if stopped between the drop and the rename
+        """
+
+        if self._table_exists(table):
+            self.db_cursor.execute(f'''DROP TABLE {table};''')
+        self.db_cursor.execute(f'''RENAME TABLE {new_table} TO {table};''')
+        self.db_connection.commit()
@@ -1,7 +1,6 @@
 ### A Database Migration Script ###
-import tomli
-import psycopg2
 from abc import ABC, abstractmethod
+from DatabaseGateway import get_database_pool
 
 
 class DatabaseMigration(ABC):
@@ -39,69 +38,24 @@ class DatabaseMigration(ABC):
 
     def __init__(self):
 
-        self.config = "MigrateDatabase.toml"
-
-        self.db_config: dict = self._load_config()
+        self.db_pool = get_database_pool()
         self.db_cursor = None
         self.db_connection = None
 
         try:
-            self._connectDB(self.db_config)
+            self.db_connection = self.db_pool.get_connection()
+            self.db_cursor = self.db_connection.cursor()
             # implement this method with migration code
             self._run_script()
         except Exception as e:
             print(f"An exception has occurred: {e}")
+            # re-raised, so a failed migration does not get its version stamped
+            raise e
         finally:
             if self.db_cursor:
                 self.db_cursor.close()
             if self.db_connection:
-                self.db_connection.close()
-
-    def _load_config(self) -> dict:
-        """ Load up the database configuration .toml file
-        """
-
-        db_config = {}
-
-        with open(self.config, mode="rb") as cf:
-            config = tomli.load(cf)
-
-            # database config
-            db_config['user'] = config['database']['user']
-            db_config['password'] = config['database']['password']
-            db_config['host'] = config['database']['host']
-            db_config['port'] = config['database']['port']
-            db_config['database'] = config['database']['database']
-
-        return db_config
-
-    def _connectDB(self, db_config) -> None:
-        """ Establish connection to the database using given config
-        """
-
-        try:
-            # Connect to DB
-            self.db_connection = psycopg2.connect(user=db_config['user'],
-                                             password=db_config['password'],
-                                             host=db_config['host'],
-                                             port=db_config['port'],
-                                             database=db_config['database']
-                                             )
-            print('Postgres connection is established.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            raise e
-
-        try:
-            # open connection for read/write
-            self.db_cursor = self.db_connection.cursor()
-            print('Postgres connection is opened.')
-        except Exception as e:
-            print(f"An exception has occurred: {e}")
-            if self.db_connection:
-                self.db_connection.close()
-            print('Postgres connection is closed.')
-            raise e
+                self.db_pool.put_connection(self.db_connection)
 
     @abstractmethod
     def _run_script(self) -> None:
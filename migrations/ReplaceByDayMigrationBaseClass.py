@@ -0,0 +1,98 @@
+### A Data Migration that re-keys a table by day ###
+from abc import abstractmethod
+from DatabaseGateway import wait_for_wal
+from migrations.DataMigrationBaseClass import DataMigration
+
+
+class ReplaceByDayMigration(DataMigration):
+    """ Base class for migrations that rebuild an append only table (VOL_SURFACE, VOL_METRICS) as one with
+        ExchangeDay as the designated timestamp, a partition per day, and DEDUP UPSERT KEYS, so rewriting a day
+        replaces it rather than appending to it.
+
+        Each key keeps its latest (by ts) row as the data is copied across, a month at a time, into <table>_DAILY;
+        copying a month again after a restart is harmless, as the new table deduplicates it. Once every key has been
+        copied the new table is swapped in.
+
+        # Example Skeleton Script
+
+        from migrations.ReplaceByDayMigrationBaseClass import ReplaceByDayMigration
+
+        class MyUpdate(ReplaceByDayMigration):
+
+            name = 'replace_vol_surface_by_day'
+            steps = ['VOL_SURFACE']
+            keys = VOL_SURFACE_UPSERT_KEYS
+            values = ['Vol']
+
+            def _create_table(self, table):
+                check_vol_surface_table_exists(self.db_cursor, table)
+
+        if __name__ == "__main__":
+            MyUpdate()
+    """
+
+    # the table's upsert keys, and the columns taken from the latest row of each key
+    keys: list = []
+    values: list = []
+
+    @abstractmethod
+    def _create_table(self, table: str) -> None:
+        """ Create the new, day keyed, table under the given name
+        """
+        pass
+
+    def _start_step(self, table: str) -> None:
+
+        new_table = f'{table}_DAILY'
+
+        self.db_cursor.execute(f'''DROP TABLE IF EXISTS {new_table};''')
+        self._create_table(new_table)
+
+    def _get_partitions(self, table: str) -> list:
+
+        # nothing to copy if the jobs have never written the table
+        if not self._table_exists(table):
+            return []
+
+        return self._month_partitions(table, 'ExchangeDay')
+
+    def _migrate_partition(self, table: str, partition: str) -> int:
+
+        self.db_cursor.execute(f'''SELECT count() FROM {table} WHERE ExchangeDay IN '{partition}';''')
+        rows = self.db_cursor.fetchone()[0]
+
+        # the old tables are in ts order, so last() is the latest value written for the key
+        columns = ', '.join(['ts'] + self.keys + self.values)
+        self.db_cursor.execute(f'''INSERT INTO {table}_DAILY ({columns})
+                                    SELECT max(ts) ts, {', '.join(self.keys)}, {', '.join(f'last({value}) {value}' for value in self.values)}
+                                    FROM {table}
+                                    WHERE ExchangeDay IN '{partition}';''')
+
+        return rows
+
+    def _finish_step(self, table: str) -> None:
+
+        new_table = f'{table}_DAILY'
+
+        # stopped after the old table was dropped, or the table has never been written; only the rename is left to do
+        if not self._table_exists(table):
+            self._swap_tables(table, new_table)
+            return
+
+        wait_for_wal(self.db_cursor, new_table)
+
+        self.db_cursor.execute(f'''SELECT count() FROM {table};''')
+        row_count = self.db_cursor.fetchone()[0]
+
+        self.db_cursor.execute(f'''SELECT count() FROM (SELECT DISTINCT {', '.join(self.keys)} FROM {table});''')
+        key_count = self.db_cursor.fetchone()[0]
+
+        self.db_cursor.execute(f'''SELECT count() FROM {new_table};''')
+        copied = self.db_cursor.fetchone()[0]
+
+        if copied != key_count:
+            raise RuntimeError(f"{table}: copied {copied} rows but the table has {key_count} keys; {table} left unchanged")
+
+        self._swap_tables(table, new_table)
+
+        print(f"{table}: KEYED BY DAY; {row_count - copied} REPEATED ROWS REMOVED")
@@ -0,0 +1,27 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections
+from migrations.DatabaseMigrationBaseClass import DatabaseMigration
+from DeribitStreamIngester import check_ohlcv_1d_table_exists
+
+# Define your upgrade class that inherits from the base class DatabaseMigration
+class MyUpdate(DatabaseMigration):
+
+    # This is the method that will be executed when this script is run
+    # and must be the entry point to the database migration itself.
+    def _run_script(self) -> None:
+        # This is where you put the code that will be run as part of the upgrade.
+        self._create_ohlcv_1d_table()
+
+    def _create_ohlcv_1d_table(self):
+
+        # Daily bars of streamed marks, written by DeribitStreamIngester
+        check_ohlcv_1d_table_exists(self.db_cursor)
+
+        self.db_connection.commit()
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
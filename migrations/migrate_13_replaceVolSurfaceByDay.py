@@ -0,0 +1,27 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections, and re-keys a table by day a month at a time
+from migrations.ReplaceByDayMigrationBaseClass import ReplaceByDayMigration
+from DeribitVolSurfaceBuilder import check_vol_surface_table_exists, VOL_SURFACE_UPSERT_KEYS
+
+
+# Define your upgrade class that inherits from the base class ReplaceByDayMigration
+class MyUpdate(ReplaceByDayMigration):
+    """ Rebuild the surface table keyed by day, with DEDUP UPSERT KEYS on each grid point,
+        so rebuilding a day replaces it rather than appending to it.
+    """
+
+    name = 'replace_vol_surface_by_day'
+    steps = ['VOL_SURFACE']
+    keys = VOL_SURFACE_UPSERT_KEYS
+    values = ['Vol']
+
+    def _create_table(self, table: str) -> None:
+
+        check_vol_surface_table_exists(self.db_cursor, table)
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
@@ -0,0 +1,27 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections, and re-keys a table by day a month at a time
+from migrations.ReplaceByDayMigrationBaseClass import ReplaceByDayMigration
+from VolMetricsEngine import check_vol_metrics_table_exists, VOL_METRICS_UPSERT_KEYS
+
+
+# Define your upgrade class that inherits from the base class ReplaceByDayMigration
+class MyUpdate(ReplaceByDayMigration):
+    """ Rebuild the metrics table keyed by day, with DEDUP UPSERT KEYS on each metric,
+        so recalculating a day replaces it rather than appending to it.
+    """
+
+    name = 'replace_vol_metrics_by_day'
+    steps = ['VOL_METRICS']
+    keys = VOL_METRICS_UPSERT_KEYS
+    values = ['Value']
+
+    def _create_table(self, table: str) -> None:
+
+        check_vol_metrics_table_exists(self.db_cursor, table)
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
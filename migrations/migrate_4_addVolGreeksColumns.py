@@ -0,0 +1,38 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections
+from migrations.DatabaseMigrationBaseClass import DatabaseMigration
+import psycopg2
+
+# Define your upgrade class that inherits from the base class DatabaseMigration
+class MyUpdate(DatabaseMigration):
+
+    # This is the method that will be executed when this script is run
+    # and must be the entry point to the database migration itself.
+    def _run_script(self) -> None:
+        # This is where you put the code that will be run as part of the upgrade.
+        self._add_greeks_columns()
+
+    def _add_greeks_columns(self):
+
+        try:
+            self.db_cursor.execute('''SELECT "column" FROM table_columns('OHLCV_VOL');''')
+            existing_columns = {row[0] for row in self.db_cursor.fetchall()}
+        except psycopg2.Error:
+            # no vol table yet; the vol job creates it with the greeks columns
+            self.db_connection.rollback()
+            return
+
+        # Greeks calculated alongside the open/close implied vols; existing rows are left NULL.
+        # A table created by the vol job since the greeks were added has them already
+        for column in ['OpenGamma', 'OpenVega', 'OpenTheta', 'CloseGamma', 'CloseVega', 'CloseTheta']:
+            if column not in existing_columns:
+                self.db_cursor.execute(f'''ALTER TABLE OHLCV_VOL ADD COLUMN {column} FLOAT;''')
+
+        self.db_connection.commit()
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
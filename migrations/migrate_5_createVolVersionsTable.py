@@ -0,0 +1,33 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections
+from migrations.DatabaseMigrationBaseClass import DatabaseMigration
+
+# Define your upgrade class that inherits from the base class DatabaseMigration
+class MyUpdate(DatabaseMigration):
+
+    # This is the method that will be executed when this script is run
+    # and must be the entry point to the database migration itself.
+    def _run_script(self) -> None:
+        # This is where you put the code that will be run as part of the upgrade.
+        self._create_vol_versions_table()
+
+    def _create_vol_versions_table(self):
+
+        # Registry of recomputed vol tables (OHLCV_VOL_V<n>); the latest row for a version is its status
+        self.db_cursor.execute('''CREATE TABLE IF NOT EXISTS VOL_VERSIONS (
+                                    ts TIMESTAMP,
+                                    Version INT NOT NULL,
+                                    TableName STRING NOT NULL,
+                                    RiskFreeRate FLOAT,
+                                    DeltaPrecision FLOAT,
+                                    Status STRING NOT NULL
+                            ) timestamp(ts);''')
+
+        self.db_connection.commit()
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
@@ -0,0 +1,87 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections
+from migrations.DatabaseMigrationBaseClass import DatabaseMigration
+from datetime import datetime
+
+# Columns of each table after the ts/Exchange/MarketSymbol/ExchangeDay/ExchangeDate/ExchangeTimestamp keys
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+OHLCV_VOL_COLUMNS = ['OpenVol', 'OpenStrike', 'OpenDelta', 'CloseVol', 'CloseStrike', 'CloseDelta', 'Term', 'Volume',
+                     'OpenGamma', 'OpenVega', 'OpenTheta', 'CloseGamma', 'CloseVega', 'CloseTheta']
+
+
+# Define your upgrade class that inherits from the base class DatabaseMigration
+class MyUpdate(DatabaseMigration):
+
+    # This is the method that will be executed when this script is run
+    # and must be the entry point to the database migration itself.
+    def _run_script(self) -> None:
+        # This is where you put the code that will be run as part of the upgrade.
+        self._rebuild_table('OHLCV', OHLCV_COLUMNS)
+        self._rebuild_table('OHLCV_VOL', OHLCV_VOL_COLUMNS)
+
+    def _rebuild_table(self, table: str, value_columns: list):
+        """ Rebuild the table with Exchange and MarketSymbol as indexed SYMBOL columns,
+            and ExchangeDate as the designated timestamp, partitioned by month,
+            so date range and per symbol queries prune partitions and use the index.
+        """
+
+        new_table = f'{table}_PARTITIONED'
+
+        self.db_cursor.execute(f'''DROP TABLE IF EXISTS {new_table};''')
+        self.db_cursor.execute(f'''CREATE TABLE {new_table} (
+                                ts TIMESTAMP,
+                                Exchange  SYMBOL CAPACITY 256 CACHE INDEX,
+                                MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
+                                ExchangeDay TIMESTAMP NOT NULL,
+                                ExchangeDate TIMESTAMP NOT NULL,
+                                ExchangeTimestamp LONG NOT NULL,
+                                {', '.join(f'{column} FLOAT' for column in value_columns)}
+                        ) timestamp(ExchangeDate) PARTITION BY MONTH;''')
+
+        self.db_cursor.execute(f'''SELECT min(ts), max(ts), count() FROM {table};''')
+        first_ts, last_ts, row_count = self.db_cursor.fetchone()
+
+        columns = ', '.join(['ts', 'Exchange', 'MarketSymbol', 'ExchangeDay', 'ExchangeDate', 'ExchangeTimestamp'] + value_columns)
+        copied = 0
+
+        # copy a month of the old (ts partitioned) table at a time, so each read prunes to its own partitions
+        for start, end in self._month_ranges(first_ts, last_ts):
+            self.db_cursor.execute(f'''INSERT INTO {new_table} ({columns})
+                                    SELECT {columns} FROM {table}
+                                    WHERE ts >= '{start.isoformat()}' AND ts < '{end.isoformat()}';''')
+            self.db_connection.commit()
+
+            self.db_cursor.execute(f'''SELECT count() FROM {new_table};''')
+            copied = self.db_cursor.fetchone()[0]
+            print(f"{table}: COPIED {copied} OF {row_count} ROWS UP TO {end:%Y-%m}")
+
+        if copied != row_count:
+            raise RuntimeError(f"{table}: copied {copied} rows but the table has {row_count}; {table} left unchanged")
+
+        self.db_cursor.execute(f'''DROP TABLE {table};''')
+        self.db_cursor.execute(f'''RENAME TABLE {new_table} TO {table};''')
+        self.db_connection.commit()
+
+    def _month_ranges(self, first_ts: datetime, last_ts: datetime) -> list:
+        """ [start, end) pairs covering every month from first_ts to last_ts
+        """
+
+        if first_ts is None:
+            return []
+
+        ranges = []
+        start = datetime(first_ts.year, first_ts.month, 1)
+
+        while start <= last_ts:
+            end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+            ranges.append((start, end))
+            start = end
+
+        return ranges
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
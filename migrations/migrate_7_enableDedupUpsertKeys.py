@@ -0,0 +1,112 @@
+### Database Migration Script;
+
+# Import the base class that handles the database connections, and copies a table a partition at a time
+from migrations.DataMigrationBaseClass import DataMigration
+from DatabaseGateway import wait_for_wal
+import re
+
+# Columns of each table after the ts/Exchange/MarketSymbol/ExchangeDay/ExchangeDate/ExchangeTimestamp keys
+VALUE_COLUMNS = {'OHLCV': ['Open', 'High', 'Low', 'Close', 'Volume'],
+                 'OHLCV_VOL': ['OpenVol', 'OpenStrike', 'OpenDelta', 'CloseVol', 'CloseStrike', 'CloseDelta', 'Term', 'Volume',
+                               'OpenGamma', 'OpenVega', 'OpenTheta', 'CloseGamma', 'CloseVega', 'CloseTheta']}
+
+# upsert keys must include the designated timestamp
+UPSERT_KEYS = ['ExchangeDate', 'Exchange', 'MarketSymbol', 'ExchangeTimestamp']
+
+# DEDUP needs WAL tables, which need QuestDB 7.3 or later
+MINIMUM_QUESTDB_VERSION = (7, 3)
+WAL_WAIT_SECONDS = 600
+
+
+# Define your upgrade class that inherits from the base class DataMigration
+class MyUpdate(DataMigration):
+    """ Rebuild each table as a WAL table with DEDUP UPSERT KEYS on (Exchange, MarketSymbol, ExchangeTimestamp),
+        so re-inserting a row replaces it rather than duplicating it. Existing duplicates are
+        collapsed (last written wins) as the data is copied across, a month at a time.
+        Copying a month again after a restart is harmless, as the new table deduplicates it.
+    """
+
+    name = 'enable_dedup_upsert_keys'
+    steps = ['OHLCV', 'OHLCV_VOL']
+
+    def _check_questdb_version(self):
+
+        self.db_cursor.execute('''SELECT build();''')
+        build = self.db_cursor.fetchone()[0]
+
+        found = re.search(r'QuestDB (\d+)\.(\d+)', build)
+        version = (int(found.group(1)), int(found.group(2))) if found else (0, 0)
+
+        if version < MINIMUM_QUESTDB_VERSION:
+            raise RuntimeError(f"DEDUP UPSERT KEYS needs QuestDB {MINIMUM_QUESTDB_VERSION[0]}.{MINIMUM_QUESTDB_VERSION[1]} "
+                               f"or later; the server is '{build}'. Upgrade QuestDB and migrate again.")
+
+    def _columns(self, table: str) -> str:
+
+        return ', '.join(['ts', 'Exchange', 'MarketSymbol', 'ExchangeDay', 'ExchangeDate', 'ExchangeTimestamp'] + VALUE_COLUMNS[table])
+
+    def _start_step(self, table: str) -> None:
+
+        self._check_questdb_version()
+
+        new_table = f'{table}_DEDUP'
+
+        self.db_cursor.execute(f'''DROP TABLE IF EXISTS {new_table};''')
+        self.db_cursor.execute(f'''CREATE TABLE {new_table} (
+                                ts TIMESTAMP,
+                                Exchange  SYMBOL CAPACITY 256 CACHE INDEX,
+                                MarketSymbol  SYMBOL CAPACITY 131072 NOCACHE INDEX,
+                                ExchangeDay TIMESTAMP NOT NULL,
+                                ExchangeDate TIMESTAMP NOT NULL,
+                                ExchangeTimestamp LONG NOT NULL,
+                                {', '.join(f'{column} FLOAT' for column in VALUE_COLUMNS[table])}
+                        ) timestamp(ExchangeDate) PARTITION BY MONTH WAL
+                        DEDUP UPSERT KEYS({', '.join(UPSERT_KEYS)});''')
+
+    def _get_partitions(self, table: str) -> list:
+
+        return self._month_partitions(table)
+
+    def _migrate_partition(self, table: str, partition: str) -> int:
+
+        # the source is partitioned by month, so each copy reads a single partition
+        return self._copy_partition(table, f'{table}_DEDUP', partition, self._columns(table))
+
+    def _finish_step(self, table: str) -> None:
+
+        new_table = f'{table}_DEDUP'
+
+        # stopped after the old table was dropped; only the rename is left to do
+        if not self._table_exists(table):
+            self._swap_tables(table, new_table)
+            return
+
+        self._wait_for_wal(new_table)
+
+        self.db_cursor.execute(f'''SELECT count() FROM {table};''')
+        row_count = self.db_cursor.fetchone()[0]
+
+        self.db_cursor.execute(f'''SELECT count() FROM (SELECT DISTINCT {', '.join(UPSERT_KEYS)} FROM {table});''')
+        key_count = self.db_cursor.fetchone()[0]
+
+        self.db_cursor.execute(f'''SELECT count() FROM {new_table};''')
+        copied = self.db_cursor.fetchone()[0]
+
+        if copied != key_count:
+            raise RuntimeError(f"{table}: copied {copied} rows but the table has {key_count} keys; {table} left unchanged")
+
+        self._swap_tables(table, new_table)
+
+        print(f"{table}: DEDUP ENABLED; {row_count - copied} DUPLICATE ROWS REMOVED")
+
+    def _wait_for_wal(self, table: str):
+        """ WAL writes are applied to the table asynchronously; wait until they all have been
+        """
+
+        wait_for_wal(self.db_cursor, table, WAL_WAIT_SECONDS)
+
+
+# This is required to enable the script to be executed by the automated process
+if __name__ == "__main__":
+    # Instantiating the migration class causes the script to be run
+    MyUpdate()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the jobs and migrations import each other as top level modules, from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
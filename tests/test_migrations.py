@@ -0,0 +1,300 @@
+import glob
+import os
+import re
+import psycopg2
+import MigrateDatabase
+import migrations.DatabaseMigrationBaseClass
+from conftest import REPO_ROOT
+
+
+class StubDatabase:
+    """ Just enough of a QuestDB 7.3 server for the migration scripts; tables are tracked by name (and column),
+        the statements run are recorded, and every table is empty.
+    """
+
+    def __init__(self, version: float, tables: dict = None):
+
+        self.versions = [version]
+        self.tables = {table: list(columns) for table, columns in (tables or {}).items()}
+        self.statements = []
+
+    def execute(self, sql: str, params: tuple = None) -> list:
+
+        sql = ' '.join(sql.split())
+        self.statements.append(sql)
+
+        if sql.startswith('INSERT INTO DB_VERSION'):
+            self.versions.append(params[1])
+            return []
+
+        if 'max(Version)' in sql:
+            return [(max(self.versions, key=lambda version: -1 if version is None else version),)]
+
+        if 'build()' in sql:
+            return [('Build Information: QuestDB 7.3.10, JDK 17.0.9, Commit Hash 0',)]
+
+        found = re.search(r"table_columns\('(\w+)'\)", sql)
+        if found:
+            if found.group(1) not in self.tables:
+                raise psycopg2.Error(f"table does not exist [table={found.group(1)}]")
+            columns = self.tables[found.group(1)]
+            return [(len(columns),)] if 'count()' in sql else [(column,) for column in columns]
+
+        found = re.match(r"CREATE TABLE (?:IF NOT EXISTS )?'?(\w+)", sql)
+        if found:
+            self.tables.setdefault(found.group(1), ['ts'])
+            return []
+
+        found = re.match(r"DROP TABLE (?:IF EXISTS )?(\w+)", sql)
+        if found:
+            self.tables.pop(found.group(1), None)
+            return []
+
+        found = re.match(r"RENAME TABLE (\w+) TO (\w+)", sql)
+        if found:
+            self.tables[found.group(2)] = self.tables.pop(found.group(1))
+            return []
+
+        found = re.match(r"ALTER TABLE (\w+) ADD COLUMN (\w+)", sql)
+        if found:
+            self.tables[found.group(1)].append(found.group(2))
+            return []
+
+        # empty tables; no first or last dates, no rows, no keys
+        if sql.startswith('SELECT min('):
+            return [(None, None, 0)] if 'count()' in sql else [(None, None)]
+
+        if sql.startswith('SELECT count()'):
+            return [(0,)]
+
+        # wal_tables(), tables(), progress records
+        return []
+
+
+class StubCursor:
+
+    def __init__(self, database: StubDatabase):
+
+        self.database = database
+        self.description = None
+        self._rows = []
+
+    def execute(self, sql: str, params: tuple = None) -> None:
+
+        self._rows = self.database.execute(sql, params)
+
+    def fetchone(self):
+
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self) -> list:
+
+        return list(self._rows)
+
+    def close(self) -> None:
+        pass
+
+
+class StubConnection:
+
+    def __init__(self, database: StubDatabase):
+
+        self.database = database
+
+    def cursor(self) -> StubCursor:
+
+        return StubCursor(self.database)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+
+class StubPool:
+
+    def __init__(self, database: StubDatabase):
+
+        self.database = database
+
+    def get_connection(self) -> StubConnection:
+
+        return StubConnection(self.database)
+
+    def put_connection(self, connection: StubConnection) -> None:
+        pass
+
+
+def migrate(monkeypatch, capsys, database: StubDatabase, to_version: float) -> str:
+    """ Run MigrateDatabase against the stub, applying the scripts up to to_version. Returns what it printed.
+    """
+
+    pool = StubPool(database)
+    monkeypatch.chdir(REPO_ROOT)
+    monkeypatch.setattr(MigrateDatabase, 'get_database_pool', lambda: pool)
+    monkeypatch.setattr(migrations.DatabaseMigrationBaseClass, 'get_database_pool', lambda: pool)
+
+    migrations_in_order = MigrateDatabase.MigrateDatabase._get_migrations_in_order
+    monkeypatch.setattr(MigrateDatabase.MigrateDatabase, '_get_migrations_in_order',
+                        lambda self: {version: script for version, script in migrations_in_order(self).items() if version <= to_version})
+
+    MigrateDatabase.MigrateDatabase()
+
+    return capsys.readouterr().out
+
+
+PRICE_TABLES = {'OHLCV': ['ts', 'Exchange', 'MarketSymbol'], 'OHLCV_VOL': ['ts', 'Exchange', 'MarketSymbol']}
+
+
+def test_migrations_apply_in_order(monkeypatch, capsys):
+
+    database = StubDatabase(5, PRICE_TABLES)
+    output = migrate(monkeypatch, capsys, database, float('inf'))
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[1:] == sorted(database.versions[1:])
+    scripts = glob.glob(os.path.join(REPO_ROOT, 'migrations', 'migrate_*_*.py'))
+    assert database.versions[-1] == max(float(os.path.basename(script).split('_')[1]) for script in scripts)
+
+
+def test_migrate_6_partitions_price_tables_by_exchange_date(monkeypatch, capsys):
+
+    database = StubDatabase(5, PRICE_TABLES)
+    output = migrate(monkeypatch, capsys, database, 6)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == 6
+    assert any(statement.startswith('CREATE TABLE OHLCV_PARTITIONED') and 'PARTITION BY MONTH' in statement
+               for statement in database.statements)
+    assert {'OHLCV', 'OHLCV_VOL'} <= set(database.tables)
+
+
+def test_failed_migration_is_not_stamped(monkeypatch, capsys):
+
+    # no price tables to rebuild
+    database = StubDatabase(5)
+
+    def no_tables(sql: str, params: tuple = None, execute=database.execute) -> list:
+        if sql.lstrip().startswith('SELECT min(ts)'):
+            raise psycopg2.Error('table does not exist [table=OHLCV]')
+        return execute(sql, params)
+
+    database.execute = no_tables
+    output = migrate(monkeypatch, capsys, database, 6)
+
+    assert 'An exception has occurred' in output
+    assert database.versions == [5]
+
+
+def test_migrate_7_enables_dedup_upsert_keys(monkeypatch, capsys):
+
+    database = StubDatabase(6, PRICE_TABLES)
+    output = migrate(monkeypatch, capsys, database, 7)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == 7
+    for table in PRICE_TABLES:
+        assert any(statement.startswith(f'CREATE TABLE {table}_DEDUP') and 'WAL DEDUP UPSERT KEYS' in statement
+                   for statement in database.statements)
+        assert f'RENAME TABLE {table}_DEDUP TO {table};' in database.statements
+    assert 'enable_dedup_upsert_keys OHLCV_VOL: FINISHED' in output
+
+
+def test_migrate_7_needs_questdb_7_3(monkeypatch, capsys):
+
+    database = StubDatabase(6, PRICE_TABLES)
+
+    def old_server(sql: str, params: tuple = None, execute=database.execute) -> list:
+        if 'build()' in sql:
+            return [('Build Information: QuestDB 6.4.3, JDK 11.0.8, Commit Hash 0',)]
+        return execute(sql, params)
+
+    database.execute = old_server
+    output = migrate(monkeypatch, capsys, database, 7)
+
+    assert 'needs QuestDB 7.3 or later' in output
+    assert database.versions == [6]
+    assert set(PRICE_TABLES) <= set(database.tables)
+
+
+def assert_migration_creates(monkeypatch, capsys, version: float, table: str) -> None:
+    """ Migrating from the version before creates the table, and stamps the version
+    """
+
+    database = StubDatabase(version - 1, PRICE_TABLES)
+    output = migrate(monkeypatch, capsys, database, version)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == version
+    assert table in database.tables
+
+
+def test_migrate_8_creates_option_chain_table(monkeypatch, capsys):
+
+    assert_migration_creates(monkeypatch, capsys, 8, 'OPTION_CHAIN')
+
+
+def test_migrate_9_creates_one_minute_bar_table(monkeypatch, capsys):
+
+    assert_migration_creates(monkeypatch, capsys, 9, 'OHLCV_1M')
+
+
+def test_migrate_12_creates_daily_bar_table(monkeypatch, capsys):
+
+    assert_migration_creates(monkeypatch, capsys, 12, 'OHLCV_1D')
+
+
+def test_migrate_10_creates_vol_intraday_table(monkeypatch, capsys):
+
+    assert_migration_creates(monkeypatch, capsys, 10, 'VOL_INTRADAY')
+
+
+def test_migrate_11_creates_job_runs_table(monkeypatch, capsys):
+
+    assert_migration_creates(monkeypatch, capsys, 11, 'JOB_RUNS')
+
+
+def test_migrate_4_skips_a_missing_vol_table(monkeypatch, capsys):
+
+    database = StubDatabase(3)
+    output = migrate(monkeypatch, capsys, database, 4)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == 4
+    assert 'OHLCV_VOL' not in database.tables
+
+
+def test_migrate_4_adds_only_missing_greeks_columns(monkeypatch, capsys):
+
+    database = StubDatabase(3, {'OHLCV_VOL': ['ts', 'CloseVol', 'OpenGamma', 'OpenVega', 'OpenTheta']})
+    output = migrate(monkeypatch, capsys, database, 4)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == 4
+    assert database.tables['OHLCV_VOL'] == ['ts', 'CloseVol', 'OpenGamma', 'OpenVega', 'OpenTheta',
+                                            'CloseGamma', 'CloseVega', 'CloseTheta']
+
+
+def test_migrate_13_keys_vol_surface_by_day(monkeypatch, capsys):
+
+    database = StubDatabase(12, {'VOL_SURFACE': ['ts', 'Exchange', 'Underlying', 'ExchangeDay', 'Tenor', 'Delta', 'Vol']})
+    output = migrate(monkeypatch, capsys, database, 13)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == 13
+    assert any(statement.startswith('CREATE TABLE IF NOT EXISTS VOL_SURFACE_DAILY') and 'PARTITION BY DAY WAL DEDUP' in statement
+               for statement in database.statements)
+    assert 'RENAME TABLE VOL_SURFACE_DAILY TO VOL_SURFACE;' in database.statements
+
+
+def test_migrate_14_keys_vol_metrics_by_day(monkeypatch, capsys):
+
+    database = StubDatabase(13, {'VOL_METRICS': ['ts', 'Exchange', 'MarketSymbol', 'ExchangeDay', 'Metric', 'Value']})
+    output = migrate(monkeypatch, capsys, database, 14)
+
+    assert 'An exception has occurred' not in output
+    assert database.versions[-1] == 14
+    assert any(statement.startswith('CREATE TABLE IF NOT EXISTS VOL_METRICS_DAILY') and 'PARTITION BY DAY WAL DEDUP' in statement
+               for statement in database.statements)
+    assert 'RENAME TABLE VOL_METRICS_DAILY TO VOL_METRICS;' in database.statements